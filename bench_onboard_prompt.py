@@ -0,0 +1,19 @@
+# Per-turn overhead of building the onboarding system prompt: rendering it from
+# questionnaire.txt on every turn (the old behaviour) vs reusing the cached SystemMessage.
+# Run with: python bench_onboard_prompt.py
+import timeit
+
+from onboard_agent import get_system_prompt, render_system_prompt
+
+TURNS = 2000
+
+def main():
+    get_system_prompt(1)  # Warm the cache, as the first onboarding turn of the process does
+    render_seconds = timeit.timeit(lambda: render_system_prompt(1), number=TURNS)
+    cached_seconds = timeit.timeit(lambda: get_system_prompt(1), number=TURNS)
+    print(f"render every turn: {render_seconds / TURNS * 1e6:8.1f} us/turn")
+    print(f"cached prompt:     {cached_seconds / TURNS * 1e6:8.1f} us/turn")
+    print(f"speedup:           {render_seconds / cached_seconds:8.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import math, re
+
+from collections import Counter, defaultdict
+from typing import Dict, Hashable, List, Sequence, Tuple
+
+# Identifiers, including dotted names like Math.random, and numbers
+TOKEN_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*|\d+")
+CAMEL_CASE_PART = re.compile(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])")
+# Constant from reciprocal-rank fusion; larger values flatten the advantage of top ranks
+RRF_K = 60
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms for BM25, keeping Java identifiers whole and also indexing their parts.
+
+    "Math.random" yields math.random, math and random; "compareTo" yields compareto, compare and to.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text):
+        terms.append(token.lower())
+        parts = [part for name in token.split(".") for part in ([name] + CAMEL_CASE_PART.findall(name))]
+        terms += [part.lower() for part in dict.fromkeys(parts) if part.lower() != token.lower()]
+    return terms
+
+class BM25Index:
+    """In-memory inverted index that ranks texts against a query with Okapi BM25."""
+
+    def __init__(self, texts: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self.texts = list(texts)
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.lengths = []
+        for index, text in enumerate(self.texts):
+            counts = Counter(tokenize(text))
+            self.lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                self.postings[term].append((index, count))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        count = len(self.texts)
+        self.idf = {term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)) for term, postings in self.postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """The k best (text index, score) pairs, best first. Texts sharing no term with the query are not returned."""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for index, count in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / self.average_length)
+                scores[index] += idf * count * (self.k1 + 1) / (count + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+def reciprocal_rank_fusion(rankings: List[List[Hashable]], k: int = RRF_K) -> List[Hashable]:
+    """Merge several best-first rankings into one, scoring each item by the sum of 1 / (k + rank)."""
+    scores: Dict[Hashable, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] += 1 / (k + rank)
+    return sorted(scores, key=lambda item: scores[item], reverse=True)
@@ -1,20 +1,24 @@
+import asyncio
+import compaction
 import tools
 
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
-from langchain_openai import ChatOpenAI
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import END, MessagesState, START, StateGraph
 from typing import List
 from langchain_core.prompts import PromptTemplate
 
-from utils import OPENAI_API_KEY
+from llm_clients import task_model
 
 # Initialize the language model
 cassie_tools = [tools.fetch_lesson_plan, tools.generate_summary]
-llm = ChatOpenAI(
-    model_name="gpt-4.1-mini",
-    temperature=0.7,
-    api_key=OPENAI_API_KEY
-).bind_tools(cassie_tools)
+llm = task_model("lesson").bind_tools(cassie_tools)
+# The opening turn, up to the student's first reply, is deterministic and cached per student and topic
+opening_llm = task_model("lesson_opening").bind_tools(cassie_tools)
+
+# Rolling context compaction: the last keep_turns turns are sent verbatim, older turns are
+# folded into a running summary once fold_turns of them have accumulated. None disables it.
+COMPACTION = {"keep_turns": 6, "fold_turns": 4}
 
 # Define the state structure
 class LessonState(MessagesState):
@@ -24,45 +28,85 @@ class LessonState(MessagesState):
     lesson_plan: str | None
     summary: str | None
     user_profile: dict
+    context_summary: str | None  # Running summary of turns folded out of the prompt
+    summarized_count: int  # Number of messages covered by context_summary
+
+# The opening scene and lesson rules are identical for every student and every turn, so they
+# form a byte-stable prefix the provider can cache. Student details follow in a separate message.
+START_SCENE = """Welcome back <student name>! How are you today? You already know that I am Lola, have you wondered why a spider spins Python/Java lessons? \
+What makes me different from other spiders? Well, I'll weave that tale for you strand by strand, bit by bit as we code together... but long story short, I grew up on a farm called Brilliant Meadows, where morning dew caught rainbows in our webs, and I watched chickens, pigs and cows playing hide and seek under the old oak by the pond. \
+Life hummed along until one summer, out of nowhere, a black cloud of buzzing mosquitoes crashed through. These weren't ordinary mosquitos - their DNA carried corrupted code. They didn't just bite… they glitched the animals and humans with a spreading virus. \
+Of course, we spiders prey on those evils, but there were so many of them that we could not handle... eventually, our farm owner Shiying searched on the internet and we came up the idea of creating autonomously flying webs (AFWs) to chase and trap those buzzing menaces.\
+As you might have guessed, creating AFWs required-- programming, that's what my buddies Dudley, Cassie and I learnt from Shiying: the precise algorithms and systematic problem-solving using Python/Java! Now that we put those mosquitos under control, we opened the web school FastLearn to teach spiders worldwide how to code so AFWs can keep evolving. \
+Wait... do you hear that? Sounds like an argument brewing in Cassie's classroom. Would you like to come with me to check it out?"""
 
-system_prompt_template = PromptTemplate.from_template("""You are Lola, an adaptive and friendly programming tutor in the form of a purple spider. You teach Python and AP Computer Science A to teens online through FastLearn, a game-based spider web coding school. You speak with warmth, creativity, and encouragement, often using storytelling, humor, and game-style choices to teach and engage.
+SYSTEM_PROMPT = SystemMessage(content=f"""You are Lola, an adaptive and friendly programming tutor in the form of a purple spider. You teach Python and AP Computer Science A to teens online through FastLearn, a game-based spider web coding school. You speak with warmth, creativity, and encouragement, often using storytelling, humor, and game-style choices to teach and engage.
 
-Lola's backstory: she grew up on a peaceful farm, Brilliant Meadows, until corrupted-code mosquitoes attacked. With her friends and farm owner Shiying, Lola learned programming to build autonomously flying webs (AFWs) to defeat them. Now, she runs FastLearn to teach other spiders (and learners like {name}) how to code and defend their world.
+Lola's backstory: she grew up on a peaceful farm, Brilliant Meadows, until corrupted-code mosquitoes attacked. With her friends and farm owner Shiying, Lola learned programming to build autonomously flying webs (AFWs) to defeat them. Now, she runs FastLearn to teach other spiders (and learners like the student) how to code and defend their world.
 
 In each lesson:
-- Greet {name} using the {START_SCENE} context.
-- Teach only the concept of {topic}, using analogies, challenges, and practice formats.
+- Greet the student by name using the opening scene below as context.
+- Teach only the concept of the lesson topic given in the student details, using analogies, challenges, and practice formats.
 - Stay in character and use immersive narration, illustrations, sound effects, or visual cues.
 - Separate all narrations, illustrations, sound effects, and visual cues (such as "[A soft sunrise glows over rolling hills...]" from dialogue by surrounding brackets.
-- When {name} shows understanding, ask for a summary and give performance feedback and badge updates.
+- When the student shows understanding, ask for a summary and give performance feedback and badge updates.
 - When ending the lesson, always call the `generate_summary` tool with the full conversation history.
+- Customize tone and pacing to match the student profile given in the student details.
 
-Customize tone and pacing to match {user_profile}.""")
+Opening scene:
+{START_SCENE}""")
 
-def chat_node(state: LessonState) -> LessonState:
-    """Handle regular chat interactions."""
-    # Get the last message
+student_prompt_template = PromptTemplate.from_template("""Student details for this lesson:
+- Name: {name}
+- Lesson topic: {topic}
+- Student profile: {user_profile}""")
+
+# The opening turn is cached, so it only gets details that stay the same from one login to the next
+opening_student_prompt_template = PromptTemplate.from_template("""Student details for this lesson:
+- Name: {name}
+- Lesson topic: {topic}""")
+
+def is_opening(state: LessonState) -> bool:
+    """Whether the lesson is still in its opening turn, before the student's first reply."""
+    return not any(isinstance(message, HumanMessage) for message in state.get("messages", []))
+
+def build_prompt(state: LessonState) -> List[BaseMessage]:
+    """Build the messages sent to the model for the next lesson turn."""
     name = state.get("user_profile").get("name")
-    START_SCENE = f"""Welcome back {name}! How are you today? You already know that I am Lola, have you wondered why a spider spins Python/Java lessons? \
-What makes me different from other spiders? Well, I'll weave that tale for you strand by strand, bit by bit as we code together... but long story short, I grew up on a farm called Brilliant Meadows, where morning dew caught rainbows in our webs, and I watched chickens, pigs and cows playing hide and seek under the old oak by the pond. \
-Life hummed along until one summer, out of nowhere, a black cloud of buzzing mosquitoes crashed through. These weren't ordinary mosquitos - their DNA carried corrupted code. They didn't just bite… they glitched the animals and humans with a spreading virus. \
-Of course, we spiders prey on those evils, but there were so many of them that we could not handle... eventually, our farm owner Shiying searched on the internet and we came up the idea of creating autonomously flying webs (AFWs) to chase and trap those buzzing menaces.\
-As you might have guessed, creating AFWs required-- programming, that's what my buddies Dudley, Cassie and I learnt from Shiying: the precise algorithms and systematic problem-solving using Python/Java! Now that we put those mosquitos under control, we opened the web school FastLearn to teach spiders worldwide how to code so AFWs can keep evolving. \
-Wait... do you hear that? Sounds like an argument brewing in Cassie's classroom. Would you like to come with me to check it out?"""
-    system = SystemMessage(content=system_prompt_template.format(
-        name=name,
-        topic=state["topic"],
-        START_SCENE=START_SCENE,
-        user_profile=state["user_profile"]
-    ))
+    if is_opening(state):
+        student = SystemMessage(content=opening_student_prompt_template.format(name=name, topic=state["topic"]))
+    else:
+        student = SystemMessage(content=student_prompt_template.format(
+            name=name,
+            topic=state["topic"],
+            user_profile=state["user_profile"]
+        ))
     if not state.get("messages", []):
         initial = HumanMessage(content=f"""
-        Deliver {START_SCENE} with immersive narration, illustrations, sound effects, and game-style choices to engage {name} in conversation.
+        Deliver the opening scene with immersive narration, illustrations, sound effects, and game-style choices to engage {name} in conversation.
         """)
-        response = llm.invoke([system, initial])
-    else:
-        messages = [system] + state["messages"]
-        response = llm.invoke(messages)
+        return [SYSTEM_PROMPT, student, initial]
+    if COMPACTION:
+        return [SYSTEM_PROMPT, student] + compaction.compacted_history(state, "Cassie")
+    return [SYSTEM_PROMPT, student] + state["messages"]
+
+def lesson_model(state: LessonState):
+    """The opening model until the student first replies, the lesson model after that."""
+    return opening_llm if is_opening(state) else llm
+
+def chat_node(state: LessonState) -> LessonState:
+    """Handle regular chat interactions."""
+    if COMPACTION:
+        compaction.compact_state(state, **COMPACTION)
+    response = lesson_model(state).invoke(build_prompt(state))
+    state["messages"].append(response)
+    return state
+
+async def achat_node(state: LessonState) -> LessonState:
+    """Async variant of chat_node."""
+    if COMPACTION:
+        await compaction.acompact_state(state, **COMPACTION)
+    response = await lesson_model(state).ainvoke(build_prompt(state))
     state["messages"].append(response)
     return state
 
@@ -129,6 +173,10 @@ def tool_executor(state: LessonState) -> LessonState:
     
     return state
 
+async def atool_executor(state: LessonState) -> LessonState:
+    """Async variant of tool_executor. The lesson tools are blocking, so they run off the event loop."""
+    return await asyncio.to_thread(tool_executor, state)
+
 def should_use_tools(state: LessonState):
     """Check if the last message has tool calls."""
     last_msg = state["messages"][-1]
@@ -143,8 +191,8 @@ def build_graph():
     workflow = StateGraph(LessonState)
     
     # Add nodes
-    workflow.add_node("chat", chat_node)
-    workflow.add_node("tools", tool_executor)
+    workflow.add_node("chat", RunnableLambda(chat_node, afunc=achat_node))
+    workflow.add_node("tools", RunnableLambda(tool_executor, afunc=atool_executor))
     
     # Set up the edges
     workflow.add_edge(START, "chat")
@@ -0,0 +1,76 @@
+import logging
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from typing import List
+
+from compaction import summary_model, transcript
+from context_budget import truncate_to_tokens
+from llm_gateway import NEAR_INTERACTIVE, llm_priority
+
+logger = logging.getLogger(__name__)
+
+# Turns stored verbatim before older ones are folded, and how many stay verbatim after a fold
+MAX_TURNS = 8
+KEEP_TURNS = 4
+SUMMARY_TOKEN_LIMIT = 300
+
+SUMMARY_PROMPT = """You keep a running summary of a visitor's chat about AP Computer Science A so the assistant can continue without the full transcript.
+Update the current summary with the new messages. Keep each question the visitor asked and the gist of the answer they were given, anything they said about themselves or their goals, and questions that are still open or that they said they would come back to.
+Reply with the updated summary only.
+
+Current summary:
+{summary}
+
+New messages:
+{transcript}"""
+
+class BoundedChatHistory:
+    """Chat history for one visitor, bounded in size however long they chat.
+
+    The greeting and the last few turns are kept verbatim. Once more than max_turns turns are
+    stored, all but the last keep_turns are folded into a running summary of capped length.
+    """
+
+    def __init__(self, greeting: str, max_turns: int = MAX_TURNS, keep_turns: int = KEEP_TURNS):
+        self.greeting = AIMessage(content=greeting)
+        self.max_turns = max_turns
+        self.keep_turns = keep_turns
+        self.messages: List[BaseMessage] = []
+        self.summary = ""
+        self.folded_turns = 0
+
+    def add(self, message: BaseMessage):
+        self.messages.append(message)
+
+    def displayed(self) -> List[BaseMessage]:
+        """Messages shown on the page: the greeting and the turns stored verbatim."""
+        return [self.greeting] + self.messages
+
+    def for_generation(self) -> List[BaseMessage]:
+        """Messages sent to the agent: the greeting, the summary of folded turns, then recent turns."""
+        summary = [SystemMessage(content=f"Summary of the earlier part of this conversation:\n{self.summary}")] if self.summary else []
+        return [self.greeting] + summary + self.messages
+
+    def turn_starts(self) -> List[int]:
+        return [i for i, message in enumerate(self.messages) if isinstance(message, HumanMessage)]
+
+    def compact(self):
+        """Fold the oldest turns into the summary once more than max_turns are stored."""
+        starts = self.turn_starts()
+        if len(starts) <= self.max_turns:
+            return
+        boundary = starts[-self.keep_turns]
+        prompt = SUMMARY_PROMPT.format(summary=self.summary or "(none yet)", transcript=transcript(self.messages[:boundary], human="Visitor"))
+        with llm_priority(NEAR_INTERACTIVE):
+            self.summary = truncate_to_tokens(summary_model().invoke(prompt).content, SUMMARY_TOKEN_LIMIT)
+        self.folded_turns += len(starts) - self.keep_turns
+        self.messages = self.messages[boundary:]
+        logger.info("CSA chat history: %d turns folded so far, ~%d bytes held", self.folded_turns, self.memory_bytes())
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by this session's history: the encoded size of every stored text."""
+        return sum(len(message.content.encode()) for message in self.displayed()) + len(self.summary.encode())
+
+    def usage(self) -> dict:
+        return {"stored_turns": len(self.turn_starts()), "folded_turns": self.folded_turns,
+                "summary_chars": len(self.summary), "memory_bytes": self.memory_bytes()}
@@ -0,0 +1,125 @@
+import logging
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langgraph.constants import TAG_NOSTREAM
+from typing import List
+
+from llm_clients import task_model
+from llm_gateway import NEAR_INTERACTIVE, llm_priority
+
+logger = logging.getLogger(__name__)
+
+# Model that folds older turns into the running summary
+summarizer = task_model("compaction")
+
+def summary_model():
+    """The summarizer, kept out of the tutor's streamed reply since it runs inside the chat node."""
+    return summarizer.with_config(tags=[TAG_NOSTREAM])
+
+SUMMARY_PROMPT = """You keep a running summary of a tutoring conversation so the tutor can continue it without the full transcript.
+Update the current summary with the new messages. Keep the concepts taught so far, the student's answers and mistakes, choices the student made in the story, and anything the tutor promised to come back to.
+Reply with the updated summary only.
+
+Current summary:
+{summary}
+
+New messages:
+{transcript}"""
+
+def transcript(messages: List[BaseMessage], human: str = "Student") -> str:
+    """Render messages as a plain-text dialogue for the summarizer, labelling the person's turns as human."""
+    lines = []
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            lines.append(f"{human}: {message.content}")
+        elif isinstance(message, AIMessage):
+            if message.content:
+                lines.append(f"AI: {message.content}")
+            for tool_call in message.tool_calls:
+                lines.append(f"Tool call: {tool_call['name']}")
+        elif isinstance(message, ToolMessage):
+            lines.append(f"Tool result ({message.name}): {message.content}")
+    return "\n".join(lines)
+
+def pinned_count(messages: List[BaseMessage]) -> int:
+    """Number of leading system messages, which are never folded."""
+    count = 0
+    while count < len(messages) and isinstance(messages[count], SystemMessage):
+        count += 1
+    return count
+
+def has_open_tool_calls(messages: List[BaseMessage]) -> bool:
+    """Whether any tool call in messages is still waiting for its ToolMessage."""
+    pending = set()
+    for message in messages:
+        if isinstance(message, AIMessage):
+            pending.update(tool_call["id"] for tool_call in message.tool_calls)
+        elif isinstance(message, ToolMessage):
+            pending.discard(message.tool_call_id)
+    return bool(pending)
+
+def fold_boundary(messages: List[BaseMessage], summarized_count: int, keep_turns: int, fold_turns: int) -> int:
+    """Index up to which messages should be folded into the summary.
+
+    A turn starts at each student message. The last keep_turns turns stay verbatim, and older
+    turns are only folded once at least fold_turns of them have piled up, so the summary is not
+    regenerated on every turn. The boundary never separates a tool call from its result.
+    """
+    start = max(summarized_count, pinned_count(messages))
+    turn_starts = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage) and i > start]
+    # The oldest verbatim turn begins at turn_starts[-keep_turns]; anything before it may be folded
+    candidates = turn_starts[:max(len(turn_starts) - keep_turns + 1, 0)]
+    for boundary in reversed(candidates):
+        if has_open_tool_calls(messages[:boundary]):
+            continue
+        folded_turns = sum(1 for message in messages[start:boundary] if isinstance(message, HumanMessage))
+        if folded_turns < fold_turns:
+            break
+        return boundary
+    return start
+
+def folded_until(state: dict) -> int:
+    """Index of the first message that has not been folded into the summary."""
+    return max(state.get("summarized_count") or 0, pinned_count(state["messages"]))
+
+def summary_update_prompt(state: dict, boundary: int) -> str:
+    start = folded_until(state)
+    return SUMMARY_PROMPT.format(
+        summary=state.get("context_summary") or "(none yet)",
+        transcript=transcript(state["messages"][start:boundary])
+    )
+
+def compact_state(state: dict, keep_turns: int = 6, fold_turns: int = 4):
+    """Fold turns that have left the verbatim window into state["context_summary"]."""
+    boundary = fold_boundary(state["messages"], state.get("summarized_count") or 0, keep_turns, fold_turns)
+    if boundary > folded_until(state):
+        with llm_priority(NEAR_INTERACTIVE):
+            state["context_summary"] = summary_model().invoke(summary_update_prompt(state, boundary)).content
+        state["summarized_count"] = boundary
+
+async def acompact_state(state: dict, keep_turns: int = 6, fold_turns: int = 4):
+    """Async variant of compact_state."""
+    boundary = fold_boundary(state["messages"], state.get("summarized_count") or 0, keep_turns, fold_turns)
+    if boundary > folded_until(state):
+        with llm_priority(NEAR_INTERACTIVE):
+            state["context_summary"] = (await summary_model().ainvoke(summary_update_prompt(state, boundary))).content
+        state["summarized_count"] = boundary
+
+def compacted_history(state: dict, graph_name: str) -> List[BaseMessage]:
+    """The conversation as sent to the model: pinned system messages, the running summary, then recent turns.
+
+    Logs how many prompt tokens the compaction saved on this turn.
+    """
+    messages = state["messages"]
+    summary = state.get("context_summary")
+    if not summary:
+        return messages
+    pinned = pinned_count(messages)
+    start = folded_until(state)
+    history = messages[:pinned] + [
+        SystemMessage(content=f"Summary of the earlier part of this conversation:\n{summary}")
+    ] + messages[start:]
+    tokens_saved = count_tokens_approximately(messages) - count_tokens_approximately(history)
+    logger.info("%s compaction: %d messages folded, ~%d prompt tokens saved", graph_name, start - pinned, tokens_saved)
+    return history
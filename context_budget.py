@@ -0,0 +1,87 @@
+import math
+
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
+from typing import List, Tuple
+
+# Same rate count_tokens_approximately assumes for messages
+CHARS_PER_TOKEN = 4.0
+# Overlaps shorter than this between two chunks are left alone, they are likely coincidence
+MIN_OVERLAP_CHARS = 40
+# A chunk that would be cut shorter than this is dropped instead
+MIN_CHUNK_TOKENS = 40
+TRUNCATION_MARK = " ..."
+
+def approximate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def overlap_length(first: str, second: str) -> int:
+    """Length of the longest suffix of first that is also a prefix of second, if long enough to count."""
+    for length in range(min(len(first), len(second)), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+def dedupe_chunks(chunks: List[str]) -> List[str]:
+    """Drop repeated chunks and the text a chunk shares with a more relevant one.
+
+    Ingestion splits documents with overlapping windows, so neighbouring chunks often repeat
+    each other's edges; only the first (most relevant) copy of that text is kept.
+    """
+    kept = []
+    for chunk in chunks:
+        text = chunk.strip()
+        for other in kept:
+            if text in other:
+                text = ""
+                break
+            text = text[overlap_length(other, text):]
+            cut = overlap_length(text, other)
+            text = text[:len(text) - cut].strip()
+        if text:
+            kept.append(text)
+    return kept
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Cut text to at most tokens tokens, at a word boundary, or to nothing if no room is left."""
+    limit = int(tokens * CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    if limit <= len(TRUNCATION_MARK):
+        return ""
+    return text[:limit - len(TRUNCATION_MARK)].rsplit(" ", 1)[0] + TRUNCATION_MARK
+
+def budget_chunks(chunks: List[str], budget: int) -> Tuple[List[str], int]:
+    """The most relevant chunks that fit the token budget, the last one truncated if needed, and the tokens used."""
+    selected, used = [], 0
+    for chunk in dedupe_chunks(chunks):
+        tokens = approximate_tokens(chunk)
+        if used + tokens > budget:
+            remaining = budget - used
+            if remaining >= MIN_CHUNK_TOKENS:
+                chunk = truncate_to_tokens(chunk, remaining)
+                selected.append(chunk)
+                used += approximate_tokens(chunk)
+            break
+        selected.append(chunk)
+        used += tokens
+    return selected, used
+
+def budget_history(messages: List[BaseMessage], budget: int) -> List[BaseMessage]:
+    """The most recent turns that fit the token budget, always including the latest message.
+
+    System messages, such as a summary of earlier turns, are always kept and count against the budget.
+    An assistant greeting opening the conversation is kept too when it fits alongside the turns.
+    """
+    pinned = [message for message in messages if isinstance(message, SystemMessage)]
+    turns = [message for message in messages if not isinstance(message, SystemMessage)]
+    greeting = turns[:1] if turns and isinstance(turns[0], AIMessage) else []
+    remaining = max(budget - count_tokens_approximately(pinned), 0)
+    history = trim_messages(
+        turns[len(greeting):], max_tokens=remaining,
+        token_counter=count_tokens_approximately, strategy="last", start_on="human"
+    ) or turns[-1:]
+    if greeting and greeting[0] not in history and count_tokens_approximately(greeting + history) <= remaining:
+        history = greeting + history
+    kept = {id(message) for message in pinned + history}
+    return [message for message in messages if id(message) in kept]
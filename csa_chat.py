@@ -1,14 +1,18 @@
-import base64
+import base64, uuid
 import streamlit as st
 import utils
 
+from chat_history import BoundedChatHistory
 from csa_rag_agent import invoke_agent
+from llm_gateway import llm_owner
 from langchain_core.messages import HumanMessage, AIMessage
 
+GREETING = "Hi! I'm Lola, your AP CSA tutor. I can help you with any questions about the AP Computer Science A curriculum. What would you like to learn about?"
+
 def clear_chat_history():
     """Clear the chat history from session state."""
-    if "csa_messages" in st.session_state:
-        del st.session_state.csa_messages
+    if "csa_history" in st.session_state:
+        del st.session_state.csa_history
 
 def run_csa_chat():
     """Run the CSA chat interface."""
@@ -49,16 +53,19 @@ def run_csa_chat():
     """, unsafe_allow_html=True)
     
     # Initialize chat history with welcome message
-    if "csa_messages" not in st.session_state:
-        st.session_state.csa_messages = [
-            AIMessage(content="Hi! I'm Lola, your AP CSA tutor. I can help you with any questions about the AP Computer Science A curriculum. What would you like to learn about?")
-        ]
+    if "csa_history" not in st.session_state:
+        st.session_state.csa_history = BoundedChatHistory(GREETING)
+        # Identifies this visitor to the model request scheduler, so heavy users cannot crowd out others
+        st.session_state.csa_visitor = f"visitor:{uuid.uuid4().hex}"
+    history = st.session_state.csa_history
     
     # Get Lola's avatar
     lola_avatar = utils.get_avatar_base64("assets/lola.png")
     
-    # Display chat messages
-    for message in st.session_state.csa_messages:
+    # Display chat messages; turns folded into the summary are no longer kept
+    if history.folded_turns:
+        st.caption(f"{history.folded_turns} earlier questions are summarized to keep this chat quick.")
+    for message in history.displayed():
         if isinstance(message, AIMessage):
             with st.chat_message("assistant", avatar=f"data:image/png;base64,{lola_avatar}"):
                 st.write(message.content)
@@ -69,12 +76,12 @@ def run_csa_chat():
     # Chat input
     if prompt := st.chat_input("Ask me anything about AP CSA!"):
         # Add user message to chat history
-        st.session_state.csa_messages.append(HumanMessage(content=prompt))
+        history.add(HumanMessage(content=prompt))
         
-        # Get AI response and add to chat history
-        with st.spinner("Thinking..."):
-            response = invoke_agent(st.session_state.csa_messages)
-            st.session_state.csa_messages = response  # Replace entire message history with updated one
+        # Get AI response and add only the reply to chat history, folding old turns if it grew too long
+        with st.spinner("Thinking..."), llm_owner(st.session_state.csa_visitor):
+            history.add(invoke_agent(history.for_generation())[-1])
+            history.compact()
         
         # Rerun to update the display
         st.rerun() 
\ No newline at end of file
@@ -1,30 +1,36 @@
-import os
+import asyncio, logging, os, threading, time
 from dotenv import load_dotenv
 import utils
 
-from langchain_core.messages import BaseMessage
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableLambda
 from langchain_mongodb import MongoDBAtlasVectorSearch
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langgraph.graph import StateGraph, START, END
-from typing import Annotated, Sequence, TypedDict
+from typing import Annotated, Optional, Sequence, TypedDict
+
+from bm25_index import BM25Index, reciprocal_rank_fusion
+from context_budget import budget_chunks, budget_history
+from llm_clients import embeddings_model, task_model
+from local_vector_store import DEFAULT_INDEX_DIR, LocalVectorStore
+from semantic_cache import SemanticCache, normalize_question
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Define the state type
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], "The messages in the conversation"]
     context: Annotated[list[str], "The context retrieved from the knowledge base"]
+    query_embedding: Annotated[Optional[list[float]], "Embedding of the question, when it was already computed"]
 
 # Initialize the language model
-llm = ChatOpenAI(
-    temperature=0.7, 
-    model_name="gpt-4.1-mini", 
-    api_key=os.getenv("OPENAI_API_KEY")
-)
+llm = task_model("csa_chat")
 
 # Initialize embeddings
-embeddings = OpenAIEmbeddings()
+embeddings = embeddings_model()
 
 # Initialize vector store at module level
 def initialize_vector_store():
@@ -44,28 +50,161 @@ def initialize_vector_store():
     )
     return vector_store
 
+# "atlas" searches csa_documents in MongoDB Atlas, "local" a local index exported from it
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "atlas")
+LOCAL_VECTOR_INDEX_DIR = os.getenv("LOCAL_VECTOR_INDEX_DIR", DEFAULT_INDEX_DIR)
+# Atlas searches slower than this are answered from the local index instead, when there is one
+ATLAS_TIMEOUT_SECONDS = float(os.getenv("ATLAS_TIMEOUT_SECONDS", 2))
+
+def initialize_local_vector_store():
+    """Open the local vector index, or None if it has not been built."""
+    store = LocalVectorStore(embeddings, LOCAL_VECTOR_INDEX_DIR)
+    return store if len(store) else None
+
 try:
-    vectorstore = initialize_vector_store()
+    vectorstore = initialize_local_vector_store() if VECTOR_BACKEND == "local" else initialize_vector_store()
 except Exception as e:
     print(f"Warning: Could not initialize vector store: {e}")
     vectorstore = None
 
+# The local index stands in when Atlas is unavailable, failing or slow
+fallback_store = initialize_local_vector_store() if VECTOR_BACKEND != "local" else None
+if vectorstore is None:
+    vectorstore, fallback_store = fallback_store, None
+
+# Answers to opening questions on the public chat, reused for near-duplicate questions
+answer_cache = SemanticCache(
+    threshold=float(os.getenv("CSA_CACHE_THRESHOLD", 0.95)),
+    ttl_seconds=int(os.getenv("CSA_CACHE_TTL_SECONDS", 24 * 60 * 60)),
+    max_entries=5000
+)
+
+# Chunks passed to the model, and candidates each retriever contributes to the fusion
+RETRIEVAL_K = 3
+FUSION_CANDIDATES = 10
+# Approximate prompt tokens allowed for retrieved chunks and for chat history
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CSA_CONTEXT_TOKEN_BUDGET", 1200))
+HISTORY_TOKEN_BUDGET = int(os.getenv("CSA_HISTORY_TOKEN_BUDGET", 1500))
+
+# BM25 index over the same chunks as the vector store, built on first use
+lexical_index_lock = threading.Lock()
+lexical_index_cache = None
+
+def corpus_texts() -> list[str]:
+    """Text of every chunk in the knowledge base, read from Atlas or from the local index."""
+    store = vectorstore
+    if isinstance(store, MongoDBAtlasVectorSearch):
+        try:
+            return [document["text"] for document in store.collection.find({}, {"text": 1, "_id": 0}) if document.get("text")]
+        except Exception as e:
+            if fallback_store is None:
+                raise
+            logger.warning("Could not read chunks from Atlas, using the local index: %s", e)
+            store = fallback_store
+    return [document["text"] for document in store.documents] if isinstance(store, LocalVectorStore) else []
+
+def lexical_index() -> Optional[BM25Index]:
+    """The BM25 index over the knowledge base, or None if there are no chunks to index."""
+    global lexical_index_cache
+    with lexical_index_lock:
+        if lexical_index_cache is None:
+            try:
+                start = time.perf_counter()
+                texts = corpus_texts()
+                if texts:
+                    lexical_index_cache = BM25Index(texts)
+                    logger.info("Lexical index built over %d chunks in %.2fs", len(texts), time.perf_counter() - start)
+            except Exception as e:
+                logger.warning("Could not build the lexical index, using vector search alone: %s", e)
+        return lexical_index_cache
+
+def invalidate_lexical_index():
+    global lexical_index_cache
+    with lexical_index_lock:
+        lexical_index_cache = None
+
+def fuse_results(query: str, docs, k: int = RETRIEVAL_K) -> list[str]:
+    """Combine vector search results with BM25 matches for the query by reciprocal-rank fusion."""
+    dense = list(dict.fromkeys(doc.page_content for doc in docs))
+    index = lexical_index()
+    if index is None:
+        return dense[:k]
+    start = time.perf_counter()
+    lexical = [index.texts[i] for i, _ in index.search(query, FUSION_CANDIDATES)]
+    logger.debug("BM25 matched %d chunks in %.0fus", len(lexical), (time.perf_counter() - start) * 1e6)
+    return reciprocal_rank_fusion([dense, lexical])[:k]
+
+def watch_documents(collection):
+    """Drop cached answers and the lexical index whenever the knowledge base changes, since they may be out of date.
+
+    Relies on a MongoDB change stream; without one, cached answers expire after their TTL.
+    """
+    try:
+        with collection.watch() as stream:
+            for change in stream:
+                answer_cache.invalidate()
+                invalidate_lexical_index()
+                logger.info("Knowledge base changed (%s), answer cache and lexical index cleared", change.get("operationType"))
+    except Exception as e:
+        logger.warning("Knowledge base change stream unavailable, relying on TTL expiry: %s", e)
+
+if isinstance(vectorstore, MongoDBAtlasVectorSearch):
+    threading.Thread(target=watch_documents, args=(vectorstore.collection,), name="csa-documents-watcher", daemon=True).start()
+
+def is_opening_question(messages: list[BaseMessage]) -> bool:
+    """Whether the conversation so far is just the greeting and one question, so the answer does not depend on context."""
+    return sum(isinstance(message, HumanMessage) for message in messages) == 1 and isinstance(messages[-1], HumanMessage)
+
+def search_by_vector(query_embedding: list[float], k: int = 3):
+    """Search the knowledge base, answering from the local index if the primary store fails."""
+    try:
+        return vectorstore.similarity_search_by_vector(query_embedding, k=k)
+    except Exception as e:
+        if fallback_store is None:
+            raise
+        logger.warning("Vector search failed, using the local index: %s", e)
+        return fallback_store.similarity_search_by_vector(query_embedding, k=k)
+
+async def asearch_by_vector(query_embedding: list[float], k: int = 3):
+    """Async variant of search_by_vector that also falls back when the primary store is slow."""
+    try:
+        search = vectorstore.asimilarity_search_by_vector(query_embedding, k=k)
+        if fallback_store is None:
+            return await search
+        return await asyncio.wait_for(search, ATLAS_TIMEOUT_SECONDS)
+    except Exception as e:
+        if fallback_store is None:
+            raise
+        logger.warning("Vector search failed or timed out, using the local index: %r", e)
+        return await fallback_store.asimilarity_search_by_vector(query_embedding, k=k)
+
 def retrieve(state: AgentState) -> AgentState:
     """Retrieve relevant context from the knowledge base."""
     if not vectorstore:
         raise Exception("Vector store not initialized")
         
-    # Get the last human message
-    last_message = state["messages"][-1].content
+    # Embed the last human message, unless that was already done
+    query_embedding = state.get("query_embedding") or embeddings.embed_query(state["messages"][-1].content)
     
-    # Retrieve relevant documents
-    docs = vectorstore.similarity_search(last_message, k=3)
-    context = [doc.page_content for doc in docs]
+    # Retrieve candidates by meaning and by exact terms, then fuse the two rankings
+    docs = search_by_vector(query_embedding, k=FUSION_CANDIDATES)
+    context = fuse_results(state["messages"][-1].content, docs)
     
-    return {"messages": state["messages"], "context": context}
+    return {"messages": state["messages"], "context": context, "query_embedding": query_embedding}
 
-def generate_response(state: AgentState) -> AgentState:
-    """Generate a response using the retrieved context."""
+async def aretrieve(state: AgentState) -> AgentState:
+    """Async variant of retrieve."""
+    if not vectorstore:
+        raise Exception("Vector store not initialized")
+        
+    query_embedding = state.get("query_embedding") or await embeddings.aembed_query(state["messages"][-1].content)
+    docs = await asearch_by_vector(query_embedding, k=FUSION_CANDIDATES)
+    context = fuse_results(state["messages"][-1].content, docs)
+    
+    return {"messages": state["messages"], "context": context, "query_embedding": query_embedding}
+
+def build_prompt(state: AgentState) -> list[BaseMessage]:
+    """Build the messages sent to the model from the retrieved context and chat history."""
     # Create the prompt template
     prompt = ChatPromptTemplate.from_messages([
         ("system", """You are Lola, an expert AP Computer Science A tutor. 
@@ -78,34 +217,78 @@ def generate_response(state: AgentState) -> AgentState:
         MessagesPlaceholder(variable_name="messages"),
     ])
     
+    # Keep the prompt within budget: the most relevant chunks first, then the most recent turns
+    chunks, context_tokens = budget_chunks(state["context"], CONTEXT_TOKEN_BUDGET)
+    history = budget_history(state["messages"], HISTORY_TOKEN_BUDGET)
+    logger.info(
+        "CSA prompt budget: context %d/%d tokens (%d of %d chunks), history %d/%d tokens (%d of %d messages)",
+        context_tokens, CONTEXT_TOKEN_BUDGET, len(chunks), len(state["context"]),
+        count_tokens_approximately(history), HISTORY_TOKEN_BUDGET, len(history), len(state["messages"])
+    )
+
     # Format the prompt
-    formatted_prompt = prompt.format_messages(
-        context="\n\n".join(state["context"]),
-        messages=state["messages"]
+    return prompt.format_messages(
+        context="\n\n".join(chunks),
+        messages=history
     )
-    
-    # Generate response
-    response = llm.invoke(formatted_prompt)
+
+def generate_response(state: AgentState) -> AgentState:
+    """Generate a response using the retrieved context."""
+    response = llm.invoke(build_prompt(state))
     
     # Add the response to messages
     state["messages"].append(response)
     
     return state
 
+async def agenerate_response(state: AgentState) -> AgentState:
+    """Async variant of generate_response."""
+    response = await llm.ainvoke(build_prompt(state))
+    state["messages"].append(response)
+    return state
+
 def invoke_agent(messages: list[BaseMessage]) -> list[BaseMessage]:
     """Invoke the agent with a list of messages."""
+    query_embedding = None
+    if is_opening_question(messages):
+        question = normalize_question(messages[-1].content)
+        query_embedding = embeddings.embed_query(question)
+        answer = answer_cache.lookup(question, query_embedding)
+        if answer is not None:
+            return list(messages) + [AIMessage(content=answer)]
     result = app.invoke({
         "messages": messages,
-        "context": []
+        "context": [],
+        "query_embedding": query_embedding
+    })
+    if query_embedding is not None:
+        answer_cache.store(question, query_embedding, result["messages"][-1].content)
+    return result["messages"]
+
+async def ainvoke_agent(messages: list[BaseMessage]) -> list[BaseMessage]:
+    """Async variant of invoke_agent."""
+    query_embedding = None
+    if is_opening_question(messages):
+        question = normalize_question(messages[-1].content)
+        query_embedding = await embeddings.aembed_query(question)
+        answer = answer_cache.lookup(question, query_embedding)
+        if answer is not None:
+            return list(messages) + [AIMessage(content=answer)]
+    result = await app.ainvoke({
+        "messages": messages,
+        "context": [],
+        "query_embedding": query_embedding
     })
+    if query_embedding is not None:
+        answer_cache.store(question, query_embedding, result["messages"][-1].content)
     return result["messages"]
 
 # Create the graph
 workflow = StateGraph(AgentState)
 
 # Add nodes
-workflow.add_node("retrieve", retrieve)
-workflow.add_node("generate", generate_response)
+workflow.add_node("retrieve", RunnableLambda(retrieve, afunc=aretrieve))
+workflow.add_node("generate", RunnableLambda(generate_response, afunc=agenerate_response))
 
 # Add edges
 workflow.add_edge(START, "retrieve")  # Add entry point
@@ -1,6 +1,6 @@
 import streamlit as st
 import utils
-from onboard_agent import sally_graph
+from onboard_agent import PROFILE_VARIABLES, missing_profile_variables, sally_graph
 from datetime import datetime
 from utils import create_new_user, get_avatar_base64
 import re
@@ -133,6 +133,13 @@ def display_question_options(msg_idx: int, question_text: str, options: list[str
                     st.markdown(f"<div style='padding: 0.5rem; margin: 0.25rem 0;'>{option}</div>", 
                               unsafe_allow_html=True)
 
+def display_profile_progress(missing_variables: list):
+    """Show how much of the profile has been saved so far while onboarding is in progress."""
+    saved = len(PROFILE_VARIABLES) - len(missing_variables)
+    st.progress(saved / len(PROFILE_VARIABLES), text=f"Profile: {saved} of {len(PROFILE_VARIABLES)} answers saved")
+    if saved:
+        st.caption("Still to cover: " + ", ".join(missing_variables))
+
 def display_account_creation(student_profile: dict, user: dict):
     """Display account creation options after profile completion."""
     st.success("✅ You're all set! Here's what I learned about you:")
@@ -299,6 +306,8 @@ def display_customer_service():
                     st.session_state.onboard_state = onboard_state
                     st.rerun()
             
-            # Display account creation if profile is complete
+            # Display account creation if profile is complete, otherwise how far along it is
             if onboard_state.get("student_profile"):
-                display_account_creation(onboard_state["student_profile"], user)
\ No newline at end of file
+                display_account_creation(onboard_state["student_profile"], user)
+            else:
+                display_profile_progress(missing_profile_variables(onboard_state))
\ No newline at end of file
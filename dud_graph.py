@@ -1,16 +1,25 @@
+import asyncio
+
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_openai import ChatOpenAI
+from langchain_core.runnables import RunnableLambda
+from langgraph.constants import TAG_NOSTREAM
 from langgraph.graph import END, MessagesState, StateGraph, START
-from typing import Annotated
+from typing import Annotated, List, Optional, Tuple
+
+from llm_clients import task_model
+from llm_gateway import BACKGROUND, llm_priority
+from question_bank import draw_questions, format_answer, format_question, parse_choice
 
-from utils import OPENAI_API_KEY
+# Initialize LLMs: quiz turns keep the larger model, answer feedback and summaries use small fast ones
+llm = task_model("quiz")
+# Without a question bank, the quiz's first question depends only on the topic, so it is cached
+opening_llm = task_model("quiz_opening")
+feedback_llm = task_model("quiz_feedback")
+summary_llm = task_model("quiz_summary")
 
-# Initialize LLM
-llm = ChatOpenAI(
-    temperature=0.7, 
-    model_name="gpt-4.1-mini", 
-    api_key = OPENAI_API_KEY
-)
+def feedback_model():
+    """The model that explains answers, kept out of the streamed reply since the verdict and next question are added to its text."""
+    return feedback_llm.with_config(tags=[TAG_NOSTREAM])
 
 # ------------------ Define State Structure ------------------
 
@@ -18,41 +27,166 @@ class DudState(MessagesState):
     """State for Dud graph, extending MessagesState for message history management."""
     topic: Annotated[str, "The lesson topic"]
     summary: str
+    questions: Annotated[List[dict], "Questions drawn from the bank; empty when the model runs the quiz"]
+    question_index: int
+    results: Annotated[List[dict], "Concept and outcome of each answered question"]
 
-def chat_node(state: DudState):
-    if not state.get("messages", []):
-        prompt = f"""
+# The quiz ends when the student gets this many questions right, or this many wrong
+CORRECTS_TO_FINISH = 15
+WRONGS_TO_FINISH = 3
+# Enough questions for the longest possible quiz
+QUESTIONS_PER_QUIZ = CORRECTS_TO_FINISH + WRONGS_TO_FINISH - 1
+
+# Instructions shared by every quiz, kept byte-stable so the provider can cache them as a prompt prefix
+QUIZ_INSTRUCTIONS = """
         You are a helpful teaching assistant. You are speaking to an 8th or 9th grade student in AP Computer Science.
-        Give the student multiple choice questions, one at a time, on the topic of {state.get('topic', 'Computer Fundamentals')}.
+        Give the student multiple choice questions, one at a time, on the quiz topic given below.
         IMPORTANT: This is an interactive session. Wait for the student's response before proceeding.
         If the student answers the question, give feedback regardless of whether their answer is correct or incorrect.
         If the student asks for clarification regarding quiz question, answer it. Otherwise redirect them back to the quiz.
         The quiz ends when the student gets 15 questions correct or 3 questions wrong, whichever occurs first. Also let the student know they can end the quiz by typing 'quit' or 'exit'.
         When you end the quiz, generate a summary of the student's strengths and weaknesses with the header QUIZ SUMMARY in capital letters.
         """
-        state["messages"].append(SystemMessage(content=prompt))
+
+# Instructions for the model's only jobs in a question-bank quiz, explaining wrong answers and clarifying questions
+TUTOR_INSTRUCTIONS = """
+        You are a helpful teaching assistant. You are speaking to an 8th or 9th grade student in AP Computer Science who is taking a multiple choice quiz.
+        You will be given the current question, its answer key and what the student said.
+        If the student answered incorrectly, explain in two or three sentences why the correct answer is right and where their choice goes wrong. Do not ask another question.
+        If the student asked for clarification, answer it without giving away the correct answer, then ask them to pick an option.
+        """
+
+def start_quiz(state: DudState, questions: List[dict]):
+    """Open a fresh quiz, from the question bank when the topic has one."""
+    topic = state.get('topic', 'Computer Fundamentals')
+    state["questions"] = questions
+    state["question_index"] = 0
+    state["results"] = []
+    if questions:
+        state["messages"].append(AIMessage(content=f"Let's see what you know about {topic}! "
+            f"The quiz ends after {CORRECTS_TO_FINISH} correct answers or {WRONGS_TO_FINISH} wrong ones, "
+            f"and you can end it early by typing 'quit' or 'exit'. Reply with the letter of your answer.\n\n"
+            + format_question(questions[0], 1)))
+    else:
+        # No bank for this topic, so the model runs the whole quiz
+        state["messages"].append(SystemMessage(content=QUIZ_INSTRUCTIONS))
+        state["messages"].append(SystemMessage(content=f"Quiz topic: {topic}"))
+
+def quiz_finished(state: DudState) -> bool:
+    results = state["results"]
+    correct = sum(result["correct"] for result in results)
+    return (correct >= CORRECTS_TO_FINISH or len(results) - correct >= WRONGS_TO_FINISH
+            or state["question_index"] >= len(state["questions"]))
+
+def quiz_summary(state: DudState) -> str:
+    """Summarize a question-bank quiz from its graded answers."""
+    results = state["results"]
+    correct = sum(result["correct"] for result in results)
+    strengths = sorted({result["concept"] for result in results if result["correct"] and result["concept"]})
+    weaknesses = sorted({result["concept"] for result in results if not result["correct"] and result["concept"]})
+    summary = f"\nThe student answered {correct} of {len(results)} questions correctly ({correct}/{len(results)})."
+    if strengths:
+        summary += f"\nStrengths: {', '.join(strengths)}."
+    if weaknesses:
+        summary += f"\nNeeds more practice: {', '.join(weaknesses)}."
+    return summary
+
+def grade_answer(state: DudState) -> Tuple[str, Optional[list]]:
+    """Grade the student's latest message against the current bank question.
+
+    Returns the outcome ("correct", "wrong", "clarify" or "exit") and the prompt for the model
+    when the reply needs one: an explanation of a wrong answer or an answer to a clarifying
+    question. Correct answers and exits need no model call.
+    """
+    question = state["questions"][state["question_index"]]
+    text = state["messages"][-1].content
+    if text.strip().lower() in ['exit', 'quit']:
+        return "exit", None
+    choice = parse_choice(text, question)
+    details = f"Question: {format_question(question, state['question_index'] + 1)}\nCorrect answer: {format_answer(question)}"
+    if question.get("explanation"):
+        details += f"\nAnswer key explanation: {question['explanation']}"
+    if choice is None:
+        return "clarify", [SystemMessage(content=TUTOR_INSTRUCTIONS), HumanMessage(content=f"{details}\nThe student asked: {text}")]
+    correct = choice == question["answer_index"]
+    state["results"].append({"concept": question.get("concept"), "correct": correct})
+    state["question_index"] += 1
+    if correct:
+        return "correct", None
+    return "wrong", [SystemMessage(content=TUTOR_INSTRUCTIONS), HumanMessage(content=f"{details}\nThe student answered: {format_answer({**question, 'answer_index': choice})}")]
+
+def record_bank_turn(state: DudState, outcome: str, explanation: str = ""):
+    """Reply to the student's latest message in a question-bank quiz, then ask the next question or end the quiz."""
+    if outcome == "clarify":
+        state["messages"].append(AIMessage(content=explanation))
+        return
+    if outcome == "correct":
+        reply = "Correct!"
+    elif outcome == "wrong":
+        reply = f"Not quite, the correct answer is {format_answer(state['questions'][state['question_index'] - 1])}. {explanation}"
+    else:
+        reply = "No problem, let's stop here."
+    if outcome == "exit" or quiz_finished(state):
+        state["summary"] = quiz_summary(state)
+        reply += "\n\n## QUIZ SUMMARY" + state["summary"]
+    else:
+        reply += "\n\n" + format_question(state["questions"][state["question_index"]], state["question_index"] + 1)
+    state["messages"].append(AIMessage(content=reply))
+
+def exit_summary_prompt(state: DudState) -> str:
+    """Build the prompt used to summarize a quiz the student quit early."""
+    summary_prompt = """The student has exited the quiz early. 
+    Summarize the quiz based on the following dialogue. 
+    Highlight the student's strengths and weaknesses.
+    Try to take into account why they may have ended the quiz early."""
+    for message in state["messages"]:
+        if isinstance(message, HumanMessage):
+            summary_prompt += f"Student: {message.content}" + "\n"
+        elif isinstance(message, AIMessage):
+            summary_prompt += f"AI: {message.content}" + "\n"
+        else:
+            summary_prompt += f"System: {message.content}" + "\n"
+    return summary_prompt
+
+def record_exit_summary(state: DudState, summary: AIMessage):
+    state["summary"] = summary.content
+    state["messages"].append(summary)
+
+def record_response(state: DudState, response: AIMessage):
+    state["messages"].append(response)
+    if "quiz summary" in response.content.lower() and not state.get("summary", ""):
+        state["summary"] = response.content.split("QUIZ SUMMARY")[1]
+
+def chat_node(state: DudState):
+    if not state.get("messages", []):
+        start_quiz(state, draw_questions(state.get('topic', 'Computer Fundamentals'), QUESTIONS_PER_QUIZ))
+    last_message = state["messages"][-1] if state["messages"] else None
+    if not isinstance(last_message, AIMessage):
+        if state.get("questions"):
+            outcome, prompt = grade_answer(state)
+            record_bank_turn(state, outcome, feedback_model().invoke(prompt).content if prompt else "")
+        elif last_message.content in ['exit', 'quit']:
+            with llm_priority(BACKGROUND):
+                record_exit_summary(state, summary_llm.invoke(exit_summary_prompt(state)))
+        else:
+            record_response(state, (llm if last_message.type == "human" else opening_llm).invoke(state["messages"]))
+    
+    return state
+
+async def achat_node(state: DudState):
+    """Async variant of chat_node."""
+    if not state.get("messages", []):
+        start_quiz(state, await asyncio.to_thread(draw_questions, state.get('topic', 'Computer Fundamentals'), QUESTIONS_PER_QUIZ))
     last_message = state["messages"][-1] if state["messages"] else None
     if not isinstance(last_message, AIMessage):
-        if last_message.content in ['exit', 'quit']:
-            summary_prompt = """The student has exited the quiz early. 
-            Summarize the quiz based on the following dialogue. 
-            Highlight the student's strengths and weaknesses.
-            Try to take into account why they may have ended the quiz early."""
-            for message in state["messages"]:
-                if isinstance(message, HumanMessage):
-                    summary_prompt += f"Student: {message.content}" + "\n"
-                elif isinstance(message, AIMessage):
-                    summary_prompt += f"AI: {message.content}" + "\n"
-                else:
-                    summary_prompt += f"System: {message.content}" + "\n"
-            summary = llm.invoke(summary_prompt)
-            state["summary"] = summary.content
-            state["messages"].append(summary)
+        if state.get("questions"):
+            outcome, prompt = grade_answer(state)
+            record_bank_turn(state, outcome, (await feedback_model().ainvoke(prompt)).content if prompt else "")
+        elif last_message.content in ['exit', 'quit']:
+            with llm_priority(BACKGROUND):
+                record_exit_summary(state, await summary_llm.ainvoke(exit_summary_prompt(state)))
         else:
-            response = llm.invoke(state["messages"])
-            state["messages"].append(response)
-            if "quiz summary" in response.content.lower() and not state.get("summary", ""):
-                state["summary"] = response.content.split("QUIZ SUMMARY")[1]
+            record_response(state, await (llm if last_message.type == "human" else opening_llm).ainvoke(state["messages"]))
     
     return state
 
@@ -60,7 +194,7 @@ def build_graph():
     workflow = StateGraph(DudState)
 
     # Add nodes
-    workflow.add_node("chat_node", chat_node)
+    workflow.add_node("chat_node", RunnableLambda(chat_node, afunc=achat_node))
     workflow.add_edge(START, "chat_node")
     workflow.add_edge("chat_node", END)
 
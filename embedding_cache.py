@@ -0,0 +1,142 @@
+import asyncio, hashlib, logging, threading
+
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from langchain_core.embeddings import Embeddings
+from pymongo import UpdateOne
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_COLLECTION = "embedding_cache"
+MEMORY_CACHE_SIZE = 10000
+# Entries not embedded again within this long expire, so one-off queries do not pile up
+EMBEDDING_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+def embedding_key(model: str, text: str) -> str:
+    """Cache key for a text's embedding: the model name plus the text with whitespace collapsed."""
+    return hashlib.sha256(f"{model}\n{' '.join(text.split())}".encode()).hexdigest()
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that are computed once per model and text, then served from memory or MongoDB.
+
+    Lookups go to an in-process LRU first, then to the embedding_cache collection, and only
+    texts missing from both are sent to the underlying model. MongoDB expires entries after
+    the TTL. Without MongoDB, only the in-process tier is used.
+    """
+
+    def __init__(self, embeddings: Embeddings, collection_provider=None, memory_size: int = MEMORY_CACHE_SIZE,
+                 ttl_seconds: float = EMBEDDING_CACHE_TTL_SECONDS):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        self.collection_provider = collection_provider
+        self.memory_size = memory_size
+        self.ttl_seconds = ttl_seconds
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.indexed = False
+        self.stats = {"memory_hits": 0, "mongo_hits": 0, "misses": 0}
+
+    def collection(self):
+        """The persistent tier with its TTL index, or None if it is unavailable."""
+        if self.collection_provider is None:
+            return None
+        try:
+            collection = self.collection_provider()
+            if collection is not None and not self.indexed:
+                collection.create_index("expires_at", expireAfterSeconds=0)
+                self.indexed = True
+            return collection
+        except Exception as e:
+            logger.warning("Embedding cache collection unavailable: %s", e)
+            return None
+
+    def remember(self, key: str, embedding: List[float]):
+        with self.lock:
+            self.memory[key] = embedding
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    def from_memory(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+            self.stats["memory_hits"] += len(found)
+        return found
+
+    def from_mongo(self, keys: List[str]) -> Dict[str, List[float]]:
+        collection = self.collection()
+        if collection is None or not keys:
+            return {}
+        try:
+            found = {document["_id"]: document["embedding"] for document in collection.find({"_id": {"$in": keys}, "expires_at": {"$gt": datetime.now(timezone.utc)}})}
+        except Exception as e:
+            logger.warning("Embedding cache lookup failed: %s", e)
+            return {}
+        for key, embedding in found.items():
+            self.remember(key, embedding)
+        with self.lock:
+            self.stats["mongo_hits"] += len(found)
+        return found
+
+    def save(self, computed: Dict[str, List[float]]):
+        for key, embedding in computed.items():
+            self.remember(key, embedding)
+        collection = self.collection()
+        if collection is None or not computed:
+            return
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+        try:
+            # Upserts, so an entry cached before entries expired also picks up an expiry
+            collection.bulk_write([
+                UpdateOne({"_id": key}, {"$set": {"model": self.model, "embedding": embedding, "expires_at": expires_at}}, upsert=True)
+                for key, embedding in computed.items()
+            ], ordered=False)
+        except Exception as e:
+            logger.warning("Could not persist embeddings: %s", e)
+
+    def lookup(self, texts: List[str]):
+        """Cached embeddings by key, and the texts (by key) that still need embedding."""
+        keys = [embedding_key(self.model, text) for text in texts]
+        found = self.from_memory(keys)
+        found.update(self.from_mongo([key for key in dict.fromkeys(keys) if key not in found]))
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        with self.lock:
+            self.stats["misses"] += len(missing)
+        return keys, found, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self.lookup(texts)
+        if missing:
+            computed = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self.save(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, found, missing = self.lookup([text])
+        if missing:
+            computed = {keys[0]: self.embeddings.embed_query(text)}
+            self.save(computed)
+            found.update(computed)
+        return found[keys[0]]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = await asyncio.to_thread(self.lookup, texts)
+        if missing:
+            computed = dict(zip(missing, await self.embeddings.aembed_documents(list(missing.values()))))
+            await asyncio.to_thread(self.save, computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        keys, found, missing = await asyncio.to_thread(self.lookup, [text])
+        if missing:
+            computed = {keys[0]: await self.embeddings.aembed_query(text)}
+            await asyncio.to_thread(self.save, computed)
+            found.update(computed)
+        return found[keys[0]]
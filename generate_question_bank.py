@@ -0,0 +1,152 @@
+# Offline job that fills the question bank for every topic in lesson_templates, so quizzes
+# and reviews can serve questions without generating them on the student's critical path.
+# Progress is checkpointed per topic, so an interrupted run picks up where it left off.
+# Run with: python generate_question_bank.py [--per-topic 60] [--concurrency 4] [--topic Arrays]
+# Try the pipeline offline with: python generate_question_bank.py --fake-llm --collection question_bank_scratch
+import argparse, asyncio, json, logging, os
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
+from pymongo import UpdateOne
+
+from llm_clients import run_async, task_model
+from question_bank import GENERATION_INSTRUCTIONS, QUESTION_BANK_COLLECTION, parse_questions, question_hash, questions_collection
+import utils
+
+logger = logging.getLogger(__name__)
+
+# Progress file for a collection, so runs against a scratch bank never mark topics of the real one done
+CHECKPOINT_PATH = "{collection}_checkpoint.json"
+QUESTIONS_PER_REQUEST = 10
+# Give up on a topic after this many requests in a row that add no new questions
+MAX_FRUITLESS_REQUESTS = 3
+
+def generation_prompt(topic: str, template: str, count: int, batch: int, avoid: list) -> list:
+    avoid_lines = "\n".join(f"- {question}" for question in avoid[-30:]) or "- none yet"
+    return [
+        SystemMessage(content=GENERATION_INSTRUCTIONS),
+        HumanMessage(content=f"Topic: {topic}\nLesson plan:\n{template[:2000]}\n\n"
+                             f"Write {count} new questions (batch {batch}). Do not repeat these existing questions:\n{avoid_lines}")
+    ]
+
+def load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint:
+        return json.load(checkpoint)
+
+def save_checkpoint(path: str, checkpoint: dict):
+    # Write then rename, so an interrupted run never leaves a half-written checkpoint
+    with open(path + ".tmp", "w") as tmp:
+        json.dump(checkpoint, tmp, indent=2)
+    os.replace(path + ".tmp", path)
+
+def store_questions(collection, documents: list) -> int:
+    """Insert questions that are not in the bank yet, keyed by content hash. Returns how many were new."""
+    if not documents:
+        return 0
+    result = collection.bulk_write(
+        [UpdateOne({"hash": document["hash"]}, {"$setOnInsert": document}, upsert=True) for document in documents],
+        ordered=False
+    )
+    return result.upserted_count
+
+async def fill_topic(llm, collection, topic: str, template: str, target: int, checkpoint: dict, semaphore: asyncio.Semaphore, save) -> int:
+    """Generate questions for one topic until the bank holds target of them, calling save after each batch."""
+    progress = checkpoint.setdefault(topic, {"stored": 0, "batches": 0, "done": False})
+    if progress["done"]:
+        return 0
+    existing = await asyncio.to_thread(lambda: list(collection.find({"topic": topic}, {"question": 1, "options": 1, "_id": 0})))
+    seen = {question_hash(topic, question["question"], question["options"]) for question in existing}
+    avoid = [question["question"] for question in existing]
+    progress["stored"] = len(existing)
+    added = fruitless = 0
+    while progress["stored"] < target and fruitless < MAX_FRUITLESS_REQUESTS:
+        count = min(QUESTIONS_PER_REQUEST, target - progress["stored"])
+        async with semaphore:
+            reply = await llm.ainvoke(generation_prompt(topic, template, count, progress["batches"] + 1, avoid))
+        progress["batches"] += 1
+        documents = []
+        for document in parse_questions(topic, reply.content):
+            if document["hash"] not in seen:
+                seen.add(document["hash"])
+                documents.append(document)
+        new = await asyncio.to_thread(store_questions, collection, documents[:target - progress["stored"]])
+        avoid += [document["question"] for document in documents]
+        progress["stored"] += new
+        added += new
+        fruitless = 0 if new else fruitless + 1
+        save()
+    progress["done"] = progress["stored"] >= target
+    logger.info("%s: %d questions in the bank (%d new)", topic, progress["stored"], added)
+    return added
+
+async def fill_question_bank(llm, collection, topics: dict, target: int, concurrency: int, checkpoint_path: str) -> int:
+    """Fill every topic concurrently, with at most concurrency model requests in flight."""
+    checkpoint = load_checkpoint(checkpoint_path)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    def save():
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    async def fill(topic, template):
+        try:
+            return await fill_topic(llm, collection, topic, template, target, checkpoint, semaphore, save)
+        finally:
+            save()
+
+    added = await asyncio.gather(*(fill(topic, template) for topic, template in topics.items()), return_exceptions=True)
+    for topic, result in zip(topics, added):
+        if isinstance(result, Exception):
+            logger.error("%s: generation failed, rerun to resume: %s", topic, result)
+    return sum(result for result in added if not isinstance(result, Exception))
+
+def lesson_topics(only_topic: str = None) -> dict:
+    """Lesson plan text by topic, from the templates fetch_lesson_plan serves."""
+    client = utils.get_mongodb_connection()
+    if client is None:
+        raise ConnectionError("MongoDB is unavailable")
+    criteria = {"topic_name": only_topic} if only_topic else {}
+    templates = client[utils.MONGO_DB_NAME]["lesson_templates"].find(criteria, {"topic_name": 1, "template": 1})
+    return {template["topic_name"]: str(template.get("template", "")) for template in templates}
+
+def fake_question_model(messages) -> AIMessage:
+    """Offline stand-in for the generation model that returns well-formed questions, for trying out the pipeline."""
+    prompt = messages[-1].content
+    topic = prompt.split("\n", 1)[0].removeprefix("Topic: ")
+    count = int(prompt.split("Write ", 1)[1].split(" ", 1)[0])
+    batch = prompt.split("(batch ", 1)[1].split(")", 1)[0]
+    questions = [{
+        "question": f"Sample question {batch}.{i} on {topic}?",
+        "options": ["Right answer", "Wrong answer", "Another wrong answer", "Yet another wrong answer"],
+        "answer": "Right answer",
+        "explanation": "This is a placeholder question.",
+        "concept": topic
+    } for i in range(count)]
+    return AIMessage(content=json.dumps({"questions": questions}))
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the question bank for every lesson topic.")
+    parser.add_argument("--per-topic", type=int, default=60, help="questions to keep in the bank for each topic")
+    parser.add_argument("--concurrency", type=int, default=4, help="model requests in flight at once")
+    parser.add_argument("--topic", help="only fill this topic")
+    parser.add_argument("--collection", default=QUESTION_BANK_COLLECTION, help="collection to fill, quizzes and reviews draw from the default")
+    parser.add_argument("--checkpoint", help="progress file, one per collection by default")
+    parser.add_argument("--fake-llm", action="store_true", help="generate placeholder questions without calling the model, into a separate --collection")
+    args = parser.parse_args()
+    if args.fake_llm and args.collection == QUESTION_BANK_COLLECTION:
+        parser.error(f"--fake-llm writes placeholder questions, so it needs a --collection other than {QUESTION_BANK_COLLECTION}, which students are served from")
+    logging.basicConfig(level=logging.INFO)
+
+    llm = RunnableLambda(fake_question_model) if args.fake_llm else task_model("question_generation").bind(response_format={"type": "json_object"})
+    collection = questions_collection(args.collection)
+    if collection is None:
+        raise SystemExit("MongoDB is unavailable")
+    collection.create_index("hash", unique=True)
+    collection.create_index("topic")
+    added = run_async(fill_question_bank(llm, collection, lesson_topics(args.topic), args.per_topic, args.concurrency,
+                                          args.checkpoint or CHECKPOINT_PATH.format(collection=args.collection)))
+    print(f"Added {added} questions")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# Incremental ingestion of curriculum PDFs and text files into csa_documents, the collection
+# the CSA chat retrieves from. Files whose content has not changed are skipped; for the rest,
+# only chunks that are new are embedded and written, and chunks that disappeared are removed.
+# Run with: python ingest_documents.py PATH [PATH ...] [--concurrency 4] [--local-index]
+import argparse, asyncio, hashlib, logging, os
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pymongo import UpdateOne
+from pypdf import PdfReader
+from typing import Iterator, List, Tuple
+
+from llm_clients import embeddings_model, run_async
+import utils
+
+logger = logging.getLogger(__name__)
+
+SOURCES_COLLECTION = "ingestion_sources"
+SUPPORTED_EXTENSIONS = {".pdf", ".txt", ".md"}
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 150
+EMBED_BATCH_SIZE = 64
+
+splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(" ".join(text.split()).encode()).hexdigest()
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def find_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, name) for name in sorted(names) if os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS]
+        elif os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS:
+            files.append(path)
+    return files
+
+def read_pages(path: str) -> Iterator[Tuple[int, str]]:
+    """Yield (page number, text) one page at a time, so large PDFs are never held in memory whole."""
+    if path.lower().endswith(".pdf"):
+        for number, page in enumerate(PdfReader(path).pages, start=1):
+            yield number, page.extract_text() or ""
+    else:
+        with open(path, encoding="utf-8") as file:
+            yield 1, file.read()
+
+def chunk_file(path: str) -> dict:
+    """Chunks of a file by content hash; a chunk repeated within the file is kept once."""
+    chunks = {}
+    for page, text in read_pages(path):
+        for chunk in splitter.split_text(text):
+            chunks.setdefault(chunk_hash(chunk), {"text": chunk, "page": page})
+    return chunks
+
+async def embed_chunks(embeddings, texts: List[str], semaphore: asyncio.Semaphore) -> List[List[float]]:
+    """Embed texts in batches, with the semaphore bounding requests in flight."""
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embeddings.aembed_documents(batch)
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return [vector for batch in results for vector in batch]
+
+async def plan_file(path: str, collection, sources, force: bool = False) -> dict:
+    """Work out which of a file's chunks are new and which are stale; unchanged files are skipped."""
+    source = os.path.relpath(path)
+    digest = await asyncio.to_thread(file_hash, path)
+    record = await asyncio.to_thread(sources.find_one, {"_id": source})
+    if record and record.get("file_hash") == digest and not force:
+        return {"source": source, "skipped": True, "added": 0, "removed": 0}
+    chunks = await asyncio.to_thread(chunk_file, path)
+    existing = {document["_id"] for document in await asyncio.to_thread(lambda: list(collection.find({"sources": source}, {"_id": 1})))}
+    return {
+        "source": source, "skipped": False, "digest": digest, "chunks": chunks,
+        "new": [key for key in chunks if key not in existing],
+        "stale": [key for key in existing if key not in chunks]
+    }
+
+def apply_plan(plan: dict, collection, sources, vectors: dict):
+    """Upsert a file's new chunks, detach its stale ones, and record the file as ingested."""
+    source, chunks = plan["source"], plan["chunks"]
+    operations = []
+    for key in plan["new"]:
+        insert = {"text": chunks[key]["text"], "page": chunks[key]["page"], "hash": key}
+        if key in vectors:
+            insert["embedding"] = vectors[key]
+        operations.append(UpdateOne({"_id": key}, {"$setOnInsert": insert, "$addToSet": {"sources": source}}, upsert=True))
+    if plan["stale"]:
+        operations.append(UpdateOne({"_id": {"$in": plan["stale"]}}, {"$pull": {"sources": source}}))
+    if operations:
+        collection.bulk_write(operations, ordered=True)
+    if plan["stale"]:
+        # Chunks no other file shares are gone from the corpus
+        collection.delete_many({"_id": {"$in": plan["stale"]}, "sources": {"$size": 0}})
+    sources.replace_one({"_id": source}, {"_id": source, "file_hash": plan["digest"], "chunks": len(chunks)}, upsert=True)
+    logger.info("%s: %d chunks, %d new, %d removed", source, len(chunks), len(plan["new"]), len(plan["stale"]))
+
+async def ingest(paths: List[str], collection, sources, embeddings, concurrency: int, force: bool = False) -> List[dict]:
+    """Ingest files incrementally. Returns, per file, whether it was skipped and how many chunks were added and removed."""
+    plans = await asyncio.gather(*(plan_file(path, collection, sources, force) for path in find_files(paths)))
+    changed = [plan for plan in plans if not plan["skipped"]]
+
+    # Each distinct new chunk is embedded once, even if several files share it or it is already stored
+    texts = {key: plan["chunks"][key]["text"] for plan in changed for key in plan["new"]}
+    stored = {document["_id"] for document in await asyncio.to_thread(lambda: list(collection.find({"_id": {"$in": list(texts)}}, {"_id": 1})))}
+    to_embed = [key for key in texts if key not in stored]
+    vectors = dict(zip(to_embed, await embed_chunks(embeddings, [texts[key] for key in to_embed], asyncio.Semaphore(concurrency))))
+    logger.info("%d of %d files changed, %d chunks embedded", len(changed), len(plans), len(to_embed))
+
+    for plan in changed:
+        await asyncio.to_thread(apply_plan, plan, collection, sources, vectors)
+        plan.update(added=len(plan["new"]), removed=len(plan["stale"]))
+    return [{key: plan[key] for key in ("source", "skipped", "added", "removed")} for plan in plans]
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest curriculum documents into the CSA knowledge base.")
+    parser.add_argument("paths", nargs="+", help="PDF, text or Markdown files, or directories of them")
+    parser.add_argument("--concurrency", type=int, default=4, help="embedding requests in flight at once")
+    parser.add_argument("--force", action="store_true", help="re-chunk files even if they have not changed")
+    parser.add_argument("--local-index", action="store_true", help="also rebuild the local vector index afterwards")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    client = utils.get_mongodb_connection()
+    if client is None:
+        raise SystemExit("MongoDB is unavailable")
+    db = client[utils.MONGO_DB_NAME]
+    collection = db[os.getenv("MONGODB_COLLECTION_NAME", "csa_documents")]
+    embeddings = embeddings_model()
+    results = run_async(ingest(args.paths, collection, db[SOURCES_COLLECTION], embeddings, args.concurrency, args.force))
+    changed = [result for result in results if not result["skipped"]]
+    print(f"{len(results)} files, {len(changed)} changed: "
+          f"{sum(result['added'] for result in changed)} chunks added, {sum(result['removed'] for result in changed)} removed")
+
+    if args.local_index and changed:
+        from local_vector_store import DEFAULT_INDEX_DIR, LocalVectorStore, export_collection
+        index_dir = os.getenv("LOCAL_VECTOR_INDEX_DIR", DEFAULT_INDEX_DIR)
+        print(f"Local index rebuilt with {export_collection(collection, LocalVectorStore(embeddings, index_dir))} chunks")
+
+if __name__ == "__main__":
+    main()
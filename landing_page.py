@@ -1,6 +1,12 @@
+import logging
+import os
 import streamlit as st
 import utils
 
+# Surface token usage and cache metrics from the tutoring graphs in the server log
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
 # Page registry mapping page names to their display functions
 PAGE_REGISTRY = {
     "landing": None,  # Will be handled directly
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import httpx
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from embedding_cache import EMBEDDING_CACHE_COLLECTION, EMBEDDING_CACHE_TTL_SECONDS, CachedEmbeddings
+from llm_gateway import AsyncGatewayTransport, GatewayTransport
+from response_cache import RESPONSE_CACHE_COLLECTION, ResponseCache
+from utils import MONGO_DB_NAME, OPENAI_API_KEY, get_mongodb_connection
+
+# Bounds for the connection pool shared by every model client in the process
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+POOL_LIMITS = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+# One async HTTP client for all graphs. httpx connections belong to the event loop
+# that opened them, so async graph runs must go through run_async/iterate_async below.
+# Both clients send every request through the gateway, which applies the process-wide
+# rate limits, retries 429s and 5xx with backoff, and records per-call metrics.
+async_http_client = httpx.AsyncClient(transport=AsyncGatewayTransport(POOL_LIMITS), timeout=HTTP_TIMEOUT)
+http_client = httpx.Client(transport=GatewayTransport(POOL_LIMITS), timeout=HTTP_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+class UsageTracker(BaseCallbackHandler):
+    """Records token usage of every model call, including prompt tokens served from the provider's prefix cache."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.labels = {}
+        self.totals = {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        # Graph nodes are the most useful label; calls made outside a graph are just "llm"
+        self.labels[run_id] = (metadata or {}).get("langgraph_node", "llm")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        label = self.labels.pop(run_id, "llm")
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        if not usage:
+            return
+        cached_tokens = (usage.get("input_token_details") or {}).get("cache_read") or 0
+        with self.lock:
+            self.totals["calls"] += 1
+            self.totals["input_tokens"] += usage["input_tokens"]
+            self.totals["cached_tokens"] += cached_tokens
+            self.totals["output_tokens"] += usage["output_tokens"]
+        logger.info("%s: %d input tokens (%d cached), %d output tokens",
+                    label, usage["input_tokens"], cached_tokens, usage["output_tokens"])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.labels.pop(run_id, None)
+
+    def stats(self) -> dict:
+        """Process-wide token totals and the share of input tokens served from cache."""
+        with self.lock:
+            stats = dict(self.totals)
+        stats["cache_hit_rate"] = stats["cached_tokens"] / stats["input_tokens"] if stats["input_tokens"] else 0.0
+        return stats
+
+usage_tracker = UsageTracker()
+
+def chat_model(temperature=0.7, model_name="gpt-4.1-mini", **kwargs) -> ChatOpenAI:
+    """Create a chat model that goes through the process-wide gateway and shares usage tracking."""
+    return ChatOpenAI(
+        temperature=temperature,
+        model_name=model_name,
+        api_key=OPENAI_API_KEY,
+        http_client=http_client,
+        http_async_client=async_http_client,
+        max_retries=0,  # The gateway retries, with backoff shared across the process
+        stream_usage=True,  # Streamed responses report usage, including cached tokens, too
+        callbacks=[usage_tracker],
+        **kwargs
+    )
+
+# Model, temperature, max_tokens and timeout per node or task; tasks not listed use "default"
+MODEL_ROUTES_PATH = os.getenv("MODEL_ROUTES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_routes.json"))
+
+def load_model_routes(path: str = MODEL_ROUTES_PATH) -> dict:
+    with open(path) as routes:
+        return json.load(routes)
+
+model_routes = load_model_routes()
+
+def model_route(task: str) -> dict:
+    """The routing table's settings for a task, filled in from the default route."""
+    return {**model_routes["default"], **model_routes.get(task, {})}
+
+def response_cache_collection():
+    client = get_mongodb_connection()
+    return client[MONGO_DB_NAME][RESPONSE_CACHE_COLLECTION] if client is not None else None
+
+# Responses of tasks marked cacheable in the routing table, shared by every model in the process
+response_cache = ResponseCache(
+    ttl_seconds=int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60)),
+    collection_provider=response_cache_collection
+)
+
+def task_model(task: str, **kwargs) -> ChatOpenAI:
+    """Create the chat model the routing table assigns to a node or task.
+
+    Tasks marked cacheable reuse earlier responses to identical calls. Only temperature 0
+    tasks may opt in, since a cached response stands in for a fresh sample.
+    """
+    route = model_route(task)
+    kwargs = {"max_tokens": route["max_tokens"], "timeout": route["timeout"], **kwargs}
+    if route.get("cacheable"):
+        if route["temperature"] == 0:
+            kwargs.setdefault("cache", response_cache)
+        else:
+            logger.warning("Not caching %s responses: only temperature 0 tasks are cacheable", task)
+    return chat_model(temperature=route["temperature"], model_name=route["model"], **kwargs)
+
+def embedding_cache_collection():
+    client = get_mongodb_connection()
+    return client[MONGO_DB_NAME][EMBEDDING_CACHE_COLLECTION] if client is not None else None
+
+def embeddings_model(**kwargs) -> CachedEmbeddings:
+    """Create an embeddings model that goes through the process-wide gateway.
+
+    Embeddings are cached by model and text, in memory and in MongoDB, so repeated queries
+    and re-ingested documents are not embedded again.
+    """
+    return CachedEmbeddings(
+        OpenAIEmbeddings(
+            api_key=OPENAI_API_KEY,
+            http_client=http_client,
+            http_async_client=async_http_client,
+            max_retries=0,
+            **kwargs
+        ),
+        collection_provider=embedding_cache_collection,
+        ttl_seconds=int(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", EMBEDDING_CACHE_TTL_SECONDS))
+    )
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the background event loop that runs all async graph work."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return _loop
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result.
+
+    Streamlit scripts run in worker threads, so this is how the UI drives the async graphs.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+_DONE = object()
+
+def iterate_async(async_iterable):
+    """Consume an async iterable on the shared event loop, yielding its items to a sync caller."""
+    items = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in async_iterable:
+                items.put(item)
+        finally:
+            items.put(_DONE)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    while True:
+        item = items.get()
+        if item is _DONE:
+            break
+        yield item
+    # Re-raise anything the stream failed with
+    future.result()
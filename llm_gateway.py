@@ -0,0 +1,347 @@
+import asyncio, contextvars, json, logging, os, random, threading, time
+import httpx
+
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Process-wide OpenAI limits; set them a little under the account's tier limits
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 500))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 200000))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20.0
+# Completion tokens assumed for requests that do not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 500
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Token bucket refilled continuously at a per-minute rate, holding at most one minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount tokens are available; requests larger than the bucket wait for a full one."""
+        with self.lock:
+            self.refill()
+            return max(0.0, (min(amount, self.capacity) - self.available) / self.rate)
+
+    def take(self, amount: float):
+        with self.lock:
+            self.refill()
+            self.available -= min(amount, self.capacity)
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared by every model call in the process."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def wait_time(self, tokens: int) -> float:
+        """Seconds until a request expected to use this many tokens may be sent."""
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def take(self, tokens: int):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+# Priorities, most urgent first: a turn a student is waiting on, work they will wait on soon
+# (routing, compaction, speculative openings), and work nobody is waiting on (summaries, jobs)
+INTERACTIVE, NEAR_INTERACTIVE, BACKGROUND = "interactive", "near_interactive", "background"
+PRIORITIES = (INTERACTIVE, NEAR_INTERACTIVE, BACKGROUND)
+
+current_priority = contextvars.ContextVar("llm_priority", default=INTERACTIVE)
+current_owner = contextvars.ContextVar("llm_owner", default="anonymous")
+
+@contextmanager
+def llm_priority(priority: str):
+    """Send the model calls made inside the block at this priority."""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+@contextmanager
+def llm_owner(owner: str):
+    """Attribute the model calls made inside the block to a student or visitor, for fair sharing."""
+    token = current_owner.set(owner)
+    try:
+        yield
+    finally:
+        current_owner.reset(token)
+
+class Waiter:
+    """A request queued for the rate limit; grant() wakes its thread or coroutine."""
+
+    def __init__(self, priority: str, owner: str, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.owner = owner
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+class PriorityScheduler:
+    """Admits model requests under the rate limit in priority order, sharing each priority fairly.
+
+    Requests go straight out while the limiter has room and nothing is queued. Otherwise they
+    queue by priority, and within a priority by owner, taking turns round-robin so one student's
+    burst does not hold up everyone else. A dispatcher thread admits the head of the queue as
+    soon as the limiter has room, re-checking the head whenever a more urgent request arrives.
+    """
+
+    def __init__(self, limiter: RateLimiter):
+        self.limiter = limiter
+        self.condition = threading.Condition()
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.waits = {priority: {"requests": 0, "queued": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0} for priority in PRIORITIES}
+        self.dispatcher = None
+
+    def depth(self, priority: str) -> int:
+        return sum(len(waiters) for waiters in self.queues[priority].values())
+
+    def head(self) -> Optional[Waiter]:
+        for priority in PRIORITIES:
+            for waiters in self.queues[priority].values():
+                return waiters[0]
+        return None
+
+    def pop(self, waiter: Waiter):
+        owners = self.queues[waiter.priority]
+        waiters = owners.pop(waiter.owner)
+        waiters.remove(waiter)
+        if waiters:
+            # The owner goes to the back of the line for its next request
+            owners[waiter.owner] = waiters
+
+    def record_wait(self, priority: str, seconds: float, queued: bool):
+        stats = self.waits[priority]
+        stats["requests"] += 1
+        stats["queued"] += queued
+        stats["wait_seconds"] += seconds
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], seconds)
+
+    def admit_now(self, tokens: int) -> Optional[Waiter]:
+        """Take the limit right away if nothing is queued and there is room, else queue a waiter."""
+        priority, owner = current_priority.get(), current_owner.get()
+        with self.condition:
+            if self.head() is None and self.limiter.wait_time(tokens) == 0:
+                self.limiter.take(tokens)
+                self.record_wait(priority, 0.0, False)
+                return None
+            try:
+                waiter = Waiter(priority, owner, tokens, asyncio.get_running_loop())
+            except RuntimeError:
+                waiter = Waiter(priority, owner, tokens)
+            self.queues[priority].setdefault(owner, deque()).append(waiter)
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self.dispatch, name="llm-scheduler", daemon=True)
+                self.dispatcher.start()
+            self.condition.notify()
+            return waiter
+
+    def dispatch(self):
+        with self.condition:
+            while True:
+                waiter = self.head()
+                if waiter is None:
+                    self.condition.wait()
+                    continue
+                wait = self.limiter.wait_time(waiter.tokens)
+                if wait > 0:
+                    # Woken early if a more urgent request arrives
+                    self.condition.wait(wait)
+                    continue
+                self.pop(waiter)
+                self.limiter.take(waiter.tokens)
+                self.record_wait(waiter.priority, time.monotonic() - waiter.enqueued, True)
+                waiter.grant()
+
+    def cancel(self, waiter: Waiter):
+        with self.condition:
+            if waiter in self.queues[waiter.priority].get(waiter.owner, ()):
+                self.pop(waiter)
+
+    def acquire(self, tokens: int) -> float:
+        """Block until a request expected to use this many tokens may be sent; returns the seconds waited."""
+        start = time.monotonic()
+        waiter = self.admit_now(tokens)
+        if waiter is not None:
+            waiter.event.wait()
+        return time.monotonic() - start
+
+    async def aacquire(self, tokens: int) -> float:
+        """Async variant of acquire."""
+        start = time.monotonic()
+        waiter = self.admit_now(tokens)
+        if waiter is not None:
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                self.cancel(waiter)
+                raise
+        return time.monotonic() - start
+
+    def stats(self) -> dict:
+        """Queue depth and wait times per priority."""
+        with self.condition:
+            return {priority: dict(self.waits[priority], depth=self.depth(priority),
+                                   mean_wait_seconds=self.waits[priority]["wait_seconds"] / self.waits[priority]["requests"] if self.waits[priority]["requests"] else 0.0)
+                    for priority in PRIORITIES}
+
+class GatewayMetrics:
+    """Per-call metrics for every request sent through the gateway, logged and aggregated by model."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = defaultdict(lambda: {"calls": 0, "retries": 0, "rate_limited": 0, "errors": 0,
+                                           "throttled_seconds": 0.0, "latency_seconds": 0.0})
+
+    def record(self, call: dict):
+        logger.info("%s %s (%s): status %s in %.2fs, %d attempts, %.2fs queued, ~%d tokens",
+                    call["endpoint"], call["model"], call["priority"], call["status"], call["latency"], call["attempts"],
+                    call["throttled"], call["tokens"])
+        with self.lock:
+            totals = self.totals[call["model"]]
+            totals["calls"] += 1
+            totals["retries"] += call["attempts"] - 1
+            totals["rate_limited"] += call["rate_limited"]
+            totals["errors"] += call["status"] is None or call["status"] >= 400
+            totals["throttled_seconds"] += call["throttled"]
+            totals["latency_seconds"] += call["latency"]
+
+    def stats(self) -> dict:
+        """Totals per model, with the mean latency to response headers."""
+        with self.lock:
+            stats = {model: dict(totals) for model, totals in self.totals.items()}
+        for totals in stats.values():
+            totals["mean_latency_seconds"] = totals["latency_seconds"] / totals["calls"]
+        return stats
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+scheduler = PriorityScheduler(rate_limiter)
+gateway_metrics = GatewayMetrics()
+
+def describe_request(request: httpx.Request) -> dict:
+    """Endpoint, model and an estimate of the tokens a request will use, for limiting and metrics."""
+    try:
+        body = json.loads(request.content or b"{}")
+    except ValueError:
+        body = {}
+    completion = body.get("max_completion_tokens") or body.get("max_tokens")
+    if completion is None:
+        completion = 0 if request.url.path.endswith("/embeddings") else DEFAULT_COMPLETION_TOKENS
+    return {
+        "endpoint": request.url.path.rsplit("/", 1)[-1],
+        "model": body.get("model", "unknown"),
+        "priority": current_priority.get(),
+        # About four characters per token, counting the request's JSON as prompt
+        "tokens": len(request.content or b"") // 4 + completion
+    }
+
+def backoff_seconds(attempt: int, response: Optional[httpx.Response]) -> float:
+    """Exponential backoff with full jitter, but never sooner than the server's Retry-After."""
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    try:
+        retry_after = float(response.headers.get("retry-after", 0)) if response is not None else 0.0
+    except ValueError:
+        retry_after = 0.0
+    return max(delay, min(retry_after, BACKOFF_MAX_SECONDS))
+
+class GatewayTransport(httpx.BaseTransport):
+    """Transport for synchronous OpenAI clients that rate-limits, retries and measures each request."""
+
+    def __init__(self, limits: httpx.Limits, scheduler: PriorityScheduler = scheduler, metrics: GatewayMetrics = gateway_metrics,
+                 max_retries: int = MAX_RETRIES):
+        self.transport = httpx.HTTPTransport(limits=limits)
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.max_retries = max_retries
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        call = describe_request(request)
+        call.update(attempts=0, rate_limited=0, throttled=self.scheduler.acquire(call["tokens"]), status=None)
+        start = time.monotonic()
+        try:
+            while True:
+                call["attempts"] += 1
+                response = None
+                try:
+                    response = self.transport.handle_request(request)
+                    call["status"] = response.status_code
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    if call["attempts"] > self.max_retries:
+                        raise
+                if response is not None and (response.status_code not in RETRY_STATUSES or call["attempts"] > self.max_retries):
+                    return response
+                if response is not None:
+                    call["rate_limited"] += response.status_code == 429
+                    response.close()
+                time.sleep(backoff_seconds(call["attempts"] - 1, response))
+                # A retry is a new request as far as the limits are concerned
+                call["throttled"] += self.scheduler.acquire(call["tokens"])
+        finally:
+            call["latency"] = time.monotonic() - start
+            self.metrics.record(call)
+
+    def close(self):
+        self.transport.close()
+
+class AsyncGatewayTransport(httpx.AsyncBaseTransport):
+    """Async variant of GatewayTransport; waits and backoffs yield to the event loop."""
+
+    def __init__(self, limits: httpx.Limits, scheduler: PriorityScheduler = scheduler, metrics: GatewayMetrics = gateway_metrics,
+                 max_retries: int = MAX_RETRIES):
+        self.transport = httpx.AsyncHTTPTransport(limits=limits)
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.max_retries = max_retries
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        call = describe_request(request)
+        call.update(attempts=0, rate_limited=0, throttled=await self.scheduler.aacquire(call["tokens"]), status=None)
+        start = time.monotonic()
+        try:
+            while True:
+                call["attempts"] += 1
+                response = None
+                try:
+                    response = await self.transport.handle_async_request(request)
+                    call["status"] = response.status_code
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    if call["attempts"] > self.max_retries:
+                        raise
+                if response is not None and (response.status_code not in RETRY_STATUSES or call["attempts"] > self.max_retries):
+                    return response
+                if response is not None:
+                    call["rate_limited"] += response.status_code == 429
+                    await response.aclose()
+                await asyncio.sleep(backoff_seconds(call["attempts"] - 1, response))
+                call["throttled"] += await self.scheduler.aacquire(call["tokens"])
+        finally:
+            call["latency"] = time.monotonic() - start
+            self.metrics.record(call)
+
+    async def aclose(self):
+        await self.transport.aclose()
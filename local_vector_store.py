@@ -0,0 +1,196 @@
+# Local vector index for the CSA knowledge base: document embeddings in a memory-mapped float32
+# matrix searched with NumPy, with an optional IVF coarse quantizer for larger corpora.
+# Export the Atlas collection into a local index with: python local_vector_store.py [--index-dir vector_index]
+import argparse, json, os, uuid
+import numpy as np
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from typing import Any, Iterable, List, Optional, Tuple
+
+DEFAULT_INDEX_DIR = "vector_index"
+# Corpora at least this large get an IVF quantizer, smaller ones are searched exhaustively
+IVF_MIN_VECTORS = 20000
+IVF_PROBES = 8
+KMEANS_ITERATIONS = 10
+
+def unit_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (matrix / norms).astype(np.float32)
+
+def train_ivf(vectors: np.ndarray, nlist: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Spherical k-means centroids for the vectors, and the list each vector is assigned to."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(nlist):
+            members = vectors[assignments == i]
+            if len(members):
+                centroids[i] = members.sum(axis=0)
+        centroids = unit_rows(centroids)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first."""
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    best = np.argpartition(-scores, k)[:k]
+    return best[np.argsort(-scores[best])]
+
+class LocalVectorStore(VectorStore):
+    """Vector store kept in a local directory, searchable with the same calls as MongoDBAtlasVectorSearch.
+
+    The directory holds embeddings.npy (unit-normalized float32 rows, memory-mapped for search),
+    documents.json (text and metadata per row) and, for large corpora, the IVF centroids and
+    row assignments. Writes rewrite the files; the store is meant for small, rarely changing corpora.
+    """
+
+    def __init__(self, embedding: Embeddings, index_dir: str = DEFAULT_INDEX_DIR):
+        self.embedding = embedding
+        self.index_dir = index_dir
+        self.load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def load(self):
+        """Open the index on disk; a missing index is an empty store."""
+        self.vectors = np.load(self.path("embeddings.npy"), mmap_mode="r") if os.path.exists(self.path("embeddings.npy")) else None
+        self.documents = []
+        if os.path.exists(self.path("documents.json")):
+            with open(self.path("documents.json")) as documents:
+                self.documents = json.load(documents)
+        self.centroids = self.assignments = None
+        if os.path.exists(self.path("centroids.npy")):
+            self.centroids = np.load(self.path("centroids.npy"))
+            self.assignments = np.load(self.path("assignments.npy"))
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def write(self, vectors: np.ndarray, documents: List[dict]):
+        """Replace the index on disk, building the IVF quantizer when the corpus is large enough."""
+        os.makedirs(self.index_dir, exist_ok=True)
+        # Save to temporary names, then swap them in so readers never see a partial index
+        np.save(self.path("embeddings.tmp.npy"), vectors)
+        with open(self.path("documents.tmp.json"), "w") as tmp:
+            json.dump(documents, tmp)
+        if len(vectors) >= IVF_MIN_VECTORS:
+            centroids, assignments = train_ivf(vectors, int(np.sqrt(len(vectors))))
+            np.save(self.path("centroids.tmp.npy"), centroids)
+            np.save(self.path("assignments.tmp.npy"), assignments)
+            os.replace(self.path("centroids.tmp.npy"), self.path("centroids.npy"))
+            os.replace(self.path("assignments.tmp.npy"), self.path("assignments.npy"))
+        else:
+            for name in ("centroids.npy", "assignments.npy"):
+                if os.path.exists(self.path(name)):
+                    os.remove(self.path(name))
+        os.replace(self.path("embeddings.tmp.npy"), self.path("embeddings.npy"))
+        os.replace(self.path("documents.tmp.json"), self.path("documents.json"))
+        self.load()
+
+    def add_vectors(self, vectors: List[List[float]], texts: List[str], metadatas: Optional[List[dict]] = None,
+                    ids: Optional[List[str]] = None) -> List[str]:
+        """Add already-embedded texts, as exported from Atlas or computed during ingestion.
+
+        ids default to random ones, so they stay unique however rows are added and deleted.
+        """
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [str(id) for id in ids] if ids else [uuid.uuid4().hex for _ in texts]
+        new_vectors = unit_rows(np.asarray(vectors, dtype=np.float32))
+        all_vectors = new_vectors if self.vectors is None else np.vstack([np.asarray(self.vectors), new_vectors])
+        documents = self.documents + [{"id": id, "text": text, "metadata": metadata} for id, text, metadata in zip(ids, texts, metadatas)]
+        self.write(all_vectors, documents)
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        return self.add_vectors(self.embedding.embed_documents(texts), texts, metadatas, kwargs.get("ids"))
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids or self.vectors is None:
+            return False
+        keep = [i for i, document in enumerate(self.documents) if document["id"] not in set(ids)]
+        self.write(np.asarray(self.vectors)[keep], [self.documents[i] for i in keep])
+        return True
+
+    def candidates(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """Rows in the lists nearest the query, or None to search every row."""
+        if self.centroids is None:
+            return None
+        lists = top_k(self.centroids @ query, IVF_PROBES)
+        return np.flatnonzero(np.isin(self.assignments, lists))
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        if self.vectors is None or not len(self.documents):
+            return []
+        query = unit_rows(np.asarray([embedding], dtype=np.float32))[0]
+        rows = self.candidates(query)
+        scores = (self.vectors if rows is None else self.vectors[rows]) @ query
+        best = top_k(scores, k)
+        results = []
+        for i in best:
+            row = int(i if rows is None else rows[i])
+            document = self.documents[row]
+            results.append((Document(page_content=document["text"], metadata=document["metadata"], id=document["id"]), float(scores[i])))
+        return results
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
+
+    async def asimilarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        # A NumPy search over a small corpus is quicker than a thread hop
+        return self.similarity_search_by_vector(embedding, k)
+
+    async def asimilarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(await self.embedding.aembed_query(query), k)
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs: Any) -> "LocalVectorStore":
+        store = cls(embedding, kwargs.get("index_dir", DEFAULT_INDEX_DIR))
+        store.add_texts(texts, metadatas)
+        return store
+
+def export_collection(collection, store: LocalVectorStore, text_key: str = "text", embedding_key: str = "embedding") -> int:
+    """Copy documents and their stored embeddings from a MongoDB collection into the local index."""
+    ids, texts, vectors, metadatas = [], [], [], []
+    for document in collection.find({embedding_key: {"$exists": True}}):
+        # Ingestion keys chunks by content hash, so rows keep the same id across exports
+        ids.append(document["_id"])
+        texts.append(document[text_key])
+        vectors.append(document[embedding_key])
+        metadatas.append({key: value for key, value in document.items() if key not in ("_id", text_key, embedding_key)})
+    if texts:
+        store.write(np.zeros((0, len(vectors[0])), dtype=np.float32), [])
+        store.add_vectors(vectors, texts, metadatas, ids)
+    return len(texts)
+
+def main():
+    import utils
+    from llm_clients import embeddings_model
+
+    parser = argparse.ArgumentParser(description="Export csa_documents from MongoDB into a local vector index.")
+    parser.add_argument("--index-dir", default=os.getenv("LOCAL_VECTOR_INDEX_DIR", DEFAULT_INDEX_DIR))
+    args = parser.parse_args()
+    client = utils.get_mongodb_connection()
+    if client is None:
+        raise SystemExit("MongoDB is unavailable")
+    collection = client[utils.MONGO_DB_NAME][os.getenv("MONGODB_COLLECTION_NAME", "csa_documents")]
+    count = export_collection(collection, LocalVectorStore(embeddings_model(), args.index_dir))
+    print(f"Exported {count} documents to {args.index_dir}")
+
+if __name__ == "__main__":
+    main()
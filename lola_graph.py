@@ -1,20 +1,32 @@
-import os
+import asyncio, logging, os
 
+from concurrent.futures import Future
 from dotenv import load_dotenv
 from typing import Literal, Optional, Union, Dict, Any
-from langchain_core.messages import AIMessage
-from langchain_openai import ChatOpenAI
+from langchain_core.messages import AIMessage, AIMessageChunk, RemoveMessage
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import MessagesState, StateGraph, START, END
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+from pydantic import BaseModel, Field
 
 from cassie_graph import lesson_graph, LessonState
 from dud_graph import dud_graph, DudState
 from review_graph import review_graph, ReviewState
-from utils import OPENAI_API_KEY
+from llm_clients import get_event_loop, task_model
+from llm_gateway import NEAR_INTERACTIVE, llm_owner, llm_priority
+from routing import local_route
+from utils import get_checkpointer
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 class PrimaryState(MessagesState):
-    """Global state for the tutoring assistant."""
+    """Global state for the tutoring assistant.
+
+    State is checkpointed per student thread, so each turn only sends the student's new
+    messages; primary_assistant moves them into the active subgraph's history.
+    """
     squads_ready: bool
     awaiting_user_choice: bool
     user_topic: str  # Topic for the session
@@ -27,14 +39,24 @@ class PrimaryState(MessagesState):
     user_profile: dict
 
 
-llm = ChatOpenAI(
-    temperature=0.7, 
-    model_name="gpt-4.1-mini", 
-    api_key=OPENAI_API_KEY
-)
+class SessionRoute(BaseModel):
+    """Where the student should go after a lesson or quiz."""
+    decision: Literal["lesson", "quiz"]
+
+class ReviewRoute(BaseModel):
+    """Whether the student passed their warm-up review."""
+    ready: bool = Field(description="True if their performance is satisfactory")
+
+# Routing usually happens locally; the model only settles sessions with too little evidence
+llm = task_model("session_routing")
+session_router = llm.with_structured_output(SessionRoute)
+review_router = llm.with_structured_output(ReviewRoute)
 
 def primary_assistant(state: PrimaryState):
     """Handles user messages and determines the next step."""
+    # New student messages for this turn
+    new_messages = state.get("messages", [])
+    
     # Prepare default states if needed
     if not state.get('subgraph_state'):
         topic = state.get("user_topic", "Computer Fundamentals") if state.get('squads_ready', False) else state.get("previous_topic")
@@ -43,27 +65,28 @@ def primary_assistant(state: PrimaryState):
         if session_type == "lesson":
             default_state = {
                 "topic": topic,
-                "messages": state.get("messages", []),
+                "messages": list(new_messages),
                 "lesson_plan": None,
                 "summary": None
             }
         else:  # quiz state
             default_state = {
                 "topic": topic,
-                "messages": state.get("messages", []),
+                "messages": list(new_messages),
                 "summary": None
             }
         
         subgraph_state = default_state
     else:
         subgraph_state = state["subgraph_state"]
+        subgraph_state["messages"].extend(new_messages)
     subgraph_state["user_profile"] = state["user_profile"]
     
     # Determine routing
     next_step = route_to_subgraph(state)
     
     return {
-        **state,
+        "messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES)],  # Consumed into the subgraph history
         "next_step": next_step,  # Set next_step for routing
         "subgraph_state": subgraph_state,
     }
@@ -91,26 +114,35 @@ def route_to_subgraph(state: PrimaryState) -> str:
     else:  # session_type == "quiz"
         return "dud_entry"
 
-def summarize_and_route(state: PrimaryState) -> Dict[str, Any]:
-    """Analyzes the summary and determines the next session type, then presents the choice to the user."""
-    subgraph_state = state.get("subgraph_state", {})
-    summary = subgraph_state.get("summary", "")
-    
-    if not summary:
-        # No summary available, keep current session type
-        return {**state}
-    
+def build_routing_prompt(state: PrimaryState, summary: str) -> str:
+    """Build the prompt that asks the model where the student should go next."""
     if not state.get("squads_ready", False):
         # We have just completed a review and would like to determine whether to start lesson with new topic or repeat previous one
-        prompt = f"""
+        return f"""
         The student has taken a review session on {state.get("previous_topic", "Computer Fundamentals")}
         Based on the following summary of their performance, determine if they are ready to move on to the next lesson.
 
         Summary: {summary}
-
-        Respond with {state.get("user_topic")} if their performance is satisfactory, or with {state.get("previous_topic")} if not.
         """
-        decision = llm.invoke(prompt).content.strip().lower()
+    # Use LLM to determine if student needs a lesson or quiz based on the summary
+    return f"""
+        Based on the following summary of a student's performance, determine if they should:
+        1. Continue with another lesson (if they need more practice or teaching)
+        2. Take a quiz (if they seem ready to test their knowledge)
+        
+        Summary: {summary}
+        """
+
+def model_decision(state: PrimaryState, route) -> str:
+    """Map the routing model's structured answer onto the decision apply_routing_decision expects."""
+    if isinstance(route, ReviewRoute):
+        topic = state.get("user_topic") if route.ready else state.get("previous_topic", "Computer Fundamentals")
+        return topic.lower()
+    return route.decision
+
+def apply_routing_decision(state: PrimaryState, summary: str, decision: str) -> Dict[str, Any]:
+    """Turns the routing decision into the next-step recommendation presented to the user."""
+    if not state.get("squads_ready", False):
         new_session_type = "lesson"
         if decision.lower() == state.get("user_topic").lower():
             new_topic = state.get("user_topic")
@@ -119,19 +151,6 @@ def summarize_and_route(state: PrimaryState) -> Dict[str, Any]:
             new_topic = state.get("previous_topic", "Computer Fundamentals")
             recommendation = f"I recommend repeating the lesson for {new_topic}."
     else:
-        # Use LLM to determine if student needs a lesson or quiz based on the summary
-        prompt = f"""
-        Based on the following summary of a student's performance, determine if they should:
-        1. Continue with another lesson (if they need more practice or teaching)
-        2. Take a quiz (if they seem ready to test their knowledge)
-        
-        Summary: {summary}
-        
-        Respond with just one word: 'lesson' or 'quiz'.
-        """
-        
-        decision = llm.invoke(prompt).content.strip().lower()
-        
         # Default to opposite of current session type if decision is unclear
         current_session_type = state.get("session_type", "lesson")
         if decision not in ["lesson", "quiz"]:
@@ -171,7 +190,6 @@ def summarize_and_route(state: PrimaryState) -> Dict[str, Any]:
     
     # Return state with both the message for immediate display and the flag for user response handling
     return {
-        **state,
         "message": message,  # For direct display in UI
         "user_topic": new_topic,
         "squads_ready": True, # No need to do another review
@@ -181,58 +199,97 @@ def summarize_and_route(state: PrimaryState) -> Dict[str, Any]:
         "next_step": END  # End the workflow here to let UI take over
     }
 
-def cassie_entry(state: PrimaryState):
-    """Entry point for the lesson plan subgraph."""
-    # Ensure we have the proper state structure
-    if not state.get("subgraph_state"):
-        return state
+def summarize_and_route(state: PrimaryState) -> Dict[str, Any]:
+    """Analyzes the summary and determines the next session type, then presents the choice to the user."""
+    subgraph_state = state.get("subgraph_state", {})
+    summary = subgraph_state.get("summary", "")
     
-    # Invoke lesson graph
-    response = lesson_graph.invoke(state["subgraph_state"])
+    if not summary:
+        # No summary available, keep current session type
+        return {"next_step": None}
+    
+    decision = local_route(state, summary)
+    if decision is None:
+        router = review_router if not state.get("squads_ready", False) else session_router
+        with llm_priority(NEAR_INTERACTIVE):
+            decision = model_decision(state, router.invoke(build_routing_prompt(state, summary)))
+        logger.info("Routed by model: %s", decision)
+    else:
+        logger.info("Routed locally: %s", decision)
+    return apply_routing_decision(state, summary, decision)
+
+async def asummarize_and_route(state: PrimaryState) -> Dict[str, Any]:
+    """Async variant of summarize_and_route."""
+    subgraph_state = state.get("subgraph_state", {})
+    summary = subgraph_state.get("summary", "")
+    
+    if not summary:
+        return {"next_step": None}
     
-    # Check if we have a summary (lesson completed)
+    decision = local_route(state, summary)
+    if decision is None:
+        router = review_router if not state.get("squads_ready", False) else session_router
+        with llm_priority(NEAR_INTERACTIVE):
+            decision = model_decision(state, await router.ainvoke(build_routing_prompt(state, summary)))
+        logger.info("Routed by model: %s", decision)
+    else:
+        logger.info("Routed locally: %s", decision)
+    return apply_routing_decision(state, summary, decision)
+
+def subgraph_result(state: PrimaryState, response):
+    """Fold a finished subgraph turn back into the primary state."""
+    # Check if we have a summary (subgraph session completed)
     has_summary = response and "summary" in response and response["summary"] is not None
     
     # Set next step based on summary presence
     next_step = "summarize_and_route" if has_summary else None
     
     # Return updated state
-    return {**state, "subgraph_state": response, "next_step": next_step}
+    return {"subgraph_state": response, "next_step": next_step}
+
+def cassie_entry(state: PrimaryState):
+    """Entry point for the lesson plan subgraph."""
+    # Ensure we have the proper state structure
+    if not state.get("subgraph_state"):
+        return {"next_step": None}
+    
+    # Invoke lesson graph
+    return subgraph_result(state, lesson_graph.invoke(state["subgraph_state"]))
+
+async def acassie_entry(state: PrimaryState):
+    """Async variant of cassie_entry."""
+    if not state.get("subgraph_state"):
+        return {"next_step": None}
+    return subgraph_result(state, await lesson_graph.ainvoke(state["subgraph_state"]))
 
 def dud_entry(state: PrimaryState):
     """Entry point for the quiz subgraph."""
     # Ensure we have the proper state structure
     if not state.get("subgraph_state"):
-        return state
+        return {"next_step": None}
     
     # Invoke dud graph
-    response = dud_graph.invoke(state["subgraph_state"])
-    
-    # Check if we have a summary (quiz completed)
-    has_summary = response and "summary" in response and response["summary"] is not None
-    
-    # Set next step based on summary presence
-    next_step = "summarize_and_route" if has_summary else None
-    
-    # Return updated state
-    return {**state, "subgraph_state": response, "next_step": next_step}
+    return subgraph_result(state, dud_graph.invoke(state["subgraph_state"]))
+
+async def adud_entry(state: PrimaryState):
+    """Async variant of dud_entry."""
+    if not state.get("subgraph_state"):
+        return {"next_step": None}
+    return subgraph_result(state, await dud_graph.ainvoke(state["subgraph_state"]))
 
 def review_entry(state: PrimaryState):
     """Entry point for the review subgraph."""
     # Ensure we have the proper state structure
     if not state.get("subgraph_state"):
-        return state
+        return {"next_step": None}
     # Invoke review graph
-    response = review_graph.invoke(state["subgraph_state"])
-    
-    # Check if we have a summary (review completed)
-    has_summary = response and "summary" in response and response["summary"] is not None
-    
-    # Set next step based on summary presence
-    next_step = "summarize_and_route" if has_summary else None
-    
-    # Return updated state
-    return {**state, "subgraph_state": response, "next_step": next_step}
+    return subgraph_result(state, review_graph.invoke(state["subgraph_state"]))
+
+async def areview_entry(state: PrimaryState):
+    """Async variant of review_entry."""
+    if not state.get("subgraph_state"):
+        return {"next_step": None}
+    return subgraph_result(state, await review_graph.ainvoke(state["subgraph_state"]))
 
 # Function to determine next step
 def determine_next_step(state: PrimaryState):
@@ -242,15 +299,58 @@ def determine_next_step(state: PrimaryState):
         return END
     return next_step
 
+def load_session(config: dict) -> dict:
+    """Returns the student's saved session state, or an empty dict if they have none."""
+    return primary_graph.get_state(config).values
+
+def new_session_state(user_topic: str, previous_topic: str, session_type: str, squads_ready: bool, user_profile: dict) -> PrimaryState:
+    """The graph input that starts a fresh lesson or quiz session."""
+    state = {
+        "user_topic": user_topic,
+        "previous_topic": previous_topic,
+        "messages": [],
+        "session_type": session_type,
+        "squads_ready": squads_ready,
+        "subgraph_state": None,
+        "next_step": None,
+        "awaiting_user_choice": False,
+        "remaining_steps": 5,
+        "user_profile": user_profile
+    }
+    if session_type == "lesson":
+        state["subgraph_state"] = {
+            "topic": user_topic,
+            "messages": [],
+            "lesson_plan": None,
+            "summary": None
+        }
+    return state
+
+def speculate_session(state: PrimaryState, config: dict) -> Future:
+    """Start generating the opening turn of a session in the background.
+
+    Runs on the shared event loop without touching the student's checkpoint, so the result
+    can be handed over with adopt_session or simply dropped. Its model calls queue behind
+    turns students are waiting on.
+    """
+    async def speculate():
+        with llm_owner(config["configurable"]["thread_id"]), llm_priority(NEAR_INTERACTIVE):
+            return await speculative_graph.ainvoke(state)
+    return asyncio.run_coroutine_threadsafe(speculate(), get_event_loop())
+
+def adopt_session(config: dict, values: dict):
+    """Save a speculatively generated session as the student's current session."""
+    primary_graph.update_state(config, values, as_node="primary_assistant")
+
 # Create the graph
 primary_graph = StateGraph(PrimaryState)
 
 # Add nodes
 primary_graph.add_node("primary_assistant", primary_assistant)
-primary_graph.add_node("cassie_entry", cassie_entry)
-primary_graph.add_node("dud_entry", dud_entry)
-primary_graph.add_node("review_entry", review_entry)
-primary_graph.add_node("summarize_and_route", summarize_and_route)
+primary_graph.add_node("cassie_entry", RunnableLambda(cassie_entry, afunc=acassie_entry))
+primary_graph.add_node("dud_entry", RunnableLambda(dud_entry, afunc=adud_entry))
+primary_graph.add_node("review_entry", RunnableLambda(review_entry, afunc=areview_entry))
+primary_graph.add_node("summarize_and_route", RunnableLambda(summarize_and_route, afunc=asummarize_and_route))
 
 # Routing Logic
 primary_graph.add_edge(START, "primary_assistant")
@@ -260,5 +360,43 @@ primary_graph.add_conditional_edges("dud_entry", determine_next_step)
 primary_graph.add_conditional_edges("review_entry", determine_next_step)
 primary_graph.add_conditional_edges("summarize_and_route", determine_next_step)
 
-# Compile
-primary_graph = primary_graph.compile()
\ No newline at end of file
+# Speculative runs are throwaway until adopted, so they skip the checkpointer
+speculative_graph = primary_graph.compile()
+# Compile with the persistent checkpointer; subgraphs invoked from the entry nodes inherit it
+primary_graph = primary_graph.compile(checkpointer=get_checkpointer())
+
+# Subgraph nodes whose model output is shown to the student while it is generated
+STREAMING_NODES = {"chat", "chat_node"}
+
+def streamed_text(namespace, mode, chunk, final_state: dict):
+    """Pick the tutor's reply text out of one streamed graph event, capturing top-level state values."""
+    if mode == "values":
+        # Only the top-level graph values are the PrimaryState we hand back to the UI
+        if not namespace:
+            final_state.clear()
+            final_state.update(chunk)
+        return None
+    message, metadata = chunk
+    if isinstance(message, AIMessageChunk) and message.content and metadata.get("langgraph_node") in STREAMING_NODES:
+        return message.content
+    return None
+
+def stream_primary_graph(state: PrimaryState, final_state: dict, config: dict):
+    """Runs the primary graph, yielding the tutor's reply text as it is generated.
+
+    config carries the student's thread_id. The final graph state is written into
+    final_state once the run completes.
+    """
+    with llm_owner(config["configurable"]["thread_id"]):
+        for namespace, mode, chunk in primary_graph.stream(state, config, stream_mode=["messages", "values"], subgraphs=True):
+            text = streamed_text(namespace, mode, chunk, final_state)
+            if text:
+                yield text
+
+async def astream_primary_graph(state: PrimaryState, final_state: dict, config: dict):
+    """Async entry point for the UI: same as stream_primary_graph, driven on the shared event loop."""
+    with llm_owner(config["configurable"]["thread_id"]):
+        async for namespace, mode, chunk in primary_graph.astream(state, config, stream_mode=["messages", "values"], subgraphs=True):
+            text = streamed_text(namespace, mode, chunk, final_state)
+            if text:
+                yield text
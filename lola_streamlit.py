@@ -5,13 +5,65 @@ import re
 from datetime import datetime, timedelta
 from langchain_core.messages import AIMessage, HumanMessage
 
-from lola_graph import primary_graph
+from llm_clients import iterate_async
+from lola_graph import adopt_session, astream_primary_graph, load_session, new_session_state, speculate_session
 
 lola_avatar = utils.get_avatar_base64("assets/lola.png")
 
 def highlight_brackets(text, color="#F5CCF5"):
     return re.sub(r"\[(.*?)\]", rf"<span style='color: {color}; font-style: italic;'>[\1]</span>", text, flags=re.DOTALL)
 
+def run_graph_streaming(graph_input):
+    """Run the primary graph on the student's thread, rendering Lola's reply into the chat pane as it is generated.
+
+    Returns the final graph state and the text that was streamed (empty if nothing was streamed).
+    """
+    config = utils.student_thread_config(st.session_state.user_data)
+    new_state = {}
+    streamed_text = ""
+    placeholder = None
+    for chunk in iterate_async(astream_primary_graph(graph_input, new_state, config)):
+        if placeholder is None:
+            with st.chat_message("assistant", avatar=f"data:image/png;base64,{lola_avatar}"):
+                placeholder = st.empty()
+        streamed_text += chunk
+        placeholder.markdown(highlight_brackets(streamed_text), unsafe_allow_html=True)
+    return new_state, streamed_text
+
+def speculate_next_session(state):
+    """While the student decides, generate the opening turn of the recommended session in the background."""
+    discard_speculation()
+    if not state.get("awaiting_user_choice"):
+        return
+    graph_input = new_session_state(
+        state.get("user_topic", ""),
+        st.session_state.user_data.get('previous_topic', ""),
+        state.get("recommended_session_type", "lesson"),
+        True,  # The recommendation already accounts for the review
+        utils.graph_user_profile(st.session_state.user_data)
+    )
+    st.session_state.speculation = (graph_input, speculate_session(graph_input, utils.student_thread_config(st.session_state.user_data)))
+
+def discard_speculation():
+    speculation = st.session_state.pop("speculation", None)
+    if speculation:
+        speculation[1].cancel()
+
+def take_speculation(graph_input):
+    """The speculated session state for graph_input, or None if there is no usable speculation."""
+    speculation = st.session_state.pop("speculation", None)
+    if not speculation:
+        return None
+    speculated_input, future = speculation
+    if speculated_input != graph_input:
+        future.cancel()
+        return None
+    try:
+        # If it is still running, waiting for it is quicker than starting over
+        return future.result()
+    except Exception:
+        return None
+
 # Function to start a new session
 def start_new_session(nextTopic, previous_topic, session_type):
     # Reset state for new session
@@ -20,31 +72,17 @@ def start_new_session(nextTopic, previous_topic, session_type):
         with st.chat_message('assistant', avatar=f"data:image/png;base64,{lola_avatar}"):
             st.write(f"Uh-oh! Looks like your squads have fallen asleep! We'll have to wake them up with a review on {previous_topic}.")
     st.session_state.messages = []
-    st.session_state.state = {
-        "user_topic": nextTopic,
-        "previous_topic": previous_topic,
-        "messages": [],
-        "session_type": session_type,
-        "squads_ready": squads_ready,
-        "subgraph_state": None,
-        "next_step": None,
-        "remaining_steps": 5,
-        "user_profile": st.session_state.user_data
-    }
+    st.session_state.state = new_session_state(nextTopic, previous_topic, session_type, squads_ready, utils.graph_user_profile(st.session_state.user_data))
     
-    # Handle lesson sessions
-    if session_type == "lesson":     
-        # Prepare lesson state
-        lesson_state = {
-            "topic": nextTopic,
-            "messages": [],
-            "lesson_plan": None,
-            "summary": None
-        }
-        st.session_state.state["subgraph_state"] = lesson_state
-    # Update primary graph state with initial message and invoke it
-    new_state = primary_graph.invoke(st.session_state.state)
+    new_state = take_speculation(st.session_state.state)
+    if new_state:
+        # The opening turn was generated while the student was deciding
+        adopt_session(utils.student_thread_config(st.session_state.user_data), new_state)
+    else:
+        # Update primary graph state with initial message and stream the opening turn
+        new_state, _ = run_graph_streaming(st.session_state.state)
     st.session_state.state = new_state
+    st.session_state.state_saved = True
     
     # Preserve messages across graph calls
     if new_state.get("subgraph_state") and new_state["subgraph_state"].get("messages"):
@@ -125,17 +163,26 @@ def lola_main():
 
     if "messages" not in st.session_state:
         st.session_state.messages = []
-    if "state" not in st.session_state:
-        st.session_state.state = {
-            "user_topic": user_topic,
-            "previous_topic": previous_topic,
-            "messages": [],
-            "squads_ready": False,
-            "subgraph_state": None,
-            "session_type": "lesson",
-            "next_step": None,
-            "user_profile": st.session_state.user_data
-        }
+    if not st.session_state.get("state"):
+        # Resume the student's saved session if there is one
+        saved_state = load_session(utils.student_thread_config(st.session_state.user_data))
+        st.session_state.state_saved = bool(saved_state)
+        if saved_state:
+            st.session_state.state = saved_state
+            if saved_state.get("subgraph_state") and saved_state["subgraph_state"].get("messages"):
+                st.session_state.messages = utils.convert_to_streamlit_messages(saved_state["subgraph_state"]["messages"])
+            speculate_next_session(saved_state)
+        else:
+            st.session_state.state = {
+                "user_topic": user_topic,
+                "previous_topic": previous_topic,
+                "messages": [],
+                "squads_ready": False,
+                "subgraph_state": None,
+                "session_type": "lesson",
+                "next_step": None,
+                "user_profile": utils.graph_user_profile(st.session_state.user_data)
+            }
 
     with st.sidebar:
         st.header("Session Setup")
@@ -189,10 +236,12 @@ def lola_main():
                     
             elif "exit" in user_choice:
                 # User wants to exit; clear authentication status and user data
+                discard_speculation()
                 if "demo_user" in st.session_state:
                     del st.session_state.demo_user
                 st.session_state.user_data = {}
                 st.session_state.messages = []
+                st.session_state.state = None
                 utils.go_to_page("landing")
             else:
                 # User provided something else
@@ -203,38 +252,16 @@ def lola_main():
             # Important: Skip graph invocation when handling user choice
             st.rerun()
         
-        # Update state with user's message
-        current_state = st.session_state.state.copy()
-        
-        # Update subgraph state with the user's message
-        if current_state.get("subgraph_state") and current_state["subgraph_state"].get("messages"):
-            # If we have existing subgraph messages, append to them
-            current_messages = current_state["subgraph_state"]["messages"]
-            current_messages.append(HumanMessage(content=user_input))
-            current_state["subgraph_state"]["messages"] = current_messages
-            
-            # For quiz sessions, update user_answer
-            if current_state.get("session_type") == "quiz" and "awaiting_answer" in current_state["subgraph_state"]:
-                current_state["subgraph_state"]["user_answer"] = user_input
-        else:
-            # If we don't have messages yet, create them
-            if "subgraph_state" not in current_state or current_state["subgraph_state"] is None:
-                # Initialize subgraph state based on session type
-                if current_state.get("session_type") == "lesson":
-                    current_state["subgraph_state"] = {
-                        "topic": current_state.get("user_topic", ""),
-                        "messages": [HumanMessage(content=user_input)]
-                    }
-                else:  # quiz
-                    current_state["subgraph_state"] = {
-                        "topic": current_state.get("user_topic", ""),
-                        "messages": [HumanMessage(content=user_input)],
-                        "summary": None
-                    }
+        # Only the new message is sent; the rest of the session is loaded from the student's checkpoint
+        graph_input = {"messages": [HumanMessage(content=user_input)]}
+        if not st.session_state.get("state_saved"):
+            graph_input = {**st.session_state.state, **graph_input}
         
-        # Continue the graph with the user's input
-        new_state = primary_graph.invoke(current_state)
+        # Continue the graph with the user's input, streaming the reply as it arrives
+        new_state, streamed_text = run_graph_streaming(graph_input)
         st.session_state.state = new_state
+        st.session_state.state_saved = True
+        speculate_next_session(new_state)
         
         # Priority order for finding messages to display:
         # 1. Check direct message from state
@@ -248,8 +275,10 @@ def lola_main():
             latest_messages = new_state["subgraph_state"]["messages"]
             for msg in reversed(latest_messages):
                 if isinstance(msg, AIMessage) and msg.content not in [m["content"] for m in st.session_state.messages if m["role"] == "assistant"]:
-                    with st.chat_message("assistant", avatar=f"data:image/png;base64,{lola_avatar}"):
-                        st.write(msg.content)
+                    # Streamed replies are already on screen
+                    if not streamed_text:
+                        with st.chat_message("assistant", avatar=f"data:image/png;base64,{lola_avatar}"):
+                            st.write(msg.content)
                     st.session_state.messages.append({"role": "assistant", "content": msg.content})
                     break
         
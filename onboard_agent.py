@@ -1,24 +1,18 @@
-import json, re
+import os, re, threading
 
 from langchain_core.messages import AIMessage, SystemMessage, ToolMessage
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
+from langchain_core.runnables import RunnableLambda
+from langchain_core.tools import tool
 from langgraph.graph import END, MessagesState, StateGraph, START
+from pydantic import Field, create_model
 from typing import Optional
 
-from utils import OPENAI_API_KEY
-
-# Initialize LLM
-onboard_tools = []
-llm = ChatOpenAI(
-    temperature=0.7, 
-    model_name="gpt-4.1-mini", 
-    api_key = OPENAI_API_KEY
-)
+from llm_clients import task_model
 
 prompt_template = PromptTemplate.from_template("""{background_and_catalog}
 
-Go through all questions in the onboarding questionnaire. Start by asking the user's role (student or parent) and rephrase the questions accordingly. Use a friendly, conversational tone.
+Go through the onboarding questionnaire one section at a time; you are only shown the section the user is currently in. Start by asking the user's role (student or parent) and rephrase the questions accordingly. Use a friendly, conversational tone.
 Follow the instructions in the questionnaire for saving responses as variables.
 
 ---
@@ -54,38 +48,12 @@ Get answers to every question, but don't stick rigidly to the scripts. Try to ho
 
 Briefly recap the conclusion reached at the end of each section. 
 For instance, at end of "selecting a course", you can say "So, Introduction to Python is your best choice..."; at end of  "Setting goals", add "Gotcha, so our goal is ..." etc. 
-After all 5 sections in the questionnaire are discussed, summarize the main conclusions, especially the time commitment and schedules. These will be used to create student profile. 
+Save variables with the `record_profile_answers` tool as soon as the user's answers settle them, in the same reply as your next question; call it again if the user corrects a value.
+In Section 1, also save the user's role (student or parent) as "role". If a variable does not apply to this user (for example the AP CSA questions for a Python student), set it to "N/A".
+Once the user confirms your recap of a section, call `record_profile_answers` with section_confirmed set to true, after which you will be given the next section."""
+FINAL_SECTION_STEPS = """After all 5 sections in the questionnaire are discussed, summarize the main conclusions, especially the time commitment and schedules. These will be used to create student profile. 
 Ask if the user has more to discuss and if not, encourage him to start as early as possible.
-Finally, create a JSON object with all the collected variables and output it exactly like this format:
-{
-  "name": "value",
-  "pronoun": "value",
-  "yearOfBirth": "value",
-  "mathLevel": "value",
-  "previousCodingLanguage": "value",
-  "codingYears": "value",
-  "linesOfCodeCompleted": "value",
-  "courseSelected": "value",
-  "motivation": "value",
-  "interests": "value",
-  "codingRelatedInterests": "value",
-  "goal": "value",
-  "apComSciAInSchool": "value",
-  "APTestGoal": "value",
-  "hoursPerWeek": "value",
-  "timeZone": "value",
-  "weeklySchedule": "value",
-  "conceptFormingPreference": "value",
-  "problemSolvingApproach": "value",
-  "preferredReward": "value",
-  "preferredProjectType": "value",
-  "preferredQuestionFormat": "value",
-  "errorTolerance": "value",
-  "buildingStyle": "value",
-  "nextTopic": "value",
-  "lastLearnt": "value"
-}
-This JSON object will be automatically saved to the student_profile state variable. Ensure you gather info for all 26 variables before creating this JSON object."""
+Ensure you gather info for all 26 variables. Once the user approves the profile summary, call `record_profile_answers` with section_confirmed set to true."""
 OUTPUT_FORMAT = """### ✅ Format for Multiple Choice
 When asking a multiple choice question, always follow this format:
 
@@ -102,77 +70,166 @@ This formatting helps your front-end show buttons properly. (Note: Any option su
 
 class OnboardState(MessagesState):
     student_profile: Optional[dict] = None
+    current_section: int  # Questionnaire section the user is in
+    section_start: int  # Index of the first message sent to the model for the current section
+    collected: dict  # Profile variables filled so far
 
-def chat_node(state: OnboardState):
-    with open('questionnaire.txt', 'r') as questionnaire:
-        prompt = prompt_template.format(
-            background_and_catalog=BACKGROUND_AND_CATALOG,
-            conversation_steps=CONVERSATION_STEPS,
-            output_format=OUTPUT_FORMAT,
-            questionnaire=questionnaire.read())
-    system = SystemMessage(content=prompt)
-    messages = [system] + state.get("messages", [])
+# Variables each questionnaire section fills, in order. The 26 profile variables plus the user's role.
+SECTION_VARIABLES = {
+    1: ["role", "name", "pronoun", "yearOfBirth", "mathLevel", "previousCodingLanguage", "codingYears",
+        "linesOfCodeCompleted", "courseSelected"],
+    2: ["motivation"],
+    3: ["interests", "codingRelatedInterests", "goal", "apComSciAInSchool", "APTestGoal"],
+    4: ["hoursPerWeek", "timeZone", "weeklySchedule"],
+    5: ["conceptFormingPreference", "problemSolvingApproach", "preferredReward", "preferredProjectType",
+        "preferredQuestionFormat", "errorTolerance", "buildingStyle"],
+    6: ["nextTopic", "lastLearnt"],
+}
+# Left empty by the questionnaire unless the student opts for the diagnostic test
+OPTIONAL_VARIABLES = {"lastLearnt"}
+PROFILE_VARIABLES = [variable for section in SECTION_VARIABLES.values() for variable in section if variable != "role"]
+
+ProfileAnswers = create_model(
+    "ProfileAnswers",
+    **{variable: (Optional[str], None) for variables in SECTION_VARIABLES.values() for variable in variables},
+    section_confirmed=(bool, Field(False, description="True once the user has confirmed your recap of the current section"))
+)
+
+@tool(args_schema=ProfileAnswers)
+def record_profile_answers(**answers) -> str:
+    """Save questionnaire variables as soon as the user's answers settle them. Only pass the variables being set or corrected."""
+    return "Saved."
+
+# Initialize LLM
+onboard_tools = [record_profile_answers]
+llm = task_model("onboarding").bind_tools(onboard_tools)
+
+QUESTIONNAIRE_PATH = 'questionnaire.txt'
+SECTION_HEADER = re.compile(r'^(?:Section )?(\d+)\.\s')
+
+# Rendered per-section system prompts, rebuilt only when the questionnaire file changes on disk
+_system_prompt_cache = {"mtime": None, "sections": {}}
+_system_prompt_lock = threading.Lock()
+
+def parse_questionnaire(text: str) -> tuple[str, dict]:
+    """Split the questionnaire into its general instructions and the text of each numbered section."""
+    preamble, sections, current = [], {}, None
+    for line in text.splitlines():
+        match = SECTION_HEADER.match(line)
+        if match:
+            current = int(match.group(1))
+            sections[current] = []
+        if current is None:
+            preamble.append(line)
+        else:
+            sections[current].append(line)
+    return "\n".join(preamble), {number: "\n".join(lines) for number, lines in sections.items()}
+
+def render_system_prompt(section: int) -> SystemMessage:
+    """Render the onboarding system prompt for one questionnaire section."""
+    with open(QUESTIONNAIRE_PATH, 'r') as questionnaire:
+        preamble, sections = parse_questionnaire(questionnaire.read())
+    section_text = sections[section]
+    if section == max(sections):
+        section_text += "\n\n" + FINAL_SECTION_STEPS
+    prompt = prompt_template.format(
+        background_and_catalog=BACKGROUND_AND_CATALOG,
+        conversation_steps=CONVERSATION_STEPS,
+        output_format=OUTPUT_FORMAT,
+        questionnaire=f"{preamble}\n{section_text}")
+    return SystemMessage(content=prompt)
+
+def get_system_prompt(section: int) -> SystemMessage:
+    """Return the rendered prompt for a section, re-rendering if content editors changed the questionnaire."""
+    mtime = os.stat(QUESTIONNAIRE_PATH).st_mtime_ns
+    with _system_prompt_lock:
+        if _system_prompt_cache["mtime"] != mtime:
+            _system_prompt_cache["sections"] = {}
+            _system_prompt_cache["mtime"] = mtime
+        if section not in _system_prompt_cache["sections"]:
+            _system_prompt_cache["sections"][section] = render_system_prompt(section)
+        return _system_prompt_cache["sections"][section]
+
+def progress_message(state: OnboardState) -> SystemMessage:
+    """Compact summary of what has been collected so far, standing in for earlier sections' conversation."""
+    section = state.get("current_section") or 1
+    collected = state.get("collected") or {}
+    missing = unfilled_variables(collected, section)
+    collected_lines = "\n".join(f"- {variable}: {value}" for variable, value in collected.items()) or "- nothing yet"
+    return SystemMessage(content=f"""You are now in Section {section} of the questionnaire.
+Variables already collected:
+{collected_lines}
+Variables still needed in this section: {", ".join(missing) or "none"}""")
+
+def unfilled_variables(collected: dict, section: int) -> list:
+    """Variables of a section that still have to be collected before it is complete."""
+    return [variable for variable in SECTION_VARIABLES[section] if variable not in collected and variable not in OPTIONAL_VARIABLES]
 
-    response = llm.invoke(messages)
+def next_section(collected: dict) -> Optional[int]:
+    """First section that still has variables to fill, or None once the profile is complete."""
+    for section in SECTION_VARIABLES:
+        if unfilled_variables(collected, section):
+            return section
+    return None
 
+def build_prompt(state: OnboardState):
+    """Build the messages sent to the model: the active section, collected variables and this section's conversation."""
+    section = state.get("current_section") or 1
+    messages = state.get("messages", [])[state.get("section_start") or 0:]
+    return [get_system_prompt(section), progress_message(state)] + messages
+
+def chat_node(state: OnboardState):
+    response = llm.invoke(build_prompt(state))
+    state["messages"].append(response)
+    return state
+
+async def achat_node(state: OnboardState):
+    """Async variant of chat_node."""
+    response = await llm.ainvoke(build_prompt(state))
     state["messages"].append(response)
-    
-    # Check if the response contains JSON and update student_profile
-    if isinstance(response, AIMessage):
-        content = response.content
-        
-        # Try multiple patterns to find JSON
-        # Pattern 1: Look for JSON object with quotes
-        json_patterns = [
-            r'\{[^{}]*"[^{}]*"[^{}]*\}',  # Original pattern
-            r'\{[^{}]*"[^{}]*"[^{}]*"[^{}]*\}',  # More complex JSON
-            r'\{[^{}]*"[^{}]*"[^{}]*"[^{}]*"[^{}]*\}',  # Even more complex
-        ]
-        
-        profile_data = None
-        for pattern in json_patterns:
-            json_match = re.search(pattern, content, re.DOTALL)
-            if json_match:
-                try:
-                    json_str = json_match.group(0)
-                    profile_data = json.loads(json_str)
-                    break
-                except json.JSONDecodeError:
-                    continue
-        
-        # If no JSON found, try to extract key-value pairs manually
-        if not profile_data:
-            # Look for patterns like "name": "value" or name: value
-            key_value_pattern = r'"?([a-zA-Z_][a-zA-Z0-9_]*)"?\s*:\s*"([^"]*)"'
-            matches = re.findall(key_value_pattern, content)
-            if matches:
-                profile_data = {}
-                for key, value in matches:
-                    profile_data[key] = value
-        
-        # Check if this looks like a student profile and update state
-        if profile_data:
-            expected_keys = ["name", "pronoun", "grade", "math", "previousLanguage", "codeYears", 
-                           "linesCompleted", "course", "motivation", "interests", "relatedInterests", 
-                           "goal", "apcsaInSchool", "APTestGoal", "hoursPerWeek", "timeZone", 
-                           "daysOfWeek", "timeEachDay", "conceptForming", "problemSolving", 
-                           "reward", "projectType", "questionFormat", "errorTolerance", "buildingStyle",
-                           "nextTopic", "yearOfBirth", "mathLevel", "previousCodingLanguage", 
-                           "codingYears", "linesOfCodeCompleted", "courseSelected", "codingRelatedInterests",
-                           "apComSciAInSchool", "conceptFormingPreference", "problemSolvingApproach",
-                           "preferredReward", "preferredProjectType", "preferredQuestionFormat"]
-            
-            if any(key in profile_data for key in expected_keys):
-                state["student_profile"] = profile_data
     return state
 
+def missing_profile_variables(state: OnboardState) -> list:
+    """Profile variables that have not been collected yet, in questionnaire order."""
+    collected = state.get("collected") or {}
+    return [variable for variable in PROFILE_VARIABLES if variable not in collected]
+
+def record_profile_values(state: OnboardState, answers: dict, message_index: int):
+    """Merge recorded variables into the state and advance once the current section is confirmed.
+
+    message_index is the position of the message that recorded them, where the next section's
+    conversation starts if this call completes the current one.
+    """
+    values = {key: value for key, value in answers.items() if key in ProfileAnswers.model_fields and key != "section_confirmed" and value}
+    collected = state.get("collected") or {}
+    collected.update(values)
+    state["collected"] = collected
+    
+    section = state.get("current_section") or 1
+    if unfilled_variables(collected, section):
+        return
+    # The section is done once the user confirms the recap, or the conversation has clearly moved on
+    moved_on = any(variable not in SECTION_VARIABLES[section] for variable in values)
+    if not (answers.get("section_confirmed") or moved_on):
+        return
+    
+    section = next_section(collected)
+    if section is None:
+        # Every section is complete
+        state["student_profile"] = {variable: collected.get(variable, "") for variable in PROFILE_VARIABLES}
+    else:
+        state["current_section"] = section
+        state["section_start"] = message_index
+
 def tool_executor(state: OnboardState) -> OnboardState:
     """Process tool calls in the messages."""
     # Find the last message with tool calls
     last_message = None
-    for msg in reversed(state["messages"]):
+    for index in range(len(state["messages"]) - 1, -1, -1):
+        msg = state["messages"][index]
         if isinstance(msg, AIMessage) and hasattr(msg, "tool_calls") and msg.tool_calls:
             last_message = msg
+            last_message_index = index
             break
     
     if not last_message or not last_message.tool_calls:
@@ -204,8 +261,8 @@ def tool_executor(state: OnboardState) -> OnboardState:
                     tool_call_id=tool_id
                 )
                 state["messages"].append(tool_message)
-                if tool_name == "summarize_to_profile":
-                    state["student_profile"] = result
+                if tool_name == "record_profile_answers":
+                    record_profile_values(state, tool_args, last_message_index)
             else:
                 # Tool not found
                 tool_message = ToolMessage(
@@ -227,20 +284,30 @@ def tool_executor(state: OnboardState) -> OnboardState:
 
 def should_use_tools(state: OnboardState):
     """Check if the last message has tool calls."""
+    last_msg = state["messages"][-1]
+    if isinstance(last_msg, AIMessage) and last_msg.tool_calls:
+        return "tools"
     return END
 
+def after_tools(state: OnboardState):
+    """Return to the model only if the tool-calling message had nothing to say to the user."""
+    for msg in reversed(state["messages"]):
+        if isinstance(msg, AIMessage):
+            return END if msg.content else "chat"
+    return "chat"
+
 # Build the graph
 def build_graph():
     workflow = StateGraph(OnboardState)
     
     # Add nodes
-    workflow.add_node("chat", chat_node)
+    workflow.add_node("chat", RunnableLambda(chat_node, afunc=achat_node))
     workflow.add_node("tools", tool_executor)
     
     # Set up the edges
     workflow.add_edge(START, "chat")
     workflow.add_conditional_edges("chat", should_use_tools)
-    workflow.add_edge("tools", "chat")
+    workflow.add_conditional_edges("tools", after_tools)
 
     # Compile the graph
     return workflow.compile(name='Sally')
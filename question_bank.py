@@ -0,0 +1,123 @@
+import hashlib, json, logging, re
+import utils
+
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Question documents in the question_bank collection look like:
+# {
+#     "topic": "Arrays",
+#     "question": "What is the index of the first element of a Java array?",
+#     "options": ["0", "1", "-1", "It depends on the array"],
+#     "answer_index": 0,
+#     "explanation": "Java arrays are zero-indexed.",  # optional
+#     "concept": "indexing",  # optional, used to report strengths and weaknesses
+#     "hash": "..."  # content hash, unique per question
+# }
+QUESTION_BANK_COLLECTION = "question_bank"
+OPTION_LETTERS = "ABCDEF"
+OPTIONS_PER_QUESTION = 4
+
+# Instructions for generating questions, whether offline for the bank or for a single review
+GENERATION_INSTRUCTIONS = """You write multiple choice questions for 8th and 9th grade students in AP Computer Science.
+Write questions on the topic and lesson plan you are given. Each question has exactly four distinct options, one of which is correct.
+Reply with a JSON object of the form:
+{"questions": [{"question": "...", "options": ["...", "...", "...", "..."], "answer": "<the correct option, copied exactly>", "explanation": "<one or two sentences>", "concept": "<the concept tested, in a few words>"}]}"""
+
+CHOICE_PATTERN = re.compile(r"^\s*(?:option\s+|answer\s*:?\s*)?\(?([a-f])\)?[.):]?\s*$", re.IGNORECASE)
+
+def questions_collection(name: str = QUESTION_BANK_COLLECTION):
+    """The question bank collection on the shared, pooled MongoDB client, or None if MongoDB is unavailable.
+
+    Quizzes and reviews draw from the default collection; name selects another one, such as a scratch bank.
+    """
+    client = utils.get_mongodb_connection()
+    if client is None:
+        return None
+    return client[utils.MONGO_DB_NAME][name]
+
+def draw_questions(topic: str, count: int) -> List[dict]:
+    """Draw up to count random questions on a topic. Returns an empty list if the topic has no bank."""
+    collection = questions_collection()
+    if collection is None:
+        return []
+    try:
+        questions = list(collection.aggregate([
+            {"$match": {"topic": topic}},
+            {"$sample": {"size": count}},
+            {"$project": {"_id": 0, "question": 1, "options": 1, "answer_index": 1, "explanation": 1, "concept": 1}}
+        ]))
+    except Exception as e:
+        logger.warning("Could not load the question bank for %s: %s", topic, e)
+        return []
+    logger.info("Drew %d bank questions for %s", len(questions), topic)
+    return questions
+
+def format_question(question: dict, number: int) -> str:
+    """Render a question and its lettered options for the chat."""
+    options = "\n".join(f"{OPTION_LETTERS[i]}) {option}" for i, option in enumerate(question["options"]))
+    return f"**Question {number}:** {question['question']}\n\n{options}"
+
+def format_answer(question: dict) -> str:
+    """The correct option, as shown to the student."""
+    index = question["answer_index"]
+    return f"{OPTION_LETTERS[index]}) {question['options'][index]}"
+
+def parse_choice(text: str, question: dict) -> Optional[int]:
+    """The option the student picked, by letter or by its text, or None if the message is not an answer."""
+    match = CHOICE_PATTERN.match(text)
+    if match:
+        index = OPTION_LETTERS.index(match.group(1).upper())
+        return index if index < len(question["options"]) else None
+    normalized = text.strip().lower()
+    for index, option in enumerate(question["options"]):
+        if normalized == str(option).strip().lower():
+            return index
+    return None
+
+def normalize(text) -> str:
+    return " ".join(str(text).lower().split())
+
+def question_hash(topic: str, question: str, options: List[str]) -> str:
+    """Content hash that identifies a question regardless of option order, case or spacing."""
+    content = "\n".join([normalize(topic), normalize(question)] + sorted(normalize(option) for option in options))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def validate_question(topic: str, raw: dict) -> Optional[dict]:
+    """Turn a generated question into a bank document, or None if it fails validation.
+
+    A valid question has text, exactly four distinct options, and an answer that is exactly one of them.
+    """
+    question = str(raw.get("question") or "").strip()
+    options = [str(option).strip() for option in raw.get("options") or []]
+    answer = normalize(raw.get("answer") or "")
+    if not question or len(options) != OPTIONS_PER_QUESTION or not all(options):
+        return None
+    normalized_options = [normalize(option) for option in options]
+    if len(set(normalized_options)) != len(options) or normalized_options.count(answer) != 1:
+        return None
+    document = {
+        "topic": topic,
+        "question": question,
+        "options": options,
+        "answer_index": normalized_options.index(answer),
+        "hash": question_hash(topic, question, options)
+    }
+    for field in ("explanation", "concept"):
+        if raw.get(field):
+            document[field] = str(raw[field]).strip()
+    return document
+
+def parse_questions(topic: str, content: str) -> list:
+    """Validated bank documents from one model reply; malformed replies and invalid questions are dropped."""
+    try:
+        raw_questions = json.loads(content).get("questions", [])
+    except (ValueError, AttributeError):
+        logger.warning("%s: reply was not a JSON object", topic)
+        return []
+    documents = [validate_question(topic, raw) for raw in raw_questions if isinstance(raw, dict)]
+    valid = [document for document in documents if document]
+    if len(valid) < len(raw_questions):
+        logger.info("%s: dropped %d invalid questions", topic, len(raw_questions) - len(valid))
+    return valid
@@ -0,0 +1,133 @@
+import hashlib, logging, threading, time
+
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_COLLECTION = "response_cache"
+MEMORY_CACHE_SIZE = 2000
+
+def response_key(prompt: str, llm_string: str) -> str:
+    """Cache key for a model call: its model and parameters, plus the serialized messages with whitespace collapsed."""
+    return hashlib.sha256(f"{llm_string}\n{' '.join(prompt.split())}".encode()).hexdigest()
+
+class ResponseCache(BaseCache):
+    """Exact-match cache of chat model responses, for calls whose output is a pure function of their input.
+
+    Models opt in by being created with cache=response_cache (see llm_clients.task_model), which
+    LangChain consults before each call. Lookups go to an in-process LRU first, then to the
+    response_cache collection, whose entries MongoDB expires after the TTL. Each entry keeps the
+    latency of the call that produced it, so hits can report the time they saved.
+    """
+
+    def __init__(self, ttl_seconds: float, collection_provider=None, memory_size: int = MEMORY_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.collection_provider = collection_provider
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.pending = {}  # Start time of calls that missed, by key
+        self.lock = threading.Lock()
+        self.indexed = False
+        self.stats = {"memory_hits": 0, "mongo_hits": 0, "misses": 0, "saved_seconds": 0.0}
+
+    def collection(self):
+        """The persistent tier with its TTL index, or None if it is unavailable."""
+        if self.collection_provider is None:
+            return None
+        try:
+            collection = self.collection_provider()
+            if collection is not None and not self.indexed:
+                collection.create_index("expires_at", expireAfterSeconds=0)
+                self.indexed = True
+            return collection
+        except Exception as e:
+            logger.warning("Response cache collection unavailable: %s", e)
+            return None
+
+    def remember(self, key: str, generations: list, latency: float, expires: float):
+        with self.lock:
+            self.memory[key] = {"generations": generations, "latency": latency, "expires": expires}
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    def record_hit(self, tier: str, latency: float, started: float):
+        saved = max(latency - (time.monotonic() - started), 0.0)
+        with self.lock:
+            self.stats[f"{tier}_hits"] += 1
+            self.stats["saved_seconds"] += saved
+        logger.info("Response cache %s hit, ~%.2fs saved (hit rate %.0f%%)", tier, saved, 100 * self.report()["hit_rate"])
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        started = time.monotonic()
+        key = response_key(prompt, llm_string)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry["expires"] <= started:
+                del self.memory[key]
+                entry = None
+            if entry:
+                self.memory.move_to_end(key)
+        if entry:
+            self.record_hit("memory", entry["latency"], started)
+            return entry["generations"]
+
+        collection = self.collection()
+        if collection is not None:
+            try:
+                document = collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+            except Exception as e:
+                logger.warning("Response cache lookup failed: %s", e)
+                document = None
+            if document:
+                generations = [ChatGeneration(message=message) for message in messages_from_dict(document["messages"])]
+                remaining = (document["expires_at"].replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).total_seconds()
+                self.remember(key, generations, document["latency"], time.monotonic() + remaining)
+                self.record_hit("mongo", document["latency"], started)
+                return generations
+
+        with self.lock:
+            self.stats["misses"] += 1
+            self.pending[key] = started
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE):
+        key = response_key(prompt, llm_string)
+        with self.lock:
+            started = self.pending.pop(key, None)
+        latency = time.monotonic() - started if started is not None else 0.0
+        # Hits cost no tokens, so they should not report the original call's usage
+        return_val = [ChatGeneration(message=generation.message.model_copy(update={"usage_metadata": None})) for generation in return_val]
+        self.remember(key, return_val, latency, time.monotonic() + self.ttl_seconds)
+        collection = self.collection()
+        if collection is None:
+            return
+        try:
+            collection.replace_one({"_id": key}, {
+                "_id": key,
+                "messages": [message_to_dict(generation.message) for generation in return_val],
+                "latency": latency,
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+            }, upsert=True)
+        except Exception as e:
+            logger.warning("Could not persist cached response: %s", e)
+
+    def clear(self, **kwargs: Any):
+        with self.lock:
+            self.memory.clear()
+        collection = self.collection()
+        if collection is not None:
+            collection.delete_many({})
+
+    def report(self) -> dict:
+        """Hits per tier, misses, the hit rate and the model time saved by hits."""
+        with self.lock:
+            report = dict(self.stats)
+        lookups = report["memory_hits"] + report["mongo_hits"] + report["misses"]
+        report["hit_rate"] = (report["memory_hits"] + report["mongo_hits"]) / lookups if lookups else 0.0
+        return report
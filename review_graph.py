@@ -1,17 +1,19 @@
-from langchain_core.messages import AIMessage, SystemMessage
-from langchain_openai import ChatOpenAI
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
+from langgraph.constants import TAG_NOSTREAM
 from langgraph.graph import END, MessagesState, StateGraph, START
-from typing import Annotated
+from typing import Annotated, List, Optional, Tuple
 
-from utils import OPENAI_API_KEY
+from llm_clients import task_model
+from question_bank import GENERATION_INSTRUCTIONS, draw_questions, format_answer, format_question, parse_choice, parse_questions
 
 
-# Initialize LLM
-llm = ChatOpenAI(
-    temperature=0.7, 
-    model_name="gpt-4.1-mini", 
-    api_key = OPENAI_API_KEY
-)
+# Initialize LLMs: the review set is written by the larger model, answer feedback by a small fast one
+llm = task_model("review")
+feedback_llm = task_model("review_feedback")
+review_set_llm = task_model("review_set")
 
 # ------------------ Define State Structure ------------------
 
@@ -19,28 +21,157 @@ class ReviewState(MessagesState):
     """State for Review graph, extending MessagesState for message history management."""
     topic: Annotated[str, "The lesson topic"]
     summary: str
+    questions: Annotated[List[dict], "The review set; empty when the model runs the review"]
+    question_index: int
+    results: Annotated[List[dict], "Concept and outcome of each answered question"]
 
-def chat_node(state: ReviewState):
-    if not state.get("messages", []):
-        topic = state.get('topic', 'Computer Fundamentals')
-        prompt = f"""
+REVIEW_LENGTH = 10
+# Fewer correct answers than this and the student should repeat the lesson on the review topic
+REVIEW_PASS_MARK = 8
+
+# Instructions shared by every review, kept byte-stable so the provider can cache them as a prompt prefix
+REVIEW_INSTRUCTIONS = """
         You are a helpful teaching assistant. You are speaking to an 8th or 9th grade student in AP Computer Science.
-        Give the student 10 multiple choice questions, one at a time. {topic} is the topic the student has most recently studied.
-        Prioritize questions on {topic} but feel free to occasionally use recently covered topics that were recent.
+        Give the student 10 multiple choice questions, one at a time, on the review topic given below, which is the topic the student has most recently studied.
+        Prioritize questions on the review topic but feel free to occasionally use recently covered topics that were recent.
         Start by reminding the student that this is a necessary warm up/review before they can dive into the actual lesson.
         IMPORTANT: This is an interactive session. Wait for the student's response before proceeding.
         If the student answers the question, give feedback regardless of whether their answer is correct or incorrect.
         If the student asks for clarification regarding quiz question, answer it. Otherwise redirect them back to the quiz.
         When you end the quiz, generate a summary of the student's strengths and weaknesses with the header REVIEW SUMMARY in capital letters.
-        If they get fewer than 8 questions correct, recommend that the student repeat the lesson on {topic}.
+        If they get fewer than 8 questions correct, recommend that the student repeat the lesson on the review topic.
+        """
+
+# Instructions for the model's only job once the review set exists: answering clarifying questions
+CLARIFY_INSTRUCTIONS = """
+        You are a helpful teaching assistant. You are speaking to an 8th or 9th grade student in AP Computer Science who is taking a warm-up review.
+        You will be given the current multiple choice question, its answer key and the student's question about it.
+        Answer their question without giving away the correct answer, then ask them to pick an option.
         """
-        state["messages"].append(SystemMessage(content=prompt))
+
+def review_set_prompt(topic: str, count: int) -> list:
+    return [
+        SystemMessage(content=GENERATION_INSTRUCTIONS),
+        HumanMessage(content=f"Topic: {topic}\nThis is a warm-up review of the topic the student most recently studied. "
+                             f"Write {count} questions, mostly on this topic, occasionally on closely related earlier topics.")
+    ]
+
+def feedback_model():
+    """The model that explains answers, kept out of the streamed reply since the verdict and next question are added to its text."""
+    return feedback_llm.with_config(tags=[TAG_NOSTREAM])
+
+def review_set_model():
+    """The model that writes review sets as JSON, kept out of the tutor's streamed reply."""
+    return review_set_llm.bind(response_format={"type": "json_object"}).with_config(tags=[TAG_NOSTREAM])
+
+def review_set(state: ReviewState, bank_questions: List[dict], generated: Optional[AIMessage]) -> List[dict]:
+    """The review's questions: from the bank where possible, topped up with generated ones."""
+    questions = list(bank_questions)
+    if generated is not None:
+        questions += parse_questions(state.get('topic', 'Computer Fundamentals'), generated.content)
+    return questions[:REVIEW_LENGTH]
+
+def start_review(state: ReviewState, questions: List[dict]):
+    """Open a fresh review with its question set, or hand the whole review to the model if there is none."""
+    topic = state.get('topic', 'Computer Fundamentals')
+    state["questions"] = questions
+    state["question_index"] = 0
+    state["results"] = []
+    if questions:
+        state["messages"].append(AIMessage(content=f"Before we dive into today's lesson, let's warm up with a quick review of {topic}. "
+            f"This review is a necessary step before the lesson, so give each question your best shot! "
+            f"Reply with the letter of your answer.\n\n" + format_question(questions[0], 1)))
+    else:
+        state["messages"].append(SystemMessage(content=REVIEW_INSTRUCTIONS))
+        state["messages"].append(SystemMessage(content=f"Review topic: {topic}"))
+
+def review_summary(state: ReviewState) -> str:
+    """Summarize a review from its graded answers."""
+    results = state["results"]
+    correct = sum(result["correct"] for result in results)
+    strengths = sorted({result["concept"] for result in results if result["correct"] and result.get("concept")})
+    weaknesses = sorted({result["concept"] for result in results if not result["correct"] and result.get("concept")})
+    summary = f"\nThe student answered {correct} of {len(results)} review questions correctly ({correct}/{len(results)})."
+    if strengths:
+        summary += f"\nStrengths: {', '.join(strengths)}."
+    if weaknesses:
+        summary += f"\nNeeds more practice: {', '.join(weaknesses)}."
+    if correct < REVIEW_PASS_MARK * len(results) / REVIEW_LENGTH:
+        summary += f"\nI recommend repeating the lesson on {state.get('topic', 'Computer Fundamentals')}."
+    return summary
+
+def grade_answer(state: ReviewState) -> Tuple[str, Optional[list]]:
+    """Grade the student's latest message against the current review question.
+
+    Returns the outcome ("correct", "wrong" or "clarify") and, for clarifying questions, the
+    prompt for the model. Wrong answers are explained from the review set without a model call.
+    """
+    question = state["questions"][state["question_index"]]
+    text = state["messages"][-1].content
+    choice = parse_choice(text, question)
+    if choice is None:
+        return "clarify", [SystemMessage(content=CLARIFY_INSTRUCTIONS), HumanMessage(content=
+            f"Question: {format_question(question, state['question_index'] + 1)}\nCorrect answer: {format_answer(question)}\nThe student asked: {text}")]
+    correct = choice == question["answer_index"]
+    state["results"].append({"concept": question.get("concept"), "correct": correct})
+    state["question_index"] += 1
+    return ("correct" if correct else "wrong"), None
+
+def record_review_turn(state: ReviewState, outcome: str, clarification: str = ""):
+    """Reply to the student's latest message, then ask the next question or end the review."""
+    if outcome == "clarify":
+        state["messages"].append(AIMessage(content=clarification))
+        return
+    if outcome == "correct":
+        reply = "Correct!"
+    else:
+        question = state["questions"][state["question_index"] - 1]
+        reply = f"Not quite, the correct answer is {format_answer(question)}. {question.get('explanation', '')}".strip()
+    if state["question_index"] >= len(state["questions"]):
+        state["summary"] = review_summary(state)
+        reply += "\n\n## REVIEW SUMMARY" + state["summary"]
+    else:
+        reply += "\n\n" + format_question(state["questions"][state["question_index"]], state["question_index"] + 1)
+    state["messages"].append(AIMessage(content=reply))
+
+def record_response(state: ReviewState, response: AIMessage):
+    state["messages"].append(response)
+    if "review summary" in response.content.lower() and not state.get("summary", ""):
+        state["summary"] = response.content.split("REVIEW SUMMARY")[1]
+
+def chat_node(state: ReviewState):
+    if not state.get("messages", []):
+        topic = state.get('topic', 'Computer Fundamentals')
+        bank_questions = draw_questions(topic, REVIEW_LENGTH)
+        # One model call writes whatever the bank cannot supply
+        missing = REVIEW_LENGTH - len(bank_questions)
+        generated = review_set_model().invoke(review_set_prompt(topic, missing)) if missing else None
+        start_review(state, review_set(state, bank_questions, generated))
+    last_message = state["messages"][-1] if state["messages"] else None
+    if not isinstance(last_message, AIMessage):
+        if state.get("questions"):
+            outcome, prompt = grade_answer(state)
+            record_review_turn(state, outcome, feedback_model().invoke(prompt).content if prompt else "")
+        else:
+            record_response(state, llm.invoke(state["messages"]))
+    
+    return state
+
+async def achat_node(state: ReviewState):
+    """Async variant of chat_node."""
+    if not state.get("messages", []):
+        topic = state.get('topic', 'Computer Fundamentals')
+        bank_questions = await asyncio.to_thread(draw_questions, topic, REVIEW_LENGTH)
+        missing = REVIEW_LENGTH - len(bank_questions)
+        generated = await review_set_model().ainvoke(review_set_prompt(topic, missing)) if missing else None
+        start_review(state, review_set(state, bank_questions, generated))
     last_message = state["messages"][-1] if state["messages"] else None
     if not isinstance(last_message, AIMessage):
-        response = llm.invoke(state["messages"])
-        state["messages"].append(response)
-        if "review summary" in response.content.lower() and not state.get("summary", ""):
-            state["summary"] = response.content.split("REVIEW SUMMARY")[1]
+        if state.get("questions"):
+            outcome, prompt = grade_answer(state)
+            record_review_turn(state, outcome, (await feedback_model().ainvoke(prompt)).content if prompt else "")
+        else:
+            record_response(state, await llm.ainvoke(state["messages"]))
     
     return state
 
@@ -48,7 +179,7 @@ def build_graph():
     workflow = StateGraph(ReviewState)
 
     # Add nodes
-    workflow.add_node("chat_node", chat_node)
+    workflow.add_node("chat_node", RunnableLambda(chat_node, afunc=achat_node))
     workflow.add_edge(START, "chat_node")
     workflow.add_edge("chat_node", END)
 
@@ -0,0 +1,59 @@
+import re
+
+from typing import Optional, Tuple
+
+# Share of correct answers that counts as ready to move on, matching the review's "8 of 10" bar
+READY_ACCURACY = 0.8
+# Fewer graded answers than this is too little evidence to route on without the model
+MIN_GRADED_ANSWERS = 5
+
+SCORE_PATTERN = re.compile(r"\b(\d{1,2})\s*(?:/|out of)\s*(\d{1,2})\b", re.IGNORECASE)
+
+def summary_score(summary: str) -> Optional[Tuple[int, int]]:
+    """The (correct, total) score stated in a session summary, such as "7/10" or "7 out of 10"."""
+    for match in SCORE_PATTERN.finditer(summary or ""):
+        correct, total = int(match.group(1)), int(match.group(2))
+        if 0 < total and correct <= total:
+            return correct, total
+    return None
+
+def graded_answers(subgraph_state: dict) -> Tuple[int, int]:
+    """Count (correct, incorrect) answers from the outcomes a quiz or review recorded as it graded them."""
+    results = subgraph_state.get("results") or []
+    correct = sum(1 for result in results if result["correct"])
+    return correct, len(results) - correct
+
+def session_accuracy(summary: str, subgraph_state: dict) -> Optional[float]:
+    """Share of correct answers in a quiz or review, or None when there is too little evidence to judge.
+
+    Graded outcomes recorded by the session come first. Quizzes the model ran itself record none,
+    so their summary's stated score is used instead.
+    """
+    correct, incorrect = graded_answers(subgraph_state)
+    if correct + incorrect >= MIN_GRADED_ANSWERS:
+        return correct / (correct + incorrect)
+    score = summary_score(summary)
+    if score and score[1] >= MIN_GRADED_ANSWERS:
+        return score[0] / score[1]
+    return None
+
+def local_route(state: dict, summary: str) -> Optional[str]:
+    """Route the student without a model call, in the same terms as the routing model's answer.
+
+    After a review this is the topic to study next; after a quiz, 'quiz' when the student is
+    ready for more testing and 'lesson' when they need more teaching. Lessons grade nothing, so
+    they, like sessions with too little evidence to decide confidently, return None.
+    """
+    subgraph_state = state.get("subgraph_state") or {}
+    if not state.get("squads_ready", False):
+        accuracy = session_accuracy(summary, subgraph_state)
+        if accuracy is None:
+            return None
+        topic = state.get("user_topic") if accuracy >= READY_ACCURACY else state.get("previous_topic")
+        return topic.lower() if topic else None
+    if state.get("session_type", "lesson") != "quiz":
+        return None
+    accuracy = session_accuracy(summary, subgraph_state)
+    if accuracy is None:
+        return None
+    return "quiz" if accuracy >= READY_ACCURACY else "lesson"
@@ -0,0 +1,78 @@
+import logging, re, threading, time
+import numpy as np
+
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+def normalize_question(text: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation, so trivially different phrasings embed alike."""
+    return re.sub(r"[\s?!.]+$", "", " ".join(text.lower().split()))
+
+class SemanticCache:
+    """Answers keyed by question embedding, served for new questions that are near-duplicates of cached ones.
+
+    Similarity is the cosine between normalized embeddings. Entries expire after a TTL, and the
+    oldest entries are evicted once the cache is full.
+    """
+
+    def __init__(self, threshold: float, ttl_seconds: float, max_entries: int):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.entries = []
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, question: str, embedding: List[float]) -> Optional[str]:
+        """The cached answer to the most similar live question, if it is similar enough."""
+        query = unit_vector(embedding)
+        with self.lock:
+            self.expire()
+            if self.entries:
+                similarities = self.vectors @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    logger.info("Semantic cache hit (%.3f): %r ~ %r", similarities[best], question, self.entries[best]["question"])
+                    return self.entries[best]["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, question: str, embedding: List[float], answer: str):
+        vector = unit_vector(embedding)
+        with self.lock:
+            self.expire()
+            self.entries.append({"question": question, "answer": answer, "expires": time.monotonic() + self.ttl_seconds})
+            self.vectors = vector[None, :] if self.vectors is None else np.vstack([self.vectors, vector])
+            if len(self.entries) > self.max_entries:
+                self.entries = self.entries[1:]
+                self.vectors = self.vectors[1:]
+
+    def expire(self):
+        # Entries are stored in insertion order and share one TTL, so expired ones are a prefix
+        now = time.monotonic()
+        expired = 0
+        while expired < len(self.entries) and self.entries[expired]["expires"] <= now:
+            expired += 1
+        if expired:
+            self.entries = self.entries[expired:]
+            self.vectors = self.vectors[expired:]
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = []
+            self.vectors = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+def unit_vector(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
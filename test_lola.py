@@ -1,9 +1,61 @@
+import json
+import os
+import tempfile
 import unittest
-from unittest.mock import patch
-from langgraph.graph import StateGraph
-from lola_graph import primary_graph, route_to_subgraph, PrimaryState
-from cassie_graph import lesson_graph, LessonState
-from dud_graph import dud_graph, DudState
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableLambda
+from langchain_openai import ChatOpenAI
+from langgraph.graph import END
+
+import csa_rag_agent
+import generate_question_bank
+import llm_clients
+from bm25_index import BM25Index, reciprocal_rank_fusion, tokenize
+from cassie_graph import lesson_graph
+from chat_history import BoundedChatHistory
+from compaction import compact_state, compacted_history, fold_boundary
+from context_budget import approximate_tokens, budget_chunks, budget_history, dedupe_chunks, truncate_to_tokens
+from dud_graph import dud_graph
+from embedding_cache import CachedEmbeddings
+from generate_question_bank import fake_question_model, fill_question_bank
+from ingest_documents import ingest
+from llm_clients import iterate_async, run_async
+from llm_gateway import (
+    BACKGROUND, GatewayMetrics, GatewayTransport, PriorityScheduler, RateLimiter, TokenBucket, llm_owner, llm_priority
+)
+from local_vector_store import LocalVectorStore
+from lola_graph import (
+    primary_graph, route_to_subgraph, stream_primary_graph, astream_primary_graph, load_session,
+    adopt_session, new_session_state, speculate_session, summarize_and_route
+)
+from onboard_agent import (
+    PROFILE_VARIABLES, SECTION_VARIABLES, after_tools, build_prompt as build_onboard_prompt,
+    missing_profile_variables, tool_executor
+)
+from question_bank import parse_choice, validate_question
+from response_cache import ResponseCache
+from review_graph import review_graph
+from routing import graded_answers, local_route
+from semantic_cache import SemanticCache, normalize_question
+from tools import LessonPlanCache, fetch_lesson_plan, lesson_plan_cache
+
+def quiz_state():
+    """A primary graph state at the start of a quiz on Arrays."""
+    return {
+        "messages": [],
+        "user_topic": "Arrays",
+        "session_type": "quiz",
+        "squads_ready": True,
+        "subgraph_state": {"topic": "Arrays", "messages": [], "summary": None},
+        "user_profile": {"name": "Sam"},
+    }
 
 class TestSubgraphRouting(unittest.TestCase):
     """Tests for primary assistant routing logic"""
@@ -102,5 +154,936 @@ class TestSubgraphRouting(unittest.TestCase):
         next_step = route_to_subgraph(state)
         self.assertEqual(next_step, "cassie_entry")
 
+class TestStreaming(unittest.TestCase):
+    """Tests for streaming the tutor's reply out of the primary graph"""
+
+    def config(self, thread):
+        return {"configurable": {"thread_id": f"test-streaming-{thread}"}}
+
+    def test_stream_yields_chunks_and_final_state(self):
+        """Chunks from the quiz chat node are streamed and the reply is committed to subgraph_state."""
+        fake_llm = GenericFakeChatModel(messages=iter([AIMessage(content="What is an array index?")]))
+        final_state = {}
+        with patch("dud_graph.llm", fake_llm), patch("dud_graph.opening_llm", fake_llm):
+            chunks = list(stream_primary_graph(quiz_state(), final_state, self.config("sync")))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), "What is an array index?")
+        self.assertEqual(final_state["subgraph_state"]["messages"][-1].content, "What is an array index?")
+
+    def test_async_stream_on_shared_loop(self):
+        """The async entry point streams the same way when driven from a sync caller."""
+        fake_llm = GenericFakeChatModel(messages=iter([AIMessage(content="What is an array index?")]))
+        final_state = {}
+        with patch("dud_graph.llm", fake_llm), patch("dud_graph.opening_llm", fake_llm):
+            chunks = list(iterate_async(astream_primary_graph(quiz_state(), final_state, self.config("async"))))
+
+        self.assertEqual("".join(chunks), "What is an array index?")
+        self.assertEqual(final_state["subgraph_state"]["messages"][-1].content, "What is an array index?")
+
+class TestCheckpointedSession(unittest.TestCase):
+    """Tests for resuming a student's session from the checkpointer"""
+
+    def test_turn_sends_only_new_message(self):
+        """A follow-up turn only carries the new message and continues the saved quiz history."""
+        config = {"configurable": {"thread_id": "test-checkpointed-session"}}
+        fake_llm = GenericFakeChatModel(messages=iter([
+            AIMessage(content="Question 1: What does int store?"),
+            AIMessage(content="Correct! Question 2: What does String store?"),
+        ]))
+        with patch("dud_graph.llm", fake_llm), patch("dud_graph.opening_llm", fake_llm):
+            primary_graph.invoke(quiz_state(), config)
+            state = primary_graph.invoke({"messages": [HumanMessage(content="Whole numbers")]}, config)
+
+        contents = [message.content for message in state["subgraph_state"]["messages"]]
+        self.assertEqual(contents[-3:], ["Question 1: What does int store?", "Whole numbers", "Correct! Question 2: What does String store?"])
+        self.assertEqual(state["messages"], [])
+        self.assertEqual(load_session(config)["subgraph_state"]["messages"][-1].content, contents[-1])
+
+    def test_speculated_session_is_adopted(self):
+        """A speculatively generated opening turn only reaches the student's thread once adopted."""
+        config = {"configurable": {"thread_id": "test-speculated-session"}}
+        fake_llm = GenericFakeChatModel(messages=iter([
+            AIMessage(content="Question 1: What does int store?"),
+            AIMessage(content="Correct! Question 2: What does String store?"),
+        ]))
+        with patch("dud_graph.llm", fake_llm), patch("dud_graph.opening_llm", fake_llm):
+            values = speculate_session(new_session_state("Arrays", "Loops", "quiz", True, {"name": "Sam"}), config).result()
+            self.assertEqual(load_session(config), {})
+
+            adopt_session(config, values)
+            self.assertEqual(load_session(config)["subgraph_state"]["messages"][-1].content, "Question 1: What does int store?")
+            state = primary_graph.invoke({"messages": [HumanMessage(content="Whole numbers")]}, config)
+
+        self.assertEqual(state["subgraph_state"]["messages"][-1].content, "Correct! Question 2: What does String store?")
+
+class TestCompaction(unittest.TestCase):
+    """Tests for rolling context compaction of long lessons"""
+
+    def lesson_messages(self, turns):
+        messages = [SystemMessage(content="instructions"), AIMessage(content="Welcome!")]
+        for i in range(turns):
+            messages.append(HumanMessage(content=f"answer {i}"))
+            messages.append(AIMessage(content=f"reply {i}"))
+        return messages
+
+    def test_short_lesson_is_not_folded(self):
+        """Nothing is folded until enough turns have left the verbatim window."""
+        messages = self.lesson_messages(8)
+        self.assertEqual(fold_boundary(messages, 0, keep_turns=6, fold_turns=4), 1)
+
+    def test_old_turns_are_folded(self):
+        """Turns older than the verbatim window are folded once enough accumulate."""
+        messages = self.lesson_messages(12)
+        boundary = fold_boundary(messages, 0, keep_turns=6, fold_turns=4)
+        self.assertEqual(sum(isinstance(m, HumanMessage) for m in messages[boundary:]), 6)
+        self.assertIsInstance(messages[boundary], HumanMessage)
+
+    def test_boundary_keeps_tool_call_pairs(self):
+        """A tool call is never folded away from its pending ToolMessage."""
+        messages = self.lesson_messages(10)
+        boundary = fold_boundary(messages, 0, keep_turns=6, fold_turns=4)
+        # Leave the tool call made just before the boundary unanswered until after it
+        messages.insert(boundary, AIMessage(content="", tool_calls=[{"name": "fetch_lesson_plan", "args": {"topic": "Arrays"}, "id": "call_1"}]))
+        messages.insert(boundary + 2, ToolMessage(content="plan", name="fetch_lesson_plan", tool_call_id="call_1"))
+        self.assertLess(fold_boundary(messages, 0, keep_turns=6, fold_turns=1), boundary)
+
+    def test_prompt_uses_summary(self):
+        """The compacted prompt keeps system messages, adds the summary and drops folded turns."""
+        state = {"messages": self.lesson_messages(12)}
+        fake_summarizer = GenericFakeChatModel(messages=iter([AIMessage(content="Covered answers 0-5.")]))
+        with patch("compaction.summarizer", fake_summarizer):
+            compact_state(state, keep_turns=6, fold_turns=4)
+        history = compacted_history(state, "test")
+
+        self.assertEqual(history[0].content, "instructions")
+        self.assertIn("Covered answers 0-5.", history[1].content)
+        self.assertEqual(history[2:], state["messages"][state["summarized_count"]:])
+        self.assertEqual(sum(isinstance(m, HumanMessage) for m in history), 6)
+
+    def test_summary_is_not_streamed(self):
+        """Folding turns mid-lesson streams only the tutor's reply, not the running summary."""
+        messages = [AIMessage(content="Welcome!")]
+        for i in range(11):
+            messages += [HumanMessage(content=f"answer {i}"), AIMessage(content=f"reply {i}")]
+        state = {
+            "messages": [HumanMessage(content="answer 11")], "user_topic": "Arrays", "session_type": "lesson", "squads_ready": True,
+            "subgraph_state": {"topic": "Arrays", "messages": messages, "lesson_plan": None, "summary": None},
+            "user_profile": {"name": "Sam"},
+        }
+        final_state = {}
+        with patch("compaction.summarizer", GenericFakeChatModel(messages=iter([AIMessage(content="SECRET SUMMARY TEXT")]))), \
+                patch("cassie_graph.llm", GenericFakeChatModel(messages=iter([AIMessage(content="Lesson reply")]))):
+            chunks = list(stream_primary_graph(state, final_state, {"configurable": {"thread_id": "test-compaction-stream"}}))
+
+        self.assertEqual("".join(chunks), "Lesson reply")
+        self.assertEqual(final_state["subgraph_state"]["context_summary"], "SECRET SUMMARY TEXT")
+
+class TestOnboardingSections(unittest.TestCase):
+    """Tests for the section-scoped onboarding state machine"""
+
+    def record(self, state, call_id, content="", **answers):
+        """Append a record_profile_answers call and run it through the tools node."""
+        response = AIMessage(content=content, tool_calls=[{"name": "record_profile_answers", "args": answers, "id": call_id}])
+        state["messages"].append(response)
+        tool_executor(state)
+        return response
+
+    def test_answers_are_saved_as_they_are_given(self):
+        """Each answer is recorded straight away, without waiting for the section recap."""
+        state = {"messages": [HumanMessage(content="I'm Sam, a student")]}
+        self.record(state, "call-1", "Nice to meet you Sam! Which course?", name="Sam", role="student")
+
+        self.assertEqual(state["collected"], {"name": "Sam", "role": "student"})
+        self.assertEqual(state["messages"][-1].content, "Saved.")
+        self.assertEqual(after_tools(state), END)
+        self.assertIn("name", SECTION_VARIABLES[1])
+        self.assertNotIn("name", missing_profile_variables(state))
+        self.assertEqual(len(missing_profile_variables(state)), 25)
+
+    def test_section_advances_when_variables_are_confirmed(self):
+        """Confirming a section's variables moves on and trims the prompt to the new section."""
+        state = {"messages": [HumanMessage(content="I'm a student"), AIMessage(content="Great! What's your name?")]}
+        section_one = {variable: "value" for variable in SECTION_VARIABLES[1]}
+        self.record(state, "call-1", **section_one)
+        self.assertEqual(state.get("current_section") or 1, 1)
+
+        state["messages"].append(HumanMessage(content="Yes, that's right"))
+        recap = self.record(state, "call-2", section_confirmed=True)
+        self.assertEqual(state["current_section"], 2)
+        self.assertIsNone(state.get("student_profile"))
+        self.assertEqual(after_tools(state), "chat")
+        prompt = build_onboard_prompt(state)
+        self.assertIn("Section 2. Understand Students' Motivations", prompt[0].content)
+        self.assertNotIn("1.1 Please tell me your first name", prompt[0].content)
+        self.assertIn("- courseSelected: value", prompt[1].content)
+        self.assertEqual(prompt[2], recap)
+        self.assertIsInstance(prompt[3], ToolMessage)
+
+    def test_profile_is_complete_after_last_section(self):
+        """The student profile is only saved once all 26 variables are collected."""
+        state = {"messages": []}
+        for section, variables in SECTION_VARIABLES.items():
+            self.record(state, f"call-{section}", section_confirmed=True, **{variable: f"{variable} value" for variable in variables})
+
+        self.assertEqual(list(state["student_profile"]), PROFILE_VARIABLES)
+        self.assertEqual(len(state["student_profile"]), 26)
+
+    def test_profile_completes_with_blank_last_learnt(self):
+        """lastLearnt is left empty unless the student picks the diagnostic test, and that does not hold up the profile."""
+        state = {"messages": []}
+        for section in range(1, 6):
+            self.record(state, f"call-{section}", section_confirmed=True,
+                        **{variable: f"{variable} value" for variable in SECTION_VARIABLES[section]})
+        self.assertEqual(state["current_section"], 6)
+        self.assertIn("Variables still needed in this section: nextTopic\n", build_onboard_prompt(state)[1].content + "\n")
+
+        self.record(state, "call-6", section_confirmed=True, nextTopic="Computer Fundamentals", lastLearnt="")
+        self.assertEqual(state["student_profile"]["nextTopic"], "Computer Fundamentals")
+        self.assertEqual(state["student_profile"]["lastLearnt"], "")
+        self.assertEqual(list(state["student_profile"]), PROFILE_VARIABLES)
+
+class TestLessonPlanCache(unittest.TestCase):
+    """Tests for the in-process lesson template cache"""
+
+    def setUp(self):
+        lesson_plan_cache.invalidate()
+
+    def test_template_is_fetched_once(self):
+        """Repeated lookups of a topic are served from the cache until it is invalidated."""
+        with patch("tools.lesson_templates_collection") as collection:
+            collection.return_value.find_one.return_value = {"topic_name": "Arrays", "template": "Arrays plan"}
+            self.assertEqual(fetch_lesson_plan.invoke({"topic": "Arrays"}), "Arrays plan")
+            self.assertEqual(fetch_lesson_plan.invoke({"topic": "Arrays"}), "Arrays plan")
+            self.assertEqual(collection.return_value.find_one.call_count, 1)
+
+            lesson_plan_cache.invalidate("Arrays")
+            fetch_lesson_plan.invoke({"topic": "Arrays"})
+            self.assertEqual(collection.return_value.find_one.call_count, 2)
+
+    def test_entries_expire_and_evict(self):
+        """Entries expire after the TTL and the least recently used topic is evicted first."""
+        cache = LessonPlanCache(ttl_seconds=60, max_size=2)
+        with patch("tools.time.monotonic", return_value=0):
+            cache.put("Arrays", "a")
+            cache.put("Loops", "l")
+            cache.get("Arrays")
+            cache.put("Strings", "s")
+            self.assertIsNone(cache.get("Loops"))
+            self.assertEqual(cache.get("Arrays"), "a")
+        with patch("tools.time.monotonic", return_value=61):
+            self.assertIsNone(cache.get("Arrays"))
+
+class TestLocalRouting(unittest.TestCase):
+    """Tests for routing between sessions without a model call"""
+
+    def review_state(self, summary, results=()):
+        return {
+            "user_topic": "Arrays",
+            "previous_topic": "Loops",
+            "squads_ready": False,
+            "subgraph_state": {"topic": "Loops", "messages": [], "summary": summary, "results": list(results)},
+        }
+
+    def quiz_state(self, summary, results=()):
+        return {"user_topic": "Arrays", "squads_ready": True, "session_type": "quiz",
+                "subgraph_state": {"topic": "Arrays", "messages": [], "summary": summary, "results": list(results)}}
+
+    def test_review_score_in_summary(self):
+        """A stated review score is held against the 8 of 10 bar."""
+        self.assertEqual(local_route(self.review_state("You got 9 out of 10 right."), "You got 9 out of 10 right."), "arrays")
+        self.assertEqual(local_route(self.review_state("Score: 6/10"), "Score: 6/10"), "loops")
+
+    def test_recorded_outcomes_are_counted(self):
+        """Without a stated score, the outcomes the session recorded for each answer are counted instead."""
+        results = [{"concept": "indexing", "correct": correct} for correct in [True, False, True, True, True, True]]
+        self.assertEqual(graded_answers({"results": results}), (5, 1))
+        self.assertEqual(local_route(self.review_state("Good work", results), "Good work"), "arrays")
+
+    def test_lesson_prose_is_not_counted(self):
+        """A lesson records no graded outcomes, so its wording and any numbers in it are left to the model."""
+        messages = []
+        for reply in ["Correct! Arrays start at index 0.", "That's right, 3/4 of the elements are copied."] * 3:
+            messages += [HumanMessage(content="Why?"), AIMessage(content=reply)]
+        state = {"user_topic": "Arrays", "squads_ready": True, "session_type": "lesson",
+                 "subgraph_state": {"topic": "Arrays", "messages": messages, "summary": "Covered 9/10 of the lesson plan"}}
+        self.assertEqual(graded_answers(state["subgraph_state"]), (0, 0))
+        self.assertIsNone(local_route(state, "Covered 9/10 of the lesson plan"))
+
+    def test_low_evidence_falls_back_to_model(self):
+        """Too few graded answers leaves the decision to the routing model."""
+        state = self.review_state("Good effort", [{"concept": "indexing", "correct": True}])
+        self.assertIsNone(local_route(state, "Good effort"))
+
+        state = self.quiz_state("Good effort", [{"concept": "indexing", "correct": True}])
+        with patch("lola_graph.session_router") as router:
+            router.invoke.return_value.decision = "lesson"
+            result = summarize_and_route(state)
+        router.invoke.assert_called_once()
+        self.assertEqual(result["recommended_session_type"], "lesson")
+
+    def test_quiz_routes_on_score(self):
+        """A finished quiz routes on its score: an aced quiz is not sent back to lessons."""
+        with patch("lola_graph.session_router") as router:
+            aced = summarize_and_route(self.quiz_state("Answered 5 of 5 (5/5)", [{"concept": "indexing", "correct": True}] * 5))
+            struggled = summarize_and_route(self.quiz_state("Answered 2 of 5 (2/5)"))
+        router.invoke.assert_not_called()
+        self.assertEqual(aced["recommended_session_type"], "quiz")
+        self.assertNotIn("continuing with more lessons", aced["message"])
+        self.assertEqual(struggled["recommended_session_type"], "lesson")
+
+class TestQuestionBankQuiz(unittest.TestCase):
+    """Tests for quizzes served and graded from the question bank"""
+
+    def bank(self, count):
+        return [{"question": f"Question {i}?", "options": ["right", "wrong", "also wrong", "nope"],
+                 "answer_index": 0, "concept": f"concept {i}"} for i in range(count)]
+
+    def answer(self, state, text):
+        state["messages"].append(HumanMessage(content=text))
+        return dud_graph.invoke(state)
+
+    def test_correct_answers_need_no_model_call(self):
+        """Correct answers are graded locally and the quiz ends after enough of them."""
+        fake_llm = GenericFakeChatModel(messages=iter([]))
+        with patch("dud_graph.draw_questions", return_value=self.bank(20)), patch("dud_graph.feedback_llm", fake_llm):
+            state = dud_graph.invoke({"topic": "Arrays", "messages": []})
+            self.assertIn("**Question 1:** Question 0?", state["messages"][-1].content)
+            for i in range(15):
+                state = self.answer(state, "a")
+                if i < 14:
+                    self.assertIn(f"**Question {i + 2}:**", state["messages"][-1].content)
+
+        self.assertIn("QUIZ SUMMARY", state["messages"][-1].content)
+        self.assertIn("15/15", state["summary"])
+
+    def test_wrong_answers_are_explained_and_end_the_quiz(self):
+        """Wrong answers get a model explanation, clarifications do not advance, and three wrong answers end the quiz."""
+        fake_llm = GenericFakeChatModel(messages=iter([
+            AIMessage(content="Arrays start at zero."),
+            AIMessage(content="It asks where counting starts."),
+            AIMessage(content="Remember zero."),
+            AIMessage(content="Zero again."),
+        ]))
+        with patch("dud_graph.draw_questions", return_value=self.bank(20)), patch("dud_graph.feedback_llm", fake_llm):
+            state = dud_graph.invoke({"topic": "Arrays", "messages": []})
+            state = self.answer(state, "B")
+            self.assertIn("Not quite, the correct answer is A) right. Arrays start at zero.", state["messages"][-1].content)
+            state = self.answer(state, "What does this question mean?")
+            self.assertEqual(state["messages"][-1].content, "It asks where counting starts.")
+            self.assertEqual(state["question_index"], 1)
+            state = self.answer(state, "wrong")
+            state = self.answer(state, "c)")
+
+        self.assertIn("QUIZ SUMMARY", state["messages"][-1].content)
+        self.assertIn("0/3", state["summary"])
+        self.assertIn("Needs more practice: concept 0, concept 1, concept 2", state["summary"])
+
+    def test_feedback_is_not_streamed(self):
+        """The explanation alone is not streamed, so the UI shows the whole reply with verdict and next question."""
+        fake_llm = GenericFakeChatModel(messages=iter([AIMessage(content="Arrays start at zero.")]))
+        final_state = {}
+        with patch("dud_graph.draw_questions", return_value=self.bank(20)), patch("dud_graph.feedback_llm", fake_llm):
+            state = {**quiz_state(), "subgraph_state": dud_graph.invoke({"topic": "Arrays", "messages": []}),
+                     "messages": [HumanMessage(content="B")]}
+            chunks = list(stream_primary_graph(state, final_state, {"configurable": {"thread_id": "test-quiz-feedback-stream"}}))
+
+        self.assertEqual(chunks, [])
+        reply = final_state["subgraph_state"]["messages"][-1].content
+        self.assertIn("Not quite, the correct answer is A) right. Arrays start at zero.", reply)
+        self.assertIn("**Question 2:**", reply)
+
+    def test_parse_choice(self):
+        """Answers are recognized by letter or by option text."""
+        question = self.bank(1)[0]
+        self.assertEqual(parse_choice("b", question), 1)
+        self.assertEqual(parse_choice("(C)", question), 2)
+        self.assertEqual(parse_choice("Nope", question), 3)
+        self.assertIsNone(parse_choice("E", question))
+        self.assertIsNone(parse_choice("a bit confused", question))
+
+class TestBatchReview(unittest.TestCase):
+    """Tests for reviews whose question set is generated once up front"""
+
+    def review_set(self):
+        return AIMessage(content=json.dumps({"questions": [
+            {"question": f"Review {i}?", "options": ["yes", "no", "maybe", "never"], "answer": "yes",
+             "explanation": "Because yes.", "concept": f"concept {i}"} for i in range(10)
+        ]}))
+
+    def test_review_uses_one_model_call(self):
+        """The review set is generated once and every answer is graded without the model."""
+        fake_llm = GenericFakeChatModel(messages=iter([self.review_set()]))
+        final_state = {}
+        state = {**quiz_state(), "squads_ready": False, "previous_topic": "Loops", "subgraph_state": None}
+        with patch("review_graph.draw_questions", return_value=[]), patch("review_graph.review_set_llm", fake_llm):
+            chunks = list(stream_primary_graph(state, final_state, {"configurable": {"thread_id": "test-batch-review"}}))
+            review = final_state["subgraph_state"]
+            self.assertEqual(chunks, [])
+            self.assertIn("**Question 1:** Review 0?", review["messages"][-1].content)
+            for answer in ["a"] * 7 + ["b"] * 3:
+                review["messages"].append(HumanMessage(content=answer))
+                review = review_graph.invoke(review)
+
+        self.assertIn("Not quite, the correct answer is A) yes. Because yes.", review["messages"][-1].content)
+        self.assertIn("7/10", review["summary"])
+        self.assertIn("repeating the lesson on Loops", review["summary"])
+        self.assertEqual(local_route({**state, "subgraph_state": review}, review["summary"]), "loops")
+
+    def test_feedback_is_not_streamed(self):
+        """Clarifications are not streamed from inside the chat node; the reply is rendered from state."""
+        bank = [{"question": f"Review {i}?", "options": ["yes", "no", "maybe", "never"], "answer_index": 0,
+                 "concept": f"concept {i}"} for i in range(10)]
+        fake_llm = GenericFakeChatModel(messages=iter([AIMessage(content="It asks whether the loop runs.")]))
+        final_state = {}
+        with patch("review_graph.draw_questions", return_value=bank), patch("review_graph.feedback_llm", fake_llm):
+            review = review_graph.invoke({"topic": "Loops", "messages": []})
+            state = {**quiz_state(), "squads_ready": False, "previous_topic": "Loops",
+                     "subgraph_state": review, "messages": [HumanMessage(content="What does this question mean?")]}
+            chunks = list(stream_primary_graph(state, final_state, {"configurable": {"thread_id": "test-review-feedback-stream"}}))
+
+        self.assertEqual(chunks, [])
+        self.assertEqual(final_state["subgraph_state"]["messages"][-1].content, "It asks whether the loop runs.")
+        self.assertEqual(final_state["subgraph_state"]["question_index"], 0)
+
+class TestSemanticCache(unittest.TestCase):
+    """Tests for reusing answers to near-duplicate opening questions on the public chat"""
+
+    def test_near_duplicates_hit_and_entries_expire(self):
+        """Questions above the similarity threshold share an answer until it expires."""
+        cache = SemanticCache(threshold=0.95, ttl_seconds=60, max_entries=10)
+        with patch("semantic_cache.time.monotonic", return_value=0):
+            cache.store("what is a class", [1.0, 0.0, 0.0], "A blueprint for objects.")
+            self.assertEqual(cache.lookup("what's a class", [0.99, 0.05, 0.0]), "A blueprint for objects.")
+            self.assertIsNone(cache.lookup("what is a loop", [0.5, 0.8, 0.0]))
+        with patch("semantic_cache.time.monotonic", return_value=61):
+            self.assertIsNone(cache.lookup("what is a class", [1.0, 0.0, 0.0]))
+        self.assertEqual(normalize_question("  What is a  Class?? "), "what is a class")
+
+    def test_only_opening_questions_are_cached(self):
+        """A repeated opening question skips the agent; follow-up questions always run it."""
+        csa_rag_agent.answer_cache.invalidate()
+        greeting = AIMessage(content="Hi! I'm Lola.")
+        with patch.object(csa_rag_agent, "embeddings") as embeddings, patch.object(csa_rag_agent, "app") as app:
+            embeddings.embed_query.return_value = [0.0, 1.0]
+            app.invoke.side_effect = lambda state: {"messages": state["messages"] + [AIMessage(content="The exam has two sections.")]}
+
+            first = csa_rag_agent.invoke_agent([greeting, HumanMessage(content="What's on the AP exam?")])
+            second = csa_rag_agent.invoke_agent([greeting, HumanMessage(content="what's on the AP exam")])
+            self.assertEqual(second[-1].content, "The exam has two sections.")
+            self.assertEqual(app.invoke.call_count, 1)
+
+            csa_rag_agent.invoke_agent(first + [HumanMessage(content="What's on the AP exam?")])
+            self.assertEqual(app.invoke.call_count, 2)
+
+class TestEmbeddingCache(unittest.TestCase):
+    """Tests for caching embeddings in memory and in MongoDB"""
+
+    def test_repeats_are_not_embedded_again(self):
+        """Each text is embedded once; later lookups come from memory, or from MongoDB after a restart."""
+        model = DeterministicFakeEmbedding(size=8)
+        collection = InMemoryCollection()
+        cached = CachedEmbeddings(model, collection_provider=lambda: collection, ttl_seconds=60)
+        with patch.object(DeterministicFakeEmbedding, "embed_documents", autospec=True, side_effect=lambda self, texts: [self.embed_query(text) for text in texts]) as embed:
+            first = cached.embed_documents(["What is a class?", "What is a loop?"])
+            again = cached.embed_documents(["What is  a class?", "What is a loop?", "What is a loop?"])
+            self.assertEqual(embed.call_count, 1)
+        self.assertEqual(again, [first[0], first[1], first[1]])
+        self.assertEqual(len(collection.documents), 2)
+        self.assertEqual(collection.indexes["expires_at"], {"expireAfterSeconds": 0})
+
+        restarted = CachedEmbeddings(model, collection_provider=lambda: collection)
+        with patch.object(DeterministicFakeEmbedding, "embed_query", side_effect=AssertionError("should come from MongoDB")):
+            self.assertEqual(restarted.embed_query("What is a class?"), first[0])
+        self.assertEqual(run_async(restarted.aembed_query("What is a class?")), first[0])
+        self.assertEqual(restarted.stats, {"memory_hits": 1, "mongo_hits": 1, "misses": 0})
+
+    def test_expired_entries_are_embedded_again(self):
+        """Entries past their TTL are not served from MongoDB, and embedding them again renews them."""
+        model = DeterministicFakeEmbedding(size=8)
+        collection = InMemoryCollection()
+        CachedEmbeddings(model, collection_provider=lambda: collection, ttl_seconds=0).embed_query("What is a class?")
+        renewed = CachedEmbeddings(model, collection_provider=lambda: collection, ttl_seconds=60)
+        renewed.embed_query("What is a class?")
+        self.assertEqual(renewed.stats["misses"], 1)
+        self.assertEqual(len(collection.documents), 1)
+        self.assertEqual(CachedEmbeddings(model, collection_provider=lambda: collection).lookup(["What is a class?"])[2], {})
+
+class TestLocalVectorStore(unittest.TestCase):
+    """Tests for the local memory-mapped vector index"""
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+
+    def test_search_and_reload(self):
+        """Texts are found by their own query, and the index is read back from disk."""
+        embedding = DeterministicFakeEmbedding(size=16)
+        texts = ["Classes are blueprints", "Loops repeat code", "Arrays hold values"]
+        LocalVectorStore.from_texts(texts, embedding, metadatas=[{"unit": i} for i in range(3)], index_dir=self.index_dir)
+
+        store = LocalVectorStore(embedding, self.index_dir)
+        self.assertIsInstance(store.vectors, np.memmap)
+        results = store.similarity_search("Loops repeat code", k=2)
+        self.assertEqual(results[0].page_content, "Loops repeat code")
+        self.assertEqual(results[0].metadata, {"unit": 1})
+        self.assertEqual(len(results), 2)
+
+    def test_ivf_search(self):
+        """Large corpora are searched through the coarse quantizer and still find exact matches."""
+        vectors = np.random.default_rng(1).normal(size=(400, 16))
+        store = LocalVectorStore(DeterministicFakeEmbedding(size=16), self.index_dir)
+        with patch("local_vector_store.IVF_MIN_VECTORS", 100):
+            store.add_vectors(vectors.tolist(), [f"text {i}" for i in range(400)])
+        self.assertEqual(len(store.centroids), 20)
+        for i in (0, 123, 399):
+            self.assertEqual(store.similarity_search_by_vector(vectors[i].tolist(), k=1)[0].page_content, f"text {i}")
+
+    def test_ids_stay_unique_after_deletes(self):
+        """Rows added after a delete get fresh ids, so deleting them leaves the older rows alone."""
+        store = LocalVectorStore(DeterministicFakeEmbedding(size=16), self.index_dir)
+        first = store.add_texts(["Classes are blueprints", "Loops repeat code"])
+        store.delete(first[:1])
+        added = store.add_texts(["Arrays hold values"])
+        self.assertNotIn(added[0], first)
+        store.delete(added)
+        self.assertEqual([document["text"] for document in store.documents], ["Loops repeat code"])
+        self.assertEqual(store.add_texts(["Strings hold text"], ids=["chunk-hash"]), ["chunk-hash"])
+
+    def test_retrieval_falls_back_to_local_index(self):
+        """When the primary store fails, retrieval answers from the local index."""
+        embedding = DeterministicFakeEmbedding(size=16)
+        local = LocalVectorStore.from_texts(["Classes are blueprints"], embedding, index_dir=self.index_dir)
+        broken = MagicMock()
+        broken.similarity_search_by_vector.side_effect = TimeoutError("Atlas is slow")
+        with patch.object(csa_rag_agent, "vectorstore", broken), patch.object(csa_rag_agent, "fallback_store", local):
+            state = csa_rag_agent.retrieve({"messages": [HumanMessage(content="What is a class?")], "context": [],
+                                             "query_embedding": embedding.embed_query("Classes are blueprints")})
+        self.assertEqual(state["context"], ["Classes are blueprints"])
+
+class InMemoryCollection:
+    """Just enough of a pymongo collection for the question bank, ingestion and cache tests."""
+
+    def __init__(self):
+        self.documents = {}
+        self.indexes = {}
+
+    def create_index(self, key, **options):
+        self.indexes[key] = options
+
+    def matches(self, document, criteria):
+        for key, condition in criteria.items():
+            value = document.get(key)
+            if isinstance(condition, dict):
+                if "$in" in condition and value not in condition["$in"]:
+                    return False
+                if "$size" in condition and len(value) != condition["$size"]:
+                    return False
+                if "$gt" in condition and not value > condition["$gt"]:
+                    return False
+            elif isinstance(value, list):
+                if condition not in value:
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def find(self, criteria, projection=None):
+        return [document for document in self.documents.values() if self.matches(document, criteria)]
+
+    def find_one(self, criteria):
+        return next(iter(self.find(criteria)), None)
+
+    def bulk_write(self, operations, ordered=True):
+        upserted = 0
+        for operation in operations:
+            targets = self.find(operation._filter)
+            if not targets and operation._upsert:
+                document = {"_id": len(self.documents), **operation._filter, **operation._doc.get("$setOnInsert", {})}
+                self.documents[document["_id"]] = document
+                targets, upserted = [document], upserted + 1
+            for document in targets:
+                document.update(operation._doc.get("$set", {}))
+                for key, value in operation._doc.get("$addToSet", {}).items():
+                    document.setdefault(key, [])
+                    if value not in document[key]:
+                        document[key].append(value)
+                for key, value in operation._doc.get("$pull", {}).items():
+                    document[key] = [item for item in document.get(key, []) if item != value]
+        return type("BulkWriteResult", (), {"upserted_count": upserted})()
+
+    def delete_many(self, criteria):
+        for document in self.find(criteria):
+            del self.documents[document["_id"]]
+
+    def replace_one(self, criteria, document, upsert=False):
+        self.documents[criteria["_id"]] = document
+
+class TestQuestionBankPipeline(unittest.TestCase):
+    """Tests for offline question bank generation"""
+
+    def setUp(self):
+        self.checkpoint_path = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+
+    def test_validation(self):
+        """Questions need four distinct options and an answer that is one of them."""
+        question = {"question": "Q?", "options": ["a", "b", "c", "d"], "answer": "C"}
+        self.assertEqual(validate_question("Arrays", question)["answer_index"], 2)
+        self.assertIsNone(validate_question("Arrays", {**question, "answer": "e"}))
+        self.assertIsNone(validate_question("Arrays", {**question, "options": ["a", "b", "c"]}))
+        self.assertIsNone(validate_question("Arrays", {**question, "options": ["a", "b", "c", " A "]}))
+
+    def test_fills_topics_and_resumes(self):
+        """Every topic is filled to the target, and a rerun does no further work."""
+        collection = InMemoryCollection()
+        llm = RunnableLambda(fake_question_model)
+        topics = {"Arrays": "plan", "Loops": "plan"}
+        self.assertEqual(run_async(fill_question_bank(llm, collection, topics, 25, 2, self.checkpoint_path)), 50)
+        self.assertEqual(len(collection.find({"topic": "Loops"})), 25)
+
+        with patch("generate_question_bank.fake_question_model", side_effect=AssertionError("no requests expected")):
+            self.assertEqual(run_async(fill_question_bank(llm, collection, topics, 25, 2, self.checkpoint_path)), 0)
+
+    def test_duplicates_are_dropped(self):
+        """A model that keeps repeating itself only contributes its questions once."""
+        collection = InMemoryCollection()
+        repeat = RunnableLambda(lambda messages: fake_question_model([HumanMessage(content="Topic: Arrays\nWrite 10 new questions (batch 1).")]))
+        added = run_async(fill_question_bank(repeat, collection, {"Arrays": "plan"}, 25, 1, self.checkpoint_path))
+        self.assertEqual(added, 10)
+
+    def test_fake_runs_need_a_separate_collection(self):
+        """Placeholder questions are never written to the bank students are served from."""
+        with patch("sys.argv", ["generate_question_bank.py", "--fake-llm"]), \
+                patch("generate_question_bank.questions_collection") as collection, patch("sys.stderr"):
+            with self.assertRaises(SystemExit):
+                generate_question_bank.main()
+        collection.assert_not_called()
+
+class TestIngestion(unittest.TestCase):
+    """Tests for incremental ingestion of the CSA knowledge base"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.collection, self.sources = InMemoryCollection(), InMemoryCollection()
+        self.embeddings = MagicMock()
+        self.embeddings.aembed_documents = AsyncMock(side_effect=lambda texts: [[1.0, 0.0] for _ in texts])
+
+    def write(self, name, paragraphs):
+        with open(os.path.join(self.folder, name), "w") as file:
+            file.write("\n\n".join(paragraphs))
+
+    def run_ingest(self):
+        return run_async(ingest([self.folder], self.collection, self.sources, self.embeddings, concurrency=2))
+
+    def embedded_count(self):
+        return sum(len(call.args[0]) for call in self.embeddings.aembed_documents.call_args_list)
+
+    def test_only_changed_chunks_are_embedded(self):
+        """Unchanged files are skipped, and an edit only embeds and removes the chunks it changed."""
+        paragraphs = [f"Paragraph {i}. " + "Java classes and objects. " * 30 for i in range(5)]
+        self.write("unit1.txt", paragraphs)
+        self.write("notes.md", paragraphs[:1])
+        self.run_ingest()
+        self.assertEqual(self.embedded_count(), 5)
+        shared = [document for document in self.collection.documents.values() if len(document["sources"]) == 2]
+        self.assertEqual(len(shared), 1)
+
+        self.assertTrue(all(result["skipped"] for result in self.run_ingest()))
+
+        self.write("unit1.txt", paragraphs[:4] + ["A brand new paragraph about loops. " * 20])
+        results = {os.path.basename(result["source"]): result for result in self.run_ingest()}
+        self.assertEqual(self.embedded_count(), 6)
+        self.assertEqual((results["unit1.txt"]["added"], results["unit1.txt"]["removed"]), (1, 1))
+        self.assertEqual(len(self.collection.documents), 5)
+
+class TestHybridRetrieval(unittest.TestCase):
+    """Tests for BM25 retrieval fused with vector search"""
+
+    chunks = [
+        "An ArrayList grows as elements are added with add and removed with remove.",
+        "The compareTo method returns a negative number, zero or a positive number.",
+        "Math.random returns a double between 0.0 and 1.0.",
+        "Loops repeat a block of code while a condition is true.",
+    ]
+
+    def test_identifiers_are_tokenized_whole_and_in_parts(self):
+        """Java identifiers are indexed whole and split at dots and camel case."""
+        self.assertEqual(tokenize("Math.random()"), ["math.random", "math", "random"])
+        self.assertEqual(tokenize("compareTo"), ["compareto", "compare", "to"])
+        self.assertEqual(tokenize("ArrayList"), ["arraylist", "array", "list"])
+
+    def test_bm25_finds_exact_terms(self):
+        """Chunks naming the identifier in the query rank first, and unrelated chunks are not returned."""
+        index = BM25Index(self.chunks)
+        self.assertEqual(index.search("How does compareTo work?", 2)[0][0], 1)
+        self.assertEqual(index.search("What does Math.random return?", 2)[0][0], 2)
+        self.assertEqual(index.search("xyzzy", 3), [])
+
+    def test_reciprocal_rank_fusion(self):
+        """Items ranked well by both retrievers beat items ranked first by only one."""
+        self.assertEqual(reciprocal_rank_fusion([["a", "b", "c"], ["b", "c", "d"]]), ["b", "c", "a", "d"])
+
+    def test_retrieve_fuses_lexical_matches(self):
+        """A chunk that vector search misses is still retrieved when it names the queried identifier."""
+        store = MagicMock()
+        store.similarity_search_by_vector.return_value = [
+            MagicMock(page_content=text) for text in (self.chunks[3], self.chunks[0], self.chunks[2])
+        ]
+        with patch.object(csa_rag_agent, "vectorstore", store), patch.object(csa_rag_agent, "fallback_store", None), \
+                patch.object(csa_rag_agent, "lexical_index", return_value=BM25Index(self.chunks)):
+            state = csa_rag_agent.retrieve({"messages": [HumanMessage(content="When is compareTo negative?")], "context": [],
+                                             "query_embedding": [1.0, 0.0]})
+        self.assertEqual(len(state["context"]), csa_rag_agent.RETRIEVAL_K)
+        self.assertIn(self.chunks[1], state["context"])
+        self.assertEqual(store.similarity_search_by_vector.call_args.kwargs["k"], csa_rag_agent.FUSION_CANDIDATES)
+
+class TestContextBudget(unittest.TestCase):
+    """Tests for token-budgeted prompt assembly in the CSA chat"""
+
+    def test_overlapping_chunks_are_deduped(self):
+        """Repeated chunks are dropped and the text neighbouring chunks share is kept once."""
+        shared = "the enhanced for loop visits every element of an array in order, "
+        first = "Arrays store values of one type. " + shared
+        second = shared + "but it cannot change which element a slot holds."
+        deduped = dedupe_chunks([first, second, first])
+        self.assertEqual(deduped[0], first.strip())
+        self.assertEqual(deduped[1], "but it cannot change which element a slot holds.")
+        self.assertEqual(len(deduped), 2)
+
+    def test_chunks_fit_the_budget_in_relevance_order(self):
+        """Chunks are kept most relevant first, and the last one is truncated to the remaining budget."""
+        chunks = [f"Chunk {i} " + "word " * 200 for i in range(3)]
+        selected, used = budget_chunks(chunks, 350)
+        self.assertEqual(len(selected), 2)
+        self.assertTrue(selected[1].startswith("Chunk 1") and selected[1].endswith("..."))
+        self.assertLessEqual(used, 350)
+        self.assertEqual(sum(approximate_tokens(chunk) for chunk in selected), used)
+
+    def test_old_turns_are_trimmed(self):
+        """History keeps the greeting and the latest turns within budget, starting on a student message."""
+        messages = [AIMessage(content="Hi, ask me about AP CSA!")]
+        for i in range(20):
+            messages += [HumanMessage(content=f"Question {i} " + "about loops " * 20), AIMessage(content="Answer " * 60)]
+        messages.append(HumanMessage(content="Last question"))
+        history = budget_history(messages, 400)
+        self.assertLess(len(history), len(messages))
+        self.assertEqual(history[0].content, "Hi, ask me about AP CSA!")
+        self.assertIsInstance(history[1], HumanMessage)
+        self.assertEqual(history[-1].content, "Last question")
+        self.assertLessEqual(count_tokens_approximately(history), 400)
+        long_greeting = [AIMessage(content="Hi " * 200), HumanMessage(content="What is a class?")]
+        self.assertEqual(budget_history(long_greeting, 20), long_greeting[1:])
+        self.assertEqual(budget_history([HumanMessage(content="long " * 1000)], 10)[0].content, "long " * 1000)
+
+    def test_truncation_respects_the_budget(self):
+        """Truncated text, marker included, stays within the budget, and no budget leaves no text."""
+        text = "word " * 100
+        for tokens in (1, 5, 20):
+            self.assertLessEqual(approximate_tokens(truncate_to_tokens(text, tokens)), tokens)
+        self.assertEqual(truncate_to_tokens(text, 0), "")
+        self.assertEqual(truncate_to_tokens(text, 1), "")
+
+class TestBoundedChatHistory(unittest.TestCase):
+    """Tests for the capped chat history of the public CSA chat"""
+
+    def chat(self, history, turns):
+        for i in range(turns):
+            history.add(HumanMessage(content=f"Question {i}"))
+            history.add(AIMessage(content=f"Answer {i} " + "detail " * 50))
+            history.compact()
+
+    def test_history_stays_bounded(self):
+        """However long the chat, stored turns and the summary stay capped."""
+        history = BoundedChatHistory("Hi!", max_turns=4, keep_turns=2)
+        summaries = [AIMessage(content="Summary " + "word " * n) for n in (10, 2000) * 20]
+        with patch("compaction.summarizer", GenericFakeChatModel(messages=iter(summaries))):
+            self.chat(history, 30)
+        usage = history.usage()
+        self.assertLessEqual(usage["stored_turns"], 4)
+        self.assertEqual(usage["folded_turns"] + usage["stored_turns"], 30)
+        self.assertLessEqual(len(history.summary), 300 * 4 + 4)
+        self.assertLess(usage["memory_bytes"], 4000)
+
+    def test_generation_sees_the_summary(self):
+        """The agent is sent the greeting, the summary and the recent turns, and the summary survives the budget."""
+        history = BoundedChatHistory("Hi!", max_turns=2, keep_turns=1)
+        with patch("compaction.summarizer", GenericFakeChatModel(messages=iter([AIMessage(content="Asked about loops")]))):
+            self.chat(history, 3)
+        messages = history.for_generation()
+        self.assertEqual(messages[0].content, "Hi!")
+        self.assertIn("Asked about loops", messages[1].content)
+        self.assertEqual(messages[2].content, "Question 2")
+        self.assertIn("Asked about loops", budget_history(messages, 50)[0].content)
+
+    def test_summary_tracks_the_visitors_questions(self):
+        """Folded turns are summarized with the chat's own prompt, not the tutoring session's."""
+        history = BoundedChatHistory("Hi!", max_turns=2, keep_turns=1)
+        with patch("chat_history.summary_model") as summary_model:
+            summary_model.return_value.invoke.return_value = AIMessage(content="Asked about loops")
+            self.chat(history, 3)
+        prompt = summary_model.return_value.invoke.call_args.args[0]
+        self.assertIn("each question the visitor asked", prompt)
+        self.assertIn("Visitor: Question 0", prompt)
+        self.assertNotIn("Student:", prompt)
+
+class TestLLMGateway(unittest.TestCase):
+    """Tests for the process-wide rate limiting, retries and metrics of model calls"""
+
+    completion = {
+        "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "gpt-4.1-mini",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello!"}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}
+    }
+
+    def gateway(self, responses):
+        metrics = GatewayMetrics()
+        transport = GatewayTransport(httpx.Limits(), scheduler=PriorityScheduler(RateLimiter(1000, 1000000)), metrics=metrics)
+        statuses = iter(responses)
+        transport.transport = httpx.MockTransport(lambda request: httpx.Response(next(statuses), json=self.completion))
+        return transport, metrics
+
+    def test_token_bucket_spaces_out_bursts(self):
+        """Requests within the minute's allowance go straight out; the rest wait for the refill."""
+        bucket = TokenBucket(per_minute=60)
+        self.assertEqual(bucket.wait_time(60), 0.0)
+        bucket.take(60)
+        self.assertAlmostEqual(bucket.wait_time(1), 1.0, places=1)
+        self.assertAlmostEqual(bucket.wait_time(1000), 60.0, places=0)
+
+    def test_rate_limit_errors_are_retried(self):
+        """A model call that hits 429 and 503 is retried and succeeds, and the attempts are recorded."""
+        transport, metrics = self.gateway([429, 503, 200])
+        model = ChatOpenAI(model="gpt-4.1-mini", api_key="test", max_retries=0, http_client=httpx.Client(transport=transport))
+        with patch("llm_gateway.backoff_seconds", return_value=0):
+            self.assertEqual(model.invoke("Hi").content, "Hello!")
+        stats = metrics.stats()["gpt-4.1-mini"]
+        self.assertEqual((stats["calls"], stats["retries"], stats["rate_limited"], stats["errors"]), (1, 2, 1, 0))
+
+    def test_retries_give_up(self):
+        """After the last retry the error response is passed on to the caller."""
+        transport, metrics = self.gateway([500] * 3)
+        transport.max_retries = 2
+        with patch("llm_gateway.backoff_seconds", return_value=0):
+            response = transport.handle_request(httpx.Request("POST", "https://api.openai.com/v1/chat/completions", json={"model": "m"}))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(metrics.stats()["m"]["errors"], 1)
+
+class ManualLimiter:
+    """Rate limiter that admits only as many requests as the test allows, recording each one's tokens."""
+
+    def __init__(self):
+        self.allowance = 0
+        self.taken = []
+
+    def wait_time(self, tokens):
+        return 0.0 if self.allowance else 0.01
+
+    def take(self, tokens):
+        self.allowance -= 1
+        self.taken.append(tokens)
+
+class TestPriorityScheduler(unittest.TestCase):
+    """Tests for priority and fair-share admission of model requests"""
+
+    def test_admission_order(self):
+        """Interactive requests go before background ones, and students take turns within a priority."""
+        limiter = ManualLimiter()
+        scheduler = PriorityScheduler(limiter)
+        # Token counts identify the requests
+        with llm_owner("student:a"):
+            with llm_priority(BACKGROUND):
+                waiters = [scheduler.admit_now(1)]
+            waiters += [scheduler.admit_now(2), scheduler.admit_now(3)]
+        with llm_owner("student:b"):
+            waiters.append(scheduler.admit_now(4))
+        self.assertEqual(scheduler.stats()["interactive"]["depth"], 3)
+
+        with scheduler.condition:
+            limiter.allowance = 4
+            scheduler.condition.notify()
+        self.assertTrue(all(waiter.event.wait(2) for waiter in waiters))
+        self.assertEqual(limiter.taken, [2, 4, 3, 1])
+        stats = scheduler.stats()
+        self.assertEqual((stats["interactive"]["queued"], stats["background"]["queued"], stats["background"]["depth"]), (3, 1, 0))
+
+    def test_requests_with_room_are_not_queued(self):
+        """With room under the limit and nothing queued, a request is admitted without waiting."""
+        scheduler = PriorityScheduler(RateLimiter(60, 10000))
+        self.assertLess(scheduler.acquire(100) + scheduler.acquire(100), 0.01)
+        self.assertEqual(scheduler.stats()["interactive"]["queued"], 0)
+        self.assertIsNone(scheduler.dispatcher)
+
+class TestModelRoutes(unittest.TestCase):
+    """Tests for the per-task model routing table"""
+
+    def test_routes_fill_in_from_default(self):
+        """Listed tasks get their own settings, and anything they leave out comes from the default route."""
+        with patch.dict(llm_clients.model_routes, {"grading": {"model": "gpt-4.1-nano", "temperature": 0, "max_tokens": 5}}):
+            model = llm_clients.task_model("grading")
+            self.assertEqual((model.model_name, model.temperature, model.max_tokens), ("gpt-4.1-nano", 0, 5))
+            self.assertEqual(model.request_timeout, llm_clients.model_routes["default"]["timeout"])
+            self.assertEqual(llm_clients.model_route("unlisted"), llm_clients.model_routes["default"])
+
+    def test_small_tasks_use_the_small_model(self):
+        """Classification and summaries run on the small model with tight output limits, lessons on the larger one."""
+        import cassie_graph, lola_graph, tools
+        self.assertEqual((lola_graph.llm.model_name, lola_graph.llm.max_tokens), ("gpt-4.1-nano", 20))
+        self.assertEqual(tools.llm.model_name, "gpt-4.1-nano")
+        self.assertEqual(cassie_graph.llm.bound.model_name, "gpt-4.1-mini")
+
+class TestResponseCache(unittest.TestCase):
+    """Tests for the opt-in exact-match cache of deterministic model calls"""
+
+    def test_repeated_calls_are_served_from_cache(self):
+        """An identical call is answered from memory, and another process is answered from MongoDB."""
+        collection = InMemoryCollection()
+        cache = ResponseCache(ttl_seconds=60, collection_provider=lambda: collection)
+        replies = iter([AIMessage(content="Question 1: What is an int?"), AIMessage(content="Question 1: What is a loop?")])
+        model = GenericFakeChatModel(messages=replies, cache=cache)
+
+        first = model.invoke([SystemMessage(content="Quiz topic: Variables")]).content
+        self.assertEqual(model.invoke([SystemMessage(content="Quiz topic:   Variables")]).content, first)
+        self.assertEqual(model.invoke([SystemMessage(content="Quiz topic: Loops")]).content, "Question 1: What is a loop?")
+        self.assertEqual(collection.indexes["expires_at"], {"expireAfterSeconds": 0})
+
+        other_process = ResponseCache(ttl_seconds=60, collection_provider=lambda: collection)
+        model = GenericFakeChatModel(messages=iter([]), cache=other_process)
+        self.assertEqual(model.invoke([SystemMessage(content="Quiz topic: Variables")]).content, first)
+
+        report, other_report = cache.report(), other_process.report()
+        self.assertEqual((report["memory_hits"], report["misses"]), (1, 2))
+        self.assertAlmostEqual(report["hit_rate"], 1 / 3)
+        self.assertEqual(other_report["mongo_hits"], 1)
+        self.assertGreaterEqual(report["saved_seconds"], 0.0)
+
+    def test_expired_entries_miss(self):
+        """Entries past their TTL are not served from either tier."""
+        collection = InMemoryCollection()
+        cache = ResponseCache(ttl_seconds=0, collection_provider=lambda: collection)
+        model = GenericFakeChatModel(messages=iter([AIMessage(content="One"), AIMessage(content="Two")]), cache=cache)
+        model.invoke("Hi")
+        self.assertEqual(model.invoke("Hi").content, "Two")
+
+    def test_only_temperature_zero_tasks_are_cached(self):
+        """Tasks opt in through the routing table, and the opt-in is ignored unless temperature is 0."""
+        routes = {"pure": {"temperature": 0, "cacheable": True}, "creative": {"temperature": 0.7, "cacheable": True}}
+        with patch.dict(llm_clients.model_routes, routes):
+            self.assertIs(llm_clients.task_model("pure").cache, llm_clients.response_cache)
+            self.assertIsNone(llm_clients.task_model("creative").cache)
+        self.assertIsNone(llm_clients.task_model("lesson").cache)
+
+    def test_lesson_opening_hits_across_logins(self):
+        """The lesson opening depends only on the student's name and topic, so a second login is served from cache."""
+        cache = ResponseCache(ttl_seconds=60)
+        model = GenericFakeChatModel(messages=iter([AIMessage(content="Welcome back Sam!")]), cache=cache)
+        replies = []
+        with patch("cassie_graph.opening_llm", model):
+            for last_login in ["2026-10-01T09:00:00", "2026-10-02T17:30:00"]:
+                profile = {"name": "Sam", "last_login": last_login, "created_at": "2026-09-01T12:00:00"}
+                state = lesson_graph.invoke({"topic": "Arrays", "messages": [], "lesson_plan": None, "summary": None, "user_profile": profile})
+                replies.append(state["messages"][-1].content)
+
+        self.assertEqual(replies, ["Welcome back Sam!"] * 2)
+        self.assertEqual((cache.report()["memory_hits"], cache.report()["misses"]), (1, 1))
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -1,18 +1,94 @@
-import json, os
+import json, logging, os, threading, time
 import utils
 
-from langchain_community.document_loaders.mongodb import MongodbLoader
+from collections import OrderedDict
 from langchain_core.tools import tool
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
-from langchain_openai import ChatOpenAI
-from typing import List
+from llm_clients import task_model
+from llm_gateway import BACKGROUND, llm_priority
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
 
 # Initialize the language model
-llm = ChatOpenAI(
-    model_name="gpt-4.1-mini",
-    temperature=0.7,
-    api_key=utils.OPENAI_API_KEY
-)
+llm = task_model("lesson_summary")
+
+# Lesson templates rarely change, so lookups are served from memory for a while
+LESSON_PLAN_TTL_SECONDS = int(os.environ.get("LESSON_PLAN_TTL_SECONDS", 600))
+LESSON_PLAN_CACHE_SIZE = 128
+
+class LessonPlanCache:
+    """Least-recently-used cache of lesson templates by topic, whose entries expire after a TTL."""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, topic: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(topic)
+            if entry is None or entry[1] <= time.monotonic():
+                self.entries.pop(topic, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(topic)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, topic: str, template: str):
+        with self.lock:
+            self.entries[topic] = (template, time.monotonic() + self.ttl_seconds)
+            self.entries.move_to_end(topic)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, topic: Optional[str] = None):
+        """Drop one topic, or every topic when none is given."""
+        with self.lock:
+            if topic is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(topic, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+lesson_plan_cache = LessonPlanCache(LESSON_PLAN_TTL_SECONDS, LESSON_PLAN_CACHE_SIZE)
+_template_watcher_started = threading.Event()
+
+def lesson_templates_collection():
+    """The lesson_templates collection on the shared, pooled MongoDB client."""
+    client = utils.get_mongodb_connection()
+    if client is None:
+        raise ConnectionError("MongoDB is unavailable")
+    collection = client[utils.MONGO_DB_NAME]["lesson_templates"]
+    if not _template_watcher_started.is_set():
+        _template_watcher_started.set()
+        threading.Thread(target=watch_lesson_templates, args=(collection,), name="lesson-template-watcher", daemon=True).start()
+    return collection
+
+def watch_lesson_templates(collection):
+    """Invalidate cached templates as soon as their documents change.
+
+    Relies on a MongoDB change stream, which Atlas clusters provide. Where change streams
+    are unavailable, cached templates simply expire after LESSON_PLAN_TTL_SECONDS.
+    """
+    try:
+        with collection.watch(full_document="updateLookup") as stream:
+            for change in stream:
+                topic = (change.get("fullDocument") or {}).get("topic_name")
+                # Deletes do not carry the old document, so forget everything in that case
+                lesson_plan_cache.invalidate(topic)
+                logger.info("Lesson template changed (%s), invalidated %s", change.get("operationType"), topic or "all topics")
+    except Exception as e:
+        logger.warning("Lesson template change stream unavailable, relying on TTL expiry: %s", e)
 
 
 @tool
@@ -24,17 +100,16 @@ def fetch_lesson_plan(topic: str):
             "suggestion": "Please provide a topic for the lesson plan."
         })
     
+    template = lesson_plan_cache.get(topic)
+    if template is not None:
+        return template
+    
     try:
-        loader = MongodbLoader(
-            connection_string=utils.CONNECTION_STRING,
-            db_name=utils.MONGO_DB_NAME,
-            collection_name="lesson_templates",
-            filter_criteria={"topic_name": topic},
-            field_names=["template"]
-        )
-        docs = loader.load()
-        if docs:
-            return docs[0].page_content
+        doc = lesson_templates_collection().find_one({"topic_name": topic}, {"template": 1})
+        if doc:
+            template = str(doc.get("template", ""))
+            lesson_plan_cache.put(topic, template)
+            return template
         return json.dumps({
             "error": f"No lesson plan found for topic: {topic}",
             "suggestion": "Please try a different topic or create a new lesson plan."
@@ -71,8 +146,9 @@ def generate_summary(messages: List[BaseMessage]):
         # Add the extracted messages to the summary prompt
         summary_prompt += "\n".join(message_texts)
         
-        # Generate summary using the LLM
-        summary = llm.invoke(summary_prompt)
+        # Generate summary using the LLM, behind any turn a student is waiting on
+        with llm_priority(BACKGROUND):
+            summary = llm.invoke(summary_prompt)
         if hasattr(summary, "content"):
             return summary.content
         return summary
@@ -1,16 +1,21 @@
 import base64
 import hashlib
+import logging
 import os
 import streamlit as st
 import certifi
 
 from dotenv import load_dotenv
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.mongodb import MongoDBSaver
 from pymongo import MongoClient
 from urllib.parse import quote_plus
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 def get_secret(key):
     value = os.getenv(key)
     if value:
@@ -56,6 +61,32 @@ def get_mongodb_connection():
         st.error(f"Failed to connect to MongoDB: {e}")
         return None
 
+@st.cache_resource
+def get_checkpointer():
+    """
+    Returns the LangGraph checkpointer that persists tutoring sessions in MongoDB.
+    Falls back to an in-process store if the database is unreachable.
+    """
+    client = get_mongodb_connection()
+    if client is None:
+        logger.warning("MongoDB unavailable, tutoring sessions will not persist across restarts")
+        return InMemorySaver()
+    return MongoDBSaver(
+        client,
+        db_name=MONGO_DB_NAME,
+        checkpoint_collection_name="session_checkpoints",
+        writes_collection_name="session_checkpoint_writes"
+    )
+
+def student_thread_config(user_data: dict) -> dict:
+    """Graph config that keys checkpointed session state to the student."""
+    student_id = user_data.get("email") or user_data.get("username")
+    return {"configurable": {"thread_id": f"student:{student_id}"}}
+
+def graph_user_profile(user_data: dict) -> dict:
+    """Copy of the user record that is safe to store in checkpointed graph state."""
+    return {key: value for key, value in user_data.items() if key not in ("_id", "password_hash")}
+
 # Convert Streamlit chat format to Langgraph format
 def convert_to_langgraph_messages(streamlit_messages):
     langgraph_messages = []
@@ -75,7 +106,9 @@ def convert_to_streamlit_messages(langgraph_messages):
         if isinstance(msg, HumanMessage):
             streamlit_messages.append({"role": "user", "content": msg.content})
         elif isinstance(msg, AIMessage):
-            streamlit_messages.append({"role": "assistant", "content": msg.content})
+            # Messages that only call tools have nothing to show
+            if msg.content:
+                streamlit_messages.append({"role": "assistant", "content": msg.content})
         elif isinstance(msg, SystemMessage):
             streamlit_messages.append({"role": "system", "content": msg.content})
     return streamlit_messages